@@ -16,6 +16,7 @@ import tensorflow as tf
 from tools.common import Notify
 
 DEFAULT_PADDING = 'SAME'
+LOW_PRECISION_DTYPES = (tf.float16, tf.bfloat16)
 
 
 def layer(op):
@@ -48,6 +49,13 @@ def layer(op):
     return layer_decorated
 
 
+def float32_variable_getter(getter, name, shape=None, dtype=None, *args, **kwargs):
+    """Keep the variables of low precision layers in float32, cast to the layer dtype when read."""
+    if dtype not in LOW_PRECISION_DTYPES:
+        return getter(name, shape, dtype, *args, **kwargs)
+    return tf.cast(getter(name, shape, tf.float32, *args, **kwargs), dtype)
+
+
 class Network(object):
     """Class NetWork."""
 
@@ -70,6 +78,10 @@ class Network(object):
         self.regularizer = tf.contrib.layers.l2_regularizer(1.0) if regularize else None
         # The epsilon paramater in BN layer.
         self.bn_epsilon = epsilon
+        # Fixed statistics {name: (mean, variance)} of BN layers, instead of the batch statistics
+        self.bn_stats = kwargs.pop('bn_stats', None) or {}
+        # Mapping from BN layer names to their inputs
+        self.bn_inputs = {}
         self.extra_args = kwargs
         if inputs is not None:
             # The current list of terminal nodes
@@ -78,7 +90,13 @@ class Network(object):
             self.layers = dict(inputs)
             # If true, dense layers will be omitted in network construction
             self.fcn = fcn
-            self.setup()
+            if any(tensor.dtype.base_dtype in LOW_PRECISION_DTYPES for tensor in self.layers.values()):
+                # Layers run in the input dtype, variables (and checkpoints) stay in float32
+                with tf.variable_scope(tf.get_variable_scope(), custom_getter=float32_variable_getter,
+                                       auxiliary_name_scope=False):
+                    self.setup()
+            else:
+                self.setup()
 
     def setup(self):
         '''Construct the network. '''
@@ -476,6 +494,17 @@ class Network(object):
     def batch_normalization(self, input_tensor, name,
                             center=False, scale=False, relu=False, reuse=False):
         """Batch normalization."""
+        self.bn_inputs[name] = input_tensor
+        if name in self.bn_stats:
+            dtype = input_tensor.dtype.base_dtype
+            mean, variance = [tf.cast(stat, dtype) for stat in self.bn_stats[name]]
+            with tf.variable_scope(name, reuse=True):
+                beta = tf.cast(tf.get_variable('beta'), dtype) if center else None
+                gamma = tf.cast(tf.get_variable('gamma'), dtype) if scale else None
+            output = tf.nn.batch_normalization(input_tensor, mean, variance, beta, gamma, self.bn_epsilon)
+            if relu:
+                output = self.relu(output, name + '/relu')
+            return output
         output = tf.layers.batch_normalization(input_tensor,
                                                center=center,
                                                scale=scale,
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Equivalence and CPU speed of the bilinear samplers: homography_warping against its previous
+per-corner gather_nd version, and transform_sampling (the fallback of image_transform without
+tf.contrib) against tf.contrib.image.transform, on random features and plane sweep homographies
+of slightly rotated cameras. The image gradient of tf.contrib.image.transform is the output gradient
+warped back by the inverse transform, an approximation of the exact gradient of the sampling, so
+only the transform_sampling outputs are checked against it.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from homography_warping import *
+from benchmark_shift_warp import grid_cams
+
+
+def interpolate_legacy(image, x, y):
+    """ interpolate before gather_pixels: tiled pixel grids, repeat_int and four gather_nd """
+    image_shape = tf.shape(image)
+    batch_size = image_shape[0]
+    height = image_shape[1]
+    width = image_shape[2]
+
+    x = x - 0.5
+    y = y - 0.5
+    x0 = tf.cast(tf.floor(x), 'int32')
+    x1 = x0 + 1
+    y0 = tf.cast(tf.floor(y), 'int32')
+    y1 = y0 + 1
+    x0 = tf.clip_by_value(x0, 0, width - 1)
+    x1 = tf.clip_by_value(x1, 0, width - 1)
+    y0 = tf.clip_by_value(y0, 0, height - 1)
+    y1 = tf.clip_by_value(y1, 0, height - 1)
+    b = tf.reshape(tf.matmul(tf.reshape(tf.range(batch_size), (-1, 1)),
+                             tf.ones((1, height * width), dtype='int32')), [-1])
+
+    pixel_values_a = tf.gather_nd(image, tf.stack([b, y0, x0], axis=1))
+    pixel_values_b = tf.gather_nd(image, tf.stack([b, y0, x1], axis=1))
+    pixel_values_c = tf.gather_nd(image, tf.stack([b, y1, x0], axis=1))
+    pixel_values_d = tf.gather_nd(image, tf.stack([b, y1, x1], axis=1))
+
+    x0 = tf.cast(x0, 'float32')
+    x1 = tf.cast(x1, 'float32')
+    y0 = tf.cast(y0, 'float32')
+    y1 = tf.cast(y1, 'float32')
+    return tf.add_n([tf.expand_dims((y1 - y) * (x1 - x), 1) * pixel_values_a,
+                     tf.expand_dims((y1 - y) * (x - x0), 1) * pixel_values_b,
+                     tf.expand_dims((y - y0) * (x1 - x), 1) * pixel_values_c,
+                     tf.expand_dims((y - y0) * (x - x0), 1) * pixel_values_d])
+
+def homography_warping_legacy(input_image, homography):
+    """ homography_warping before the cached pixel grids """
+    image_shape = tf.shape(input_image)
+    batch_size = image_shape[0]
+    x_linspace = tf.linspace(0.5, tf.cast(image_shape[2], 'float32') - 0.5, image_shape[2])
+    y_linspace = tf.linspace(0.5, tf.cast(image_shape[1], 'float32') - 0.5, image_shape[1])
+    x_coordinates, y_coordinates = tf.meshgrid(x_linspace, y_linspace)
+    x_coordinates = tf.reshape(x_coordinates, [-1])
+    pixel_grids = tf.concat([x_coordinates, tf.reshape(y_coordinates, [-1]), tf.ones_like(x_coordinates)], 0)
+    pixel_grids = tf.reshape(tf.tile(tf.expand_dims(pixel_grids, 0), [batch_size, 1]), (batch_size, 3, -1))
+
+    grids_affine = tf.matmul(tf.slice(homography, [0, 0, 0], [-1, 2, 3]), pixel_grids)
+    grids_div = tf.matmul(tf.slice(homography, [0, 2, 0], [-1, 1, 3]), pixel_grids)
+    grids_div = grids_div + tf.cast(tf.equal(grids_div, 0.0), dtype='float32') * 1e-7
+    grids_inv_warped = tf.div(grids_affine, tf.tile(grids_div, [1, 2, 1]))
+    x_warped, y_warped = tf.unstack(grids_inv_warped, axis=1)
+    warped_image = interpolate_legacy(input_image, tf.reshape(x_warped, [-1]), tf.reshape(y_warped, [-1]))
+    return tf.reshape(warped_image, shape=image_shape)
+
+def timeit(sess, fetches, repeat):
+    sess.run(fetches)
+    start_time = time.time()
+    for _ in range(repeat):
+        sess.run(fetches)
+    return (time.time() - start_time) / repeat * 1000.0
+
+def compare(sess, label, outputs, reference_outputs, features, tolerance, repeat, check_gradients=True):
+    """ print the largest output and image gradient differences, return the forward and gradient times """
+    gradients = tf.gradients(tf.reduce_sum(tf.square(outputs)), features)[0]
+    reference_gradients = tf.gradients(tf.reduce_sum(tf.square(reference_outputs)), features)[0]
+    gradients = tf.convert_to_tensor(gradients)
+    reference_gradients = tf.convert_to_tensor(reference_gradients)
+    out, reference_out, grad, reference_grad = sess.run(
+        [outputs, reference_outputs, gradients, reference_gradients])
+    max_diff = np.abs(out - reference_out).max()
+    grad_diff = np.abs(grad - reference_grad).max() / np.abs(reference_grad).max()
+    print('%s: max diff = %g, relative gradient diff = %g' % (label, max_diff, grad_diff))
+    assert max_diff < tolerance and (grad_diff < tolerance or not check_gradients)
+    return [timeit(sess, fetches, repeat) for fetches in
+            [reference_outputs, outputs, reference_gradients, gradients]]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=160)
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--channels', type=int, default=32)
+    parser.add_argument('--depth_num', type=int, default=32)
+    parser.add_argument('--depth_start', type=float, default=2.0)
+    parser.add_argument('--depth_interval', type=float, default=0.05)
+    parser.add_argument('--baseline', type=float, default=0.1)
+    parser.add_argument('--rotation', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # plane sweep homographies (D, 3, 3) of a rotated view, and one copy of the features per plane
+    cams = grid_cams(2, args.width, args.height, args.baseline, rotation=args.rotation)
+    homographies = get_homographies(tf.constant(cams[0:1]), tf.constant(cams[1:2]), args.depth_num,
+                                    tf.constant([args.depth_start]), tf.constant([args.depth_interval]))[0]
+    # a variable, the warps of constant features would be folded
+    features = tf.Variable(np.random.normal(
+        size=(1, args.height, args.width, args.channels)).astype(np.float32))
+    plane_features = tf.tile(features, [args.depth_num, 1, 1, 1])
+    coefficients = homography_transform_coefficients(homographies)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        homography_times = compare(
+            sess, 'homography_warping', homography_warping(plane_features, homographies),
+            homography_warping_legacy(plane_features, homographies), features, 1e-4, args.repeat)
+        transform_times = compare(
+            sess, 'transform_sampling', transform_sampling(plane_features, coefficients),
+            tf.contrib.image.transform(plane_features, coefficients, interpolation='BILINEAR'),
+            features, 1e-4, args.repeat, check_gradients=False)
+
+    print('%d x %d x %d features, %d planes, ms    forward  gradient' % (
+        args.width, args.height, args.channels, args.depth_num))
+    for label, times in [('homography_warping legacy', homography_times[0::2]),
+                         ('homography_warping', homography_times[1::2]),
+                         ('tf.contrib.image.transform', transform_times[0::2]),
+                         ('transform_sampling', transform_times[1::2])]:
+        print('    %-28s %9.3f %9.3f' % (label, times[0], times[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Equivalence of the NumPy homography transform coefficients of the data pipeline
+(homography_coefficients.py, --host_homographies) against the graph ops they replace
+(get_homographies or get_homographies_inv_depth, then get_transform_coefficients), for linear and
+inverse depth sweeps of rotated and translated views.
+"""
+
+from __future__ import print_function
+
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from homography_warping import *
+from homography_coefficients import *
+from benchmark_shift_warp import grid_cams
+
+
+def graph_coefficients(cams, depth_num, depth_start, depth_end, inverse_depth):
+    """ (V - 1, D, 8) coefficients of the (V, 2, 4, 4) cameras by the graph ops """
+    ref_cam = tf.constant(cams[0:1])
+    coefficients = []
+    for view in range(1, len(cams)):
+        view_cam = tf.constant(cams[view:view + 1])
+        if inverse_depth:
+            homographies = get_homographies_inv_depth(ref_cam, view_cam, depth_num,
+                                                      tf.constant([depth_start]), tf.constant([depth_end]))
+        else:
+            depth_interval = (depth_end - depth_start) / (depth_num - 1)
+            homographies = get_homographies(ref_cam, view_cam, depth_num,
+                                            tf.constant([depth_start]), tf.constant([depth_interval]))
+        coefficients.append(get_transform_coefficients(homographies)[0])
+    return tf.stack(coefficients, axis=0)
+
+def host_coefficients(cams, depth_num, depth_start, depth_end, inverse_depth):
+    if inverse_depth:
+        depth_values = inverse_depth_values(depth_start, depth_end, depth_num)
+    else:
+        depth_values = linear_depth_values(depth_start, (depth_end - depth_start) / (depth_num - 1), depth_num)
+    return view_transform_coefficients(cams, depth_values)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=160)
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--view_num', type=int, default=5)
+    parser.add_argument('--depth_num', type=int, default=128)
+    parser.add_argument('--depth_start', type=float, default=2.0)
+    parser.add_argument('--depth_end', type=float, default=8.0)
+    parser.add_argument('--baseline', type=float, default=0.3)
+    parser.add_argument('--rotation', type=float, default=0.1)
+    args = parser.parse_args()
+
+    # rotated views with a translation along the optical axis too
+    cams = grid_cams(args.view_num, args.width, args.height, args.baseline, rotation=args.rotation)
+    cams[1:, 0, 2, 3] = args.baseline * 0.5
+
+    for inverse_depth in [False, True]:
+        sweep = (args.depth_num, args.depth_start, args.depth_end, inverse_depth)
+        with tf.Graph().as_default():
+            coefficients = graph_coefficients(cams, *sweep)
+            with tf.Session() as sess:
+                graph_out = sess.run(coefficients)
+        host_out = host_coefficients(cams, *sweep)
+
+        # relative to the magnitude of each coefficient over the planes
+        scale = np.maximum(np.abs(graph_out).max(axis=1, keepdims=True), 1e-6)
+        max_diff = (np.abs(host_out - graph_out) / scale).max()
+        print('%s depth, %d views, %d planes: max relative diff = %g'
+              % ('inverse' if inverse_depth else 'linear', args.view_num - 1, args.depth_num, max_diff))
+        assert host_out.shape == graph_out.shape and max_diff < 1e-5
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Benchmark of the zero-copy PFM reader / writer (pfm.py) against load_pfm / write_pfm,
+on depth and probability maps of BlendedMVS size.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from preprocess import load_pfm
+from pfm import load_pfm_mmap, write_pfm_direct
+
+
+def write_pfm_legacy(path, image, scale=1):
+    """ local write_pfm before write_pfm_direct (flipud copy + tostring) """
+    image = np.flipud(image)
+    with open(path, 'wb') as pfm_file:
+        pfm_file.write(b'Pf\n')
+        pfm_file.write(('%d %d\n' % (image.shape[1], image.shape[0])).encode('UTF-8'))
+        pfm_file.write(('%f\n' % -scale).encode('UTF-8'))
+        pfm_file.write(image.tostring())
+
+def timeit(fn, repeat):
+    start_time = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start_time) / repeat * 1000.0
+
+def benchmark(name, image, folder, repeat):
+    path = os.path.join(folder, name + '.pfm')
+    direct_path = os.path.join(folder, name + '_direct.pfm')
+    write_pfm_legacy(path, image)
+    write_pfm_direct(direct_path, image)
+    assert open(path, 'rb').read() == open(direct_path, 'rb').read()
+    assert np.array_equal(load_pfm(open(path, 'rb')), load_pfm_mmap(path))
+
+    print('%s map (%d x %d, %.1f MB):' % (name, image.shape[1], image.shape[0], image.nbytes / (1024.0 * 1024.0)))
+    results = [
+        ('write_pfm', lambda: write_pfm_legacy(path, image)),
+        ('write_pfm_direct', lambda: write_pfm_direct(direct_path, image)),
+        ('load_pfm', lambda: load_pfm(open(path, 'rb'))),
+        ('load_pfm_mmap', lambda: load_pfm_mmap(path)),
+        # touch all values, as the preprocessing does
+        ('load_pfm + sum', lambda: load_pfm(open(path, 'rb')).sum()),
+        ('load_pfm_mmap + sum', lambda: load_pfm_mmap(path).sum())]
+    for label, fn in results:
+        print('    %-20s %8.3f ms' % (label, timeit(fn, repeat)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=768)
+    parser.add_argument('--height', type=int, default=576)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        depth_map = np.random.uniform(400, 900, (args.height, args.width)).astype(np.float32)
+        prob_map = np.random.uniform(0, 1, (args.height // 4, args.width // 4)).astype(np.float32)
+        benchmark('depth', depth_map, folder, args.repeat)
+        benchmark('prob', prob_map, folder, args.repeat)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
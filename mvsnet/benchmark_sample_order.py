@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Sample order of the --tf_data index dataset (data_pipeline.index_dataset) of one initialized iterator
+read ahead by a parallel map and a prefetch, as in train.py: consecutive epochs cover every index
+exactly once, the positions follow the sampler epochs and a sampler resumed from any position gives
+the same indices. Also times the python index generator.
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data_pipeline import index_dataset, AUTOTUNE
+from samplers import ShuffleSampler, SceneGroupedSampler
+
+
+def check(name, make, sample_num, epoch_num):
+    sampler = make()
+    # read ahead by the parallel map and the prefetch of the training pipeline
+    dataset = index_dataset(sample_num, sampler).map(lambda index, position: (index, position),
+                                                     num_parallel_calls=AUTOTUNE)
+    iterator = dataset.prefetch(buffer_size=AUTOTUNE).make_initializable_iterator()
+    next_sample = iterator.get_next()
+    with tf.Session() as sess:
+        sess.run(iterator.initializer)
+        start_time = time.time()
+        samples = [sess.run(next_sample) for _ in range(epoch_num * sample_num)]
+        duration = (time.time() - start_time) / len(samples) * 1000.0
+    indices = np.array([index for index, _ in samples])
+    positions = np.array([position for _, position in samples])
+
+    for epoch in range(epoch_num):
+        epoch_indices = indices[epoch * sample_num:(epoch + 1) * sample_num]
+        epoch_positions = positions[epoch * sample_num:(epoch + 1) * sample_num]
+        assert np.array_equal(np.sort(epoch_indices), np.arange(sample_num))
+        assert np.array_equal(epoch_positions[:, 0], np.full(sample_num, epoch))
+        assert np.array_equal(epoch_positions[:, 1], np.arange(1, sample_num + 1))
+
+    # a sampler resumed from each saved position continues with the same indices
+    for resumed in range(1, len(samples), max(len(samples) // 7, 1)):
+        resumed_sampler = make()
+        resumed_sampler.load_state({'seed': sampler.seed, 'epoch': int(positions[resumed - 1][0]),
+                                    'offset': int(positions[resumed - 1][1])})
+        assert np.array_equal(list(itertools.islice(resumed_sampler, len(samples) - resumed)), indices[resumed:])
+    print('%-20s %d epochs of %d samples covered once each, resumed order equal, %.3f ms/sample'
+          % (name, epoch_num, sample_num, duration))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sample_num', type=int, default=50)
+    parser.add_argument('--epoch_num', type=int, default=3)
+    parser.add_argument('--scene_num', type=int, default=7)
+    parser.add_argument('--scene_window', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=3)
+    args = parser.parse_args()
+
+    scene_ids = np.random.RandomState(0).randint(args.scene_num, size=args.sample_num)
+    check('ShuffleSampler', lambda: ShuffleSampler(args.sample_num, seed=args.seed),
+          args.sample_num, args.epoch_num)
+    check('SceneGroupedSampler', lambda: SceneGroupedSampler(scene_ids, args.scene_window, seed=args.seed),
+          args.sample_num, args.epoch_num)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Equivalence and speed of the shift warp of camera-grid rigs (tf_shift_batch) against the projective
+transform (tf_transform_homography), on random features and the cameras of
+mvsnet_wrapper/src/generate_cams_dir.py: identity rotation, shared intrinsics, X/Y translation.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from homography_warping import *
+
+
+def grid_cams(view_num, width, height, baseline, rotation=0.0):
+    """ (V, 2, 4, 4) cameras of a row of the grid, the views rotated by rotation radians around y """
+    cams = np.zeros((view_num, 2, 4, 4), np.float32)
+    for view in range(view_num):
+        cams[view, 0] = np.identity(4)
+        cams[view, 0, 0, 3] = baseline * ((view + 1) // 2) * (1 if view % 2 else -1)
+        cams[view, 0, 1, 3] = baseline * (view % 2)
+        if view > 0:
+            cams[view, 0, 0:3, 0:3] = [[np.cos(rotation), 0, np.sin(rotation)], [0, 1, 0],
+                                       [-np.sin(rotation), 0, np.cos(rotation)]]
+        cams[view, 1, 0:3, 0:3] = [[width, 0, width / 2.0], [0, width, height / 2.0], [0, 0, 1]]
+    return cams
+
+def timeit(sess, fetches, repeat):
+    sess.run(fetches)
+    start_time = time.time()
+    for _ in range(repeat):
+        sess.run(fetches)
+    return (time.time() - start_time) / repeat * 1000.0
+
+def benchmark(name, cams, features, args):
+    ref_cam = tf.constant(cams[0:1])
+    depth_start = tf.constant([args.depth_start])
+    depth_interval = tf.constant([args.depth_interval])
+    shifted_views = []
+    transformed_views = []
+    plane_views = []
+    translations = []
+    for view in range(1, len(cams)):
+        homographies = get_homographies(ref_cam, tf.constant(cams[view:view + 1]), args.depth_num,
+                                        depth_start, depth_interval)
+        coefficients = get_transform_coefficients(homographies)
+        translations.append(translation_offsets(coefficients, args.height, args.width)[1])
+        shifted_views.append(tf_shift_or_transform_batch(features, coefficients))
+        transformed_views.append(tf_transform_coefficients_batch(features, coefficients))
+        # reference: one tf_transform_homography per plane
+        plane_views.append(tf.stack([tf_transform_homography(features, homographies[:, depth])
+                                     for depth in range(args.depth_num)], axis=1))
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        out_translations, out_shifted, out_planes = sess.run([translations, shifted_views, plane_views])
+        max_diff = max(np.abs(shifted - planes).max() for shifted, planes in zip(out_shifted, out_planes))
+        print('%s rig, translations: %s, max diff against tf_transform_homography = %g'
+              % (name, all(out_translations), max_diff))
+        assert max_diff < 1e-3
+        print('    %-32s %9.3f ms' % ('tf_transform_coefficients_batch', timeit(sess, transformed_views, args.repeat)))
+        print('    %-32s %9.3f ms' % ('tf_shift_or_transform_batch', timeit(sess, shifted_views, args.repeat)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=160)
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--channels', type=int, default=32)
+    parser.add_argument('--view_num', type=int, default=3)
+    parser.add_argument('--depth_num', type=int, default=64)
+    parser.add_argument('--depth_start', type=float, default=2.0)
+    parser.add_argument('--depth_interval', type=float, default=0.05)
+    parser.add_argument('--baseline', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # a variable, the warps of constant features would be folded
+    features = tf.Variable(np.random.normal(
+        size=(1, args.height, args.width, args.channels)).astype(np.float32))
+    benchmark('camera-grid', grid_cams(args.view_num, args.width, args.height, args.baseline),
+              features, args)
+    # rotated views fall back to the projective transform
+    benchmark('rotated', grid_cams(args.view_num, args.width, args.height, args.baseline, rotation=0.05),
+              features, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Equivalence and CPU speed of the warps restricted to the visible boxes of the depth planes
+(tf_transform_boxes_batch) against the full image warps (tf_transform_coefficients_batch), on random
+features and the plane sweep homographies of a wide baseline, rotated view whose near planes are
+partly or entirely out of the reference image.
+"""
+
+from __future__ import print_function
+
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from homography_warping import *
+from benchmark_shift_warp import grid_cams
+from benchmark_bilinear_sampler import compare
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=160)
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--channels', type=int, default=32)
+    parser.add_argument('--depth_num', type=int, default=48)
+    parser.add_argument('--depth_start', type=float, default=0.5)
+    parser.add_argument('--depth_interval', type=float, default=0.1)
+    parser.add_argument('--baseline', type=float, default=0.5)
+    parser.add_argument('--rotation', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # (1, D, 8) coefficients of the plane sweep of a rotated view and their visible boxes
+    cams = grid_cams(2, args.width, args.height, args.baseline, rotation=args.rotation)
+    homographies = get_homographies(tf.constant(cams[0:1]), tf.constant(cams[1:2]), args.depth_num,
+                                    tf.constant([args.depth_start]), tf.constant([args.depth_interval]))
+    coefficients = get_transform_coefficients(homographies)
+    boxes = visible_boxes(coefficients, args.height, args.width)
+    # a variable, the warps of constant features would be folded
+    features = tf.Variable(np.random.normal(
+        size=(1, args.height, args.width, args.channels)).astype(np.float32))
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        # every non-zero output of the full warp lies in the boxes
+        full_warps, masks = sess.run([tf_transform_coefficients_batch(features + 10.0, coefficients),
+                                      box_masks(boxes, args.height, args.width)])
+        outside = np.logical_and(np.abs(full_warps).max(axis=-1, keepdims=True) > 0, masks == 0).sum()
+        print('visible box area: %.1f%% of the planes, non-zero warps out of the boxes: %d'
+              % (masks.mean() * 100.0, outside))
+        assert outside == 0
+        times = compare(sess, 'tf_transform_boxes_batch', tf_transform_boxes_batch(features, coefficients, boxes),
+                        tf_transform_coefficients_batch(features, coefficients), features, 1e-4, args.repeat)
+
+    print('%d x %d x %d features, %d planes, ms    forward  gradient' % (
+        args.width, args.height, args.channels, args.depth_num))
+    for label, label_times in [('tf_transform_coefficients_batch', times[0::2]),
+                               ('tf_transform_boxes_batch', times[1::2])]:
+        print('    %-32s %9.3f %9.3f' % (label, label_times[0], label_times[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Per depth iteration time of the GRU winner-take-all sweep (inference_winner_take_all) against
+the loop it replaced, on random images and weights. The time of one iteration is the slope of
+the run time between --depth_num and two planes, so that the feature extraction cancels out.
+"""
+
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from model import *
+
+tf.app.flags.DEFINE_integer('view_num', 3,
+                            """Number of images (1 ref image and view_num - 1 view images).""")
+tf.app.flags.DEFINE_integer('batch_size', 1,
+                            """Number of samples in a batch.""")
+tf.app.flags.DEFINE_integer('max_h', 512,
+                            """Image height.""")
+tf.app.flags.DEFINE_integer('max_w', 640,
+                            """Image width.""")
+tf.app.flags.DEFINE_integer('depth_num', 64,
+                            """Number of depth planes of the sweep.""")
+tf.app.flags.DEFINE_integer('repeat', 5,
+                            """Number of timed runs.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def inference_winner_take_all_legacy(images, cams, depth_num, depth_start, depth_end):
+    """ local winner-take-all loop before winner_take_all_sweep (linear depth, variance cost) """
+
+    depth_interval = (depth_end - depth_start) / (tf.cast(depth_num, tf.float32) - 1)
+
+    # reference image
+    ref_image = tf.squeeze(tf.slice(images, [0, 0, 0, 0, 0], [-1, 1, -1, -1, 3]), axis=1)
+    ref_cam = tf.squeeze(tf.slice(cams, [0, 0, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
+
+    # image feature extraction
+    ref_tower = UNetDS2GN({'data': ref_image}, is_training=True, reuse=True)
+    view_towers = []
+    for view in range(1, FLAGS.view_num):
+        view_image = tf.squeeze(tf.slice(images, [0, view, 0, 0, 0], [-1, 1, -1, -1, -1]), axis=1)
+        view_tower = UNetDS2GN({'data': view_image}, is_training=True, reuse=True)
+        view_towers.append(view_tower)
+
+    # get all homographies
+    view_homographies = []
+    for view in range(1, FLAGS.view_num):
+        view_cam = tf.squeeze(tf.slice(cams, [0, view, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
+        homographies = get_homographies(ref_cam, view_cam, depth_num=depth_num,
+                                        depth_start=depth_start, depth_interval=depth_interval)
+        view_homographies.append(homographies)
+
+    # gru unit
+    gru1_filters = 16
+    gru2_filters = 4
+    gru3_filters = 2
+    feature_shape = [FLAGS.batch_size, FLAGS.max_h/4, FLAGS.max_w/4, 32]
+    gru_input_shape = [feature_shape[1], feature_shape[2]]
+    state1 = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], gru1_filters])
+    state2 = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], gru2_filters])
+    state3 = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], gru3_filters])
+    conv_gru1 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru1_filters)
+    conv_gru2 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru2_filters)
+    conv_gru3 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru3_filters)
+
+    # initialize variables
+    exp_sum = tf.Variable(tf.zeros(
+        [FLAGS.batch_size, feature_shape[1], feature_shape[2], 1]),
+        name='exp_sum', trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    depth_image = tf.Variable(tf.zeros(
+        [FLAGS.batch_size, feature_shape[1], feature_shape[2], 1]),
+        name='depth_image', trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    max_prob_image = tf.Variable(tf.zeros(
+        [FLAGS.batch_size, feature_shape[1], feature_shape[2], 1]),
+        name='max_prob_image', trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    init_map = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], 1])
+
+    def body(depth_index, state1, state2, state3, depth_image, max_prob_image, exp_sum, incre):
+        """Loop body."""
+
+        # calculate cost
+        warped_view_features = []
+        for view in range(0, FLAGS.view_num - 1):
+            homographies = view_homographies[view]
+            homographies = tf.transpose(homographies, perm=[1, 0, 2, 3])
+            homography = homographies[depth_index]
+            warped_view_feature = tf_transform_homography(view_towers[view].get_output(), homography)
+            warped_view_feature.set_shape(ref_tower.get_output().get_shape())
+            warped_view_features.append(warped_view_feature)
+        cost = matching_cost(ref_tower.get_output(), warped_view_features)
+        cost.set_shape([FLAGS.batch_size, feature_shape[1], feature_shape[2], 32])
+
+        # gru
+        reg_cost1, state1 = conv_gru1(-cost, state1, scope='conv_gru1')
+        reg_cost2, state2 = conv_gru2(reg_cost1, state2, scope='conv_gru2')
+        reg_cost3, state3 = conv_gru3(reg_cost2, state3, scope='conv_gru3')
+        reg_cost = tf.layers.conv2d(
+            reg_cost3, 1, 3, padding='same', reuse=tf.AUTO_REUSE, name='prob_conv')
+        prob = tf.exp(reg_cost)
+
+        # index
+        d_idx = tf.cast(depth_index, tf.float32)
+        depth = depth_start + d_idx * depth_interval
+        temp_depth_image = tf.reshape(depth, [FLAGS.batch_size, 1, 1, 1])
+        temp_depth_image = tf.tile(
+            temp_depth_image, [1, feature_shape[1], feature_shape[2], 1])
+
+        # update the best
+        update_flag_image = tf.cast(tf.less(max_prob_image, prob), dtype='float32')
+        new_max_prob_image = update_flag_image * prob + (1 - update_flag_image) * max_prob_image
+        new_depth_image = update_flag_image * temp_depth_image + (1 - update_flag_image) * depth_image
+        max_prob_image = tf.assign(max_prob_image, new_max_prob_image)
+        depth_image = tf.assign(depth_image, new_depth_image)
+
+        # update counter
+        exp_sum = tf.assign_add(exp_sum, prob)
+        depth_index = tf.add(depth_index, incre)
+
+        return depth_index, state1, state2, state3, depth_image, max_prob_image, exp_sum, incre
+
+    # run forward loop
+    exp_sum = tf.assign(exp_sum, init_map)
+    depth_image = tf.assign(depth_image, init_map)
+    max_prob_image = tf.assign(max_prob_image, init_map)
+    depth_index = tf.constant(0)
+    incre = tf.constant(1)
+    cond = lambda depth_index, *_: tf.less(depth_index, depth_num)
+    _, state1, state2, state3, depth_image, max_prob_image, exp_sum, incre = tf.while_loop(
+        cond, body
+        , [depth_index, state1, state2, state3, depth_image, max_prob_image, exp_sum, incre]
+        , back_prop=False, parallel_iterations=1)
+
+    return depth_image, max_prob_image / (exp_sum + 1e-7)
+
+def timeit(sess, fetches, feed_dict, repeat):
+    sess.run(fetches, feed_dict=feed_dict)
+    start_time = time.time()
+    for _ in range(repeat):
+        sess.run(fetches, feed_dict=feed_dict)
+    return (time.time() - start_time) / repeat * 1000.0
+
+def main(argv=None):
+    """ program entrance """
+    # fronto-parallel cameras with a small baseline, at feature scale
+    intrinsic = np.array([[FLAGS.max_w / 8.0, 0, FLAGS.max_w / 8.0], [0, FLAGS.max_w / 8.0, FLAGS.max_h / 8.0],
+                          [0, 0, 1]], np.float32)
+    sample_cams = np.zeros((FLAGS.batch_size, FLAGS.view_num, 2, 4, 4), np.float32)
+    for view in range(FLAGS.view_num):
+        sample_cams[:, view, 0] = np.eye(4)
+        sample_cams[:, view, 0, 0, 3] = 0.05 * view
+        sample_cams[:, view, 1, :3, :3] = intrinsic
+    sample_images = np.random.normal(
+        size=(FLAGS.batch_size, FLAGS.view_num, FLAGS.max_h, FLAGS.max_w, 3)).astype(np.float32)
+
+    images = tf.constant(sample_images)
+    cams = tf.constant(sample_cams)
+    depth_num = tf.placeholder(tf.int32, [])
+    depth_start = tf.constant([1.0] * FLAGS.batch_size)
+    depth_end = tf.constant([4.0] * FLAGS.batch_size)
+    outputs = inference_winner_take_all(images, cams, depth_num, depth_start, depth_end)
+    legacy_outputs = inference_winner_take_all_legacy(images, cams, depth_num, depth_start, depth_end)
+
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        feed_dict = {depth_num: FLAGS.depth_num}
+        (depth_map, prob_map), (legacy_depth_map, legacy_prob_map) = sess.run(
+            [outputs, legacy_outputs], feed_dict=feed_dict)
+        print('%d x %d, %d views, %d planes: depth diff = %g, prob diff = %g'
+              % (FLAGS.max_w, FLAGS.max_h, FLAGS.view_num, FLAGS.depth_num,
+                 np.abs(depth_map - legacy_depth_map).max(), np.abs(prob_map - legacy_prob_map).max()))
+
+        for label, fetches in [('legacy loop', legacy_outputs), ('winner_take_all_sweep', outputs)]:
+            full_time = timeit(sess, fetches, {depth_num: FLAGS.depth_num}, FLAGS.repeat)
+            two_plane_time = timeit(sess, fetches, {depth_num: 2}, FLAGS.repeat)
+            print('    %-22s %9.3f ms / run %8.3f ms / iteration'
+                  % (label, full_time, (full_time - two_plane_time) / (FLAGS.depth_num - 2)))
+
+
+if __name__ == '__main__':
+    tf.app.run()
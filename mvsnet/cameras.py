@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+"""
+Camera tensor helpers shared by the model and the input pipelines: a camera is a (2, 4, 4) array,
+the extrinsic matrix then the intrinsic matrix with the depth range in its last row.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+# intrinsic entries scaled with the image (focal lengths and principal point)
+_CAM_SCALE_MASK = np.zeros((2, 4, 4))
+_CAM_SCALE_MASK[1, 0, 0] = _CAM_SCALE_MASK[1, 1, 1] = _CAM_SCALE_MASK[1, 0, 2] = _CAM_SCALE_MASK[1, 1, 2] = 1
+
+def tf_scale_cams(cams, scale=1):
+    """ scale the intrinsics of one (2 x 4 x 4) or several (V x 2 x 4 x 4) cameras """
+    return cams * (1 + (scale - 1) * tf.constant(_CAM_SCALE_MASK, cams.dtype))
+
+def tf_set_cam_entry(cams, entry, value):
+    """ cameras with the (i, j, k) entry of each camera set to value (a scalar or one value per camera) """
+    mask = np.zeros((2, 4, 4))
+    mask[entry] = 1
+    mask = tf.constant(mask, cams.dtype)
+    value = tf.cast(value, cams.dtype)
+    value = tf.reshape(value, tf.concat([tf.shape(value), [1, 1, 1]], axis=0))
+    return cams * (1 - mask) + value * mask
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Accuracy of the low precision 3DCNNs cost volume and regularization (--cost_dtype float16 or
+bfloat16) against float32, on the first --compare_num samples of the validation set. The flags
+are those of validate.py, both networks share the restored variables.
+"""
+
+from __future__ import print_function
+
+import itertools
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from validate import *
+
+tf.app.flags.DEFINE_integer('compare_num', 20,
+                            """Number of validation samples to compare.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def compare_precision(mvs_list):
+    """ depth maps of the float32 and FLAGS.cost_dtype networks on the same samples """
+    if FLAGS.regularization != '3DCNNs' or FLAGS.cost_dtype == 'float32':
+        raise Exception('Compare 3DCNNs with --cost_dtype float16 or bfloat16.')
+    if FLAGS.batch_size != 1:
+        raise Exception('The samples are compared one at a time (--batch_size 1).')
+
+    images = tf.placeholder(tf.float32, [1, FLAGS.view_num, None, None, 3])
+    cams = tf.placeholder(tf.float32, [1, FLAGS.view_num, 2, 4, 4])
+    depth_image = tf.placeholder(tf.float32, [1, None, None, 1])
+    # homography transform coefficients of the generator with --host_homographies
+    view_coefficients = None
+    if FLAGS.host_homographies:
+        view_coefficients = tf.placeholder(tf.float32, [1, FLAGS.view_num - 1, None, 8])
+    depth_start = tf.reshape(tf.slice(cams, [0, 0, 1, 3, 0], [1, 1, 1, 1, 1]), [1])
+    depth_interval = tf.reshape(tf.slice(cams, [0, 0, 1, 3, 1], [1, 1, 1, 1, 1]), [1])
+
+    # image normalization
+    normalized_images = []
+    for view in range(0, FLAGS.view_num):
+        image = tf.squeeze(tf.slice(images, [0, view, 0, 0, 0], [-1, 1, -1, -1, 3]), axis=1)
+        normalized_images.append(tf.image.per_image_standardization(image))
+    normalized_images = tf.stack(normalized_images, axis=1)
+
+    # the same network in both precisions
+    outputs = []
+    for cost_dtype in ['float32', FLAGS.cost_dtype]:
+        depth_map, prob_map = inference(
+            normalized_images, cams, FLAGS.max_d, depth_start, depth_interval,
+            is_master_gpu=not outputs, depth_chunk=FLAGS.depth_chunk, cost_metric=FLAGS.cost_metric,
+            group_num=FLAGS.correlation_groups, cost_dtype=cost_dtype, view_coefficients=view_coefficients)
+        loss, less_one, less_three = mvsnet_regression_loss(depth_map, depth_image, depth_interval)
+        outputs.append([depth_map, prob_map, loss, less_one, less_three])
+
+    # difference of the depth maps in depth intervals
+    depth_diff = tf.abs(outputs[1][0] - outputs[0][0]) / tf.reshape(depth_interval, [1, 1, 1, 1])
+    diff_ops = [tf.reduce_mean(depth_diff), tf.reduce_mean(tf.cast(depth_diff > 1, tf.float32)),
+                tf.reduce_mean(tf.abs(outputs[1][1] - outputs[0][1]))]
+
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    results = []
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        if FLAGS.pretrained_model_ckpt_path is not None:
+            ckpt_path = '-'.join([FLAGS.pretrained_model_ckpt_path, str(FLAGS.ckpt_step)])
+            tf.train.Saver(tf.global_variables()).restore(sess, ckpt_path)
+            print(Notify.INFO, 'Pre-trained model restored from %s' % ckpt_path, Notify.ENDC)
+
+        samples = itertools.islice(iter(MVSGenerator(mvs_list, FLAGS.view_num)), FLAGS.compare_num)
+        for step, sample in enumerate(samples):
+            feed_dict = {images: sample[0][np.newaxis], cams: sample[1][np.newaxis],
+                         depth_image: sample[2][np.newaxis]}
+            if view_coefficients is not None:
+                feed_dict[view_coefficients] = sample[3][np.newaxis]
+            start_time = time.time()
+            out_float32, out_low, out_diff = sess.run(
+                [outputs[0][2:], outputs[1][2:], diff_ops], feed_dict=feed_dict)
+            results.append(out_float32 + out_low + out_diff)
+            print(Notify.INFO, 'sample %d, float32 < 1 = %.3f, < 3 = %.3f, %s < 1 = %.3f, < 3 = %.3f, '
+                  'depth diff = %.4f intervals (%.4f > 1), prob diff = %.4f. (%.3f sec)'
+                  % (step, out_float32[1], out_float32[2], FLAGS.cost_dtype, out_low[1], out_low[2],
+                     out_diff[0], out_diff[1], out_diff[2], time.time() - start_time), Notify.ENDC)
+
+    results = np.mean(results, axis=0)
+    print('float32: loss = %f, < 1 = %f, < 3 = %f' % tuple(results[0:3]))
+    print('%s: loss = %f, < 1 = %f, < 3 = %f' % ((FLAGS.cost_dtype,) + tuple(results[3:6])))
+    print('mean depth diff = %f intervals, > 1 interval = %f, mean prob diff = %f' % tuple(results[6:9]))
+
+def main(argv=None):
+    """ program entrance """
+    image_cache.configure(FLAGS.image_cache_mb * 1024 * 1024, FLAGS.image_cache_report)
+    compare_precision(gen_validation_list())
+
+if __name__ == '__main__':
+    tf.app.run()
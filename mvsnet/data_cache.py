@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Process-wide caches of decoded sample data shared by the MVS data generators.
+"""
+
+from __future__ import print_function
+
+import collections
+import os
+
+from tensorflow.python.lib.io import file_io
+
+from preprocess import load_cam
+
+
+class CamCache:
+    """ parsed cameras keyed by path and interval scale, cached arrays are read-only """
+    def __init__(self):
+        self.cams = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path, interval_scale=1):
+        # cameras without depth number take FLAGS.max_d, which is fixed in a process
+        key = (path, interval_scale)
+        cam = self.cams.get(key)
+        if cam is not None:
+            self.hits += 1
+            return cam
+        self.misses += 1
+        cam = load_cam(file_io.FileIO(path, mode='r'), interval_scale)
+        # callers modifying a camera in place must copy it first (see writable_cam)
+        cam.flags.writeable = False
+        self.cams[key] = cam
+        return cam
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cams)}
+
+    def clear(self):
+        self.cams.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+cam_cache = CamCache()
+
+def load_cam_cached(path, interval_scale=1):
+    """ load_cam through the process-wide camera cache """
+    return cam_cache.load(path, interval_scale)
+
+
+class ImageCache:
+    """ LRU cache of decoded images bounded by a memory budget in bytes, cached images are read-only """
+    def __init__(self, max_bytes=0, report_interval=0):
+        self.images = collections.OrderedDict()
+        self.configure(max_bytes, report_interval)
+
+    def configure(self, max_bytes, report_interval=0):
+        """ max_bytes = 0 disables the cache, stats are printed every report_interval lookups """
+        self.max_bytes = max_bytes
+        self.report_interval = report_interval
+        self.clear()
+
+    def load(self, path, decode_fn):
+        """ decode_fn(path) result, the decode function is part of the key """
+        if self.max_bytes <= 0:
+            return decode_fn(path)
+
+        key = (path, decode_fn)
+        image = self.images.pop(key, None)
+        if image is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            image = decode_fn(path)
+            if image is None or image.nbytes > self.max_bytes:
+                return image
+            image.flags.writeable = False
+            self.bytes += image.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+        self.images[key] = image
+
+        if self.report_interval > 0 and (self.hits + self.misses) % self.report_interval == 0:
+            print(self.report())
+        return image
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0.0
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self.images), 'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+    def report(self):
+        return ('Image cache (pid %d): hit rate = %.3f, %d images (%.1f / %.1f MB), %d evictions.'
+                % (os.getpid(), self.hit_rate(), len(self.images), self.bytes / (1024.0 * 1024.0),
+                   self.max_bytes / (1024.0 * 1024.0), self.evictions))
+
+    def clear(self):
+        self.images.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+# disabled until configured by the generators (--image_cache_mb), one cache per worker process
+image_cache = ImageCache()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Native tf.data input pipeline, an alternative to the python MVSGenerator classes.
+
+The samples are a dataset of indices (in the sampler order) mapped in parallel to the
+decoded tensors: the images and cameras are read with tensorflow ops, only the depth maps
+(pfm or packed disparity png) go through tf.py_function. The dataset specified processing
+of each script is written with the tf_* functions below, which follow preprocess.py.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import preprocess
+from pfm import load_pfm_mmap
+from sample_index import SampleIndex
+from shards import ShardSample
+from cameras import tf_scale_cams, tf_set_cam_entry
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def sample_tables(sample_list):
+    """ (paths, samples): the distinct paths and the path ids of each sample """
+    if isinstance(sample_list, SampleIndex):
+        paths = [sample_list.path(path_id) for path_id in range(len(sample_list.path_offsets) - 1)]
+        return np.array(paths, dtype=object), np.asarray(sample_list.samples)
+    if sample_list and isinstance(sample_list[0], ShardSample):
+        raise Exception('Packed shards are read by the python generator, not by the tf.data pipeline.')
+    path_ids = {}
+    samples = np.empty((len(sample_list), len(sample_list[0])), dtype=np.int32)
+    for sample_id, sample in enumerate(sample_list):
+        for column, path in enumerate(sample):
+            samples[sample_id, column] = path_ids.setdefault(path, len(path_ids))
+    paths = np.empty(len(path_ids), dtype=object)
+    for path, path_id in path_ids.items():
+        paths[path_id] = path
+    return paths, samples
+
+def index_dataset(sample_num, sampler=None):
+    """ endless dataset of (sample index, sampler position after the sample); its iterator is initialized
+        once, the generator shares the stateful sampler and a new one would continue after the indices
+        already read ahead by the parallel map and the prefetch """
+    if sampler is None:
+        return tf.data.Dataset.range(sample_num).repeat().map(
+            lambda index: (index, tf.zeros([2], dtype=tf.int64)))
+
+    def iter_indices():
+        for index in sampler:
+            yield index, (sampler.epoch, sampler.offset)
+    # only the indices come from python, the samples are read by the parallel map
+    return tf.data.Dataset.from_generator(
+        iter_indices, (tf.int64, tf.int64), (tf.TensorShape([]), tf.TensorShape([2])))
+
+def mvs_dataset(sample_list, load_fn, sampler=None, num_parallel_calls=AUTOTUNE):
+    """ dataset of load_fn(paths, position) for each sample, paths being a string vector """
+    paths, samples = sample_tables(sample_list)
+    path_table = tf.constant(paths, dtype=tf.string)
+    sample_table = tf.constant(samples)
+
+    def load(index, position):
+        return load_fn(tf.gather(path_table, tf.gather(sample_table, index)), position)
+    return index_dataset(len(sample_list), sampler).map(load, num_parallel_calls=num_parallel_calls)
+
+
+def tf_read_image(path):
+    """ decode an image as BGR, like cv2.imread """
+    contents = tf.io.read_file(path)
+    # cv2 decodes jpegs with the accurate integer dct
+    image = tf.cond(tf.image.is_jpeg(contents),
+                    lambda: tf.image.decode_jpeg(contents, channels=3, dct_method='INTEGER_ACCURATE'),
+                    lambda: tf.image.decode_image(contents, channels=3, expand_animations=False))
+    return tf.reverse(image, axis=[-1])
+
+def tf_read_cam(path, interval_scale=1, max_d=192):
+    """ parse a camera txt file like preprocess.load_cam, max_d is the default depth number """
+    words = tf.strings.split([tf.io.read_file(path)]).values
+    word_num = tf.size(words)
+    extrinsic = tf.reshape(tf.strings.to_number(words[1:17], tf.float64), [4, 4])
+    intrinsic = tf.reshape(tf.strings.to_number(words[18:27], tf.float64), [3, 3])
+
+    # depth min, interval, number and max of the 29, 30 and 31 words formats
+    depth_words = tf.strings.to_number(tf.concat([words, tf.fill([4], '0')], axis=0)[27:31], tf.float64)
+    depth_min = depth_words[0]
+    depth_interval = depth_words[1] * interval_scale
+    depth_num = tf.where(tf.equal(word_num, 29), tf.constant(max_d, tf.float64), depth_words[2])
+    depth_max = tf.where(tf.equal(word_num, 31), depth_words[3], depth_min + depth_interval * depth_num)
+    depth_row = tf.stack([depth_min, depth_interval, depth_num, depth_max])
+    depth_row = tf.where(tf.logical_and(word_num >= 29, word_num <= 31), depth_row, tf.zeros_like(depth_row))
+
+    intrinsic = tf.concat([tf.pad(intrinsic, [[0, 0], [0, 1]]), tf.expand_dims(depth_row, 0)], axis=0)
+    return tf.stack([extrinsic, intrinsic])
+
+def _read_depth_file(path):
+    path = path.numpy()
+    if not isinstance(path, str):
+        path = path.decode('utf-8')
+    if preprocess.revery_opts.read_png_depth:
+        depth_image = preprocess.load_depth_packed_png(path)
+    else:
+        depth_image = load_pfm_mmap(path)
+    return np.array(depth_image, dtype=np.float32)
+
+def tf_read_depth(path):
+    """ read a pfm or packed png depth map (REVERY_READ_PNG_DEPTH) in python """
+    depth_image = tf.py_function(_read_depth_file, [path], tf.float32)
+    depth_image.set_shape([None, None])
+    return depth_image
+
+def _image_size_axes(image):
+    # height and width axes of an H x W, H x W x C or V x H x W x C image
+    return [0, 1] if image.shape.ndims == 2 else [image.shape.ndims - 3, image.shape.ndims - 2]
+
+def tf_resize_image(image, size, interpolation='linear'):
+    """ resize an H x W, H x W x C or V x H x W x C image like cv2.resize """
+    ndims = image.shape.ndims
+    images = image
+    if ndims == 2:
+        images = tf.expand_dims(images, -1)
+    if ndims <= 3:
+        images = tf.expand_dims(images, 0)
+    if interpolation == 'nearest':
+        # cv2 samples the pixel floor(x * scale)
+        images = tf.compat.v1.image.resize_nearest_neighbor(images, size)
+    elif interpolation == 'cubic':
+        images = tf.compat.v1.image.resize_bicubic(images, size, half_pixel_centers=True)
+    elif interpolation == 'area':
+        images = tf.compat.v1.image.resize_area(images, size)
+    else:
+        images = tf.compat.v1.image.resize_bilinear(images, size, half_pixel_centers=True)
+    if not image.dtype.is_floating and interpolation != 'nearest':
+        # cv2 rounds the interpolated integer images
+        images = tf.round(images)
+    images = tf.saturate_cast(images, image.dtype)
+    if ndims == 2:
+        return images[0, :, :, 0]
+    return images[0] if ndims == 3 else images
+
+def tf_scale_image(image, scale=1, interpolation='linear'):
+    """ resize an image by scale like preprocess.scale_image """
+    image_size = tf.gather(tf.shape(image), _image_size_axes(image))
+    size = tf.cast(tf.round(tf.cast(image_size, tf.float64) * scale), tf.int32)
+    return tf_resize_image(image, size, interpolation)
+
+def tf_revery_preprocess_images(image):
+    """ resize to REVERY_IMAGE_WIDTH/HEIGHT like preprocess.revery_preprocess_images """
+    w = preprocess.revery_opts.image_width
+    h = preprocess.revery_opts.image_height
+    if w is None or h is None:
+        return image
+    # images of a resized copy are already at the size
+    return tf.cond(tf.reduce_all(tf.equal(tf.shape(image)[0:2], [h, w])), lambda: image,
+                   lambda: tf_resize_image(image, [h, w], preprocess.revery_opts.image_interpolation))
+
+def tf_crop_mvs_input(images, cams, new_h, new_w, depth_image=None):
+    """ center crop of the V x H x W x 3 images (and the reference depth map) to new_h x new_w """
+    image_shape = tf.shape(images)
+    start_h = (image_shape[1] - new_h) // 2
+    start_w = (image_shape[2] - new_w) // 2
+    images = images[:, start_h:start_h + new_h, start_w:start_w + new_w]
+    offset = tf.scatter_nd([[1, 0, 2], [1, 1, 2]], tf.cast(tf.stack([start_w, start_h]), cams.dtype), [2, 4, 4])
+    cams = cams - offset
+    if depth_image is None:
+        return images, cams
+    return images, cams, depth_image[start_h:start_h + new_h, start_w:start_w + new_w]
+
+def tf_mask_depth_image(depth_image, min_depth, max_depth):
+    """ mask out-of-range pixels to zero, like preprocess.mask_depth_image """
+    depth_image = tf.cast(depth_image, tf.float32)
+    min_depth = tf.cast(min_depth, tf.float32)
+    max_depth = tf.cast(max_depth, tf.float32)
+    in_range = tf.logical_and(depth_image > min_depth, depth_image <= max_depth)
+    depth_image = tf.where(in_range, depth_image, tf.zeros_like(depth_image))
+    return tf.expand_dims(depth_image, -1)
+
+def tf_center_images(images):
+    """ normalize each V x H x W x 3 image like preprocess.center_image """
+    images = tf.cast(images, tf.float32)
+    mean, var = tf.nn.moments(images, axes=[1, 2], keep_dims=True)
+    return (images - mean) / (tf.sqrt(var) + 0.00000001)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+NumPy version of get_homographies and homography_transform_coefficients: the plane sweep
+homographies of all the views and depth planes of a sample and their tf.contrib.image.transform
+coefficients, computed in the data pipeline and fed to the model instead of the graph ops.
+"""
+
+import numpy as np
+
+# image coordinate of the pixel (0, 0), tf.contrib.image.transform works in pixel coordinates
+PIXEL_TO_IMAGE = np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+
+
+def linear_depth_values(depth_start, depth_interval, depth_num):
+    """ depths of the depth_num planes from depth_start every depth_interval """
+    return depth_start + np.arange(depth_num) * depth_interval
+
+def inverse_depth_values(depth_start, depth_end, depth_num):
+    """ depths of the depth_num planes regularly spaced in inverse depth from depth_start to depth_end """
+    return 1.0 / np.linspace(1.0 / depth_start, 1.0 / depth_end, depth_num)
+
+def plane_homographies(ref_cam, view_cams, depth_values):
+    """ homographies (V, D, 3, 3) from the reference image to the (V, 2, 4, 4) view cameras of the
+        fronto-parallel planes of the reference camera at the (D,) depth_values """
+    ref_cam = np.asarray(ref_cam, np.float64)
+    view_cams = np.asarray(view_cams, np.float64)
+    depth_values = np.asarray(depth_values, np.float64)
+
+    # cameras (K, R, t)
+    R_ref = ref_cam[0, 0:3, 0:3]
+    t_ref = ref_cam[0, 0:3, 3]
+    K_ref = ref_cam[1, 0:3, 0:3]
+    R_view = view_cams[:, 0, 0:3, 0:3]
+    t_view = view_cams[:, 0, 0:3, 3]
+    K_view = view_cams[:, 1, 0:3, 0:3]
+
+    # camera centers and the normal of the planes
+    c_ref = -np.dot(R_ref.T, t_ref)
+    c_view = -np.einsum('vji,vj->vi', R_view, t_view)
+    c_relative = c_view - c_ref                                                 # (V, 3)
+    fronto_direction = R_ref[2]                                                 # (3,)
+
+    # K_view R_view (I - c_relative n^T / d) R_ref^T K_ref^-1
+    temp_vec = c_relative[:, :, np.newaxis] * fronto_direction                  # (V, 3, 3)
+    middle_mat0 = np.eye(3) - temp_vec[:, np.newaxis] / depth_values[:, np.newaxis, np.newaxis]
+    middle_mat1 = np.dot(R_ref.T, np.linalg.inv(K_ref))
+    return np.matmul(np.matmul(K_view, R_view)[:, np.newaxis], np.matmul(middle_mat0, middle_mat1))
+
+def transform_coefficients(homographies):
+    """ 8 tf.contrib.image.transform coefficients (..., 8) of the (..., 3, 3) homographies """
+    pixel_homographies = np.matmul(np.matmul(np.linalg.inv(PIXEL_TO_IMAGE), homographies), PIXEL_TO_IMAGE)
+    pixel_homographies = pixel_homographies.reshape(pixel_homographies.shape[:-2] + (9,))
+    return pixel_homographies[..., 0:8] / pixel_homographies[..., 8:9]
+
+def view_transform_coefficients(cams, depth_values):
+    """ transform coefficients (V - 1, D, 8) of the homographies from the reference view to the other
+        views of the (V, 2, 4, 4) sample cameras, for the (D,) depth_values """
+    return transform_coefficients(plane_homographies(cams[0], cams[1:], depth_values)).astype(np.float32)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Dataset-wide table of the homography transform coefficients of a fixed camera rig: every scene of
+gen_revery_path shares the cameras and pair.txt of one cams_dir, so the coefficients of a
+(ref id, src id, depth setup) are computed once, stored on disk and looked up by the data pipelines.
+"""
+
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+from data_cache import load_cam_cached
+from homography_coefficients import view_transform_coefficients
+
+
+def cam_id(cam_path):
+    """ image id of a '%08d_cam.txt' camera file """
+    return int(os.path.basename(cam_path).split('_')[0])
+
+def rig_samples(cams_dir, view_num):
+    """ (ref id, src ids) of the samples of gen_revery_path, from the pair.txt of cams_dir """
+    cluster_lines = open(os.path.join(cams_dir, 'pair.txt')).read().splitlines()
+    samples = []
+    for idx in range(int(cluster_lines[0])):
+        ref_id = int(cluster_lines[2 * idx + 1])
+        cluster_info = cluster_lines[2 * idx + 2].split()
+        if int(cluster_info[0]) < view_num - 1:
+            continue
+        samples.append((ref_id, [int(cluster_info[2 * view + 1]) for view in range(view_num - 1)]))
+    return samples
+
+
+class HomographyTable:
+    """ (D, 8) transform coefficients of the homographies from a reference to a source view, keyed by
+        (ref id, src id, depth setup) where the depth setup is the first, second and last depth
+        planes and their number; the intrinsics of both (processed) cameras are part of the key so that
+        an entry built at another image scale or crop is never returned. The extrinsics are not: a table
+        belongs to the cameras of one cams_dir """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.modified = False
+        if path is not None and os.path.isfile(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(ref_id, src_id, ref_cam, src_cam, depth_values):
+        depth_setup = (depth_values[0], depth_values[min(1, len(depth_values) - 1)], depth_values[-1],
+                       len(depth_values))
+        intrinsics = (ref_cam[1, 0, 0], ref_cam[1, 1, 1], ref_cam[1, 0, 2], ref_cam[1, 1, 2],
+                      src_cam[1, 0, 0], src_cam[1, 1, 1], src_cam[1, 0, 2], src_cam[1, 1, 2])
+        return tuple(float(value) for value in (ref_id, src_id) + depth_setup + intrinsics)
+
+    def lookup(self, ref_id, src_ids, cams, depth_values):
+        """ (V - 1, D, 8) coefficients of the (V, 2, 4, 4) sample cameras, None if a view is missing """
+        coefficients = []
+        for view, src_id in enumerate(src_ids):
+            entry = self.entries.get(self.key(ref_id, src_id, cams[0], cams[view + 1], depth_values))
+            if entry is None:
+                return None
+            coefficients.append(entry)
+        return np.stack(coefficients, axis=0)
+
+    def coefficients(self, ref_id, src_ids, cams, depth_values):
+        """ lookup, the missing coefficients are computed and added to the table """
+        coefficients = self.lookup(ref_id, src_ids, cams, depth_values)
+        if coefficients is not None:
+            return coefficients
+        coefficients = view_transform_coefficients(cams, depth_values)
+        for view, src_id in enumerate(src_ids):
+            self.entries[self.key(ref_id, src_id, cams[0], cams[view + 1], depth_values)] = coefficients[view]
+        self.modified = True
+        return coefficients
+
+    def fill(self, cams_dir, view_num, process_cams, sample_depth_values):
+        """ add the samples of the pair.txt of cams_dir, process_cams is the camera process of the data
+            pipeline (None for invalid samples) and sample_depth_values the depth planes of its cameras """
+        for ref_id, src_ids in rig_samples(cams_dir, view_num):
+            cams = process_cams([load_cam_cached(os.path.join(cams_dir, '%08d_cam.txt' % image_id))
+                                 for image_id in [ref_id] + src_ids])
+            if cams is not None:
+                self.coefficients(ref_id, src_ids, cams, sample_depth_values(cams))
+
+    def load(self, path):
+        table = np.load(path)
+        keys, coefficients = table['keys'], table['coefficients']
+        offsets = np.cumsum(np.concatenate([[0], keys[:, 5].astype(np.int64)]))
+        for index, key in enumerate(keys):
+            self.entries[tuple(float(value) for value in key)] = coefficients[offsets[index]:offsets[index + 1]]
+
+    def save(self, path=None):
+        """ keys (N, 14) and the coefficients of all the entries concatenated along the depth planes """
+        path = self.path if path is None else path
+        keys = sorted(self.entries)
+        coefficients = [self.entries[key] for key in keys]
+        # through a file object, np.savez would append .npz to the path
+        with open(path, 'wb') as table_file:
+            np.savez(table_file, keys=np.array(keys, np.float64).reshape(-1, 14),
+                     coefficients=np.concatenate(coefficients, axis=0) if coefficients
+                     else np.zeros((0, 8), np.float32))
+        self.modified = False
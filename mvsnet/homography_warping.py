@@ -4,9 +4,22 @@ Copyright 2019, Yao Yao, HKUST.
 Differentiable homography related.
 """
 
+import weakref
+
 import tensorflow as tf
 import numpy as np
 
+try:
+    from tensorflow.contrib.image import transform as contrib_transform
+except ImportError:
+    # builds without tf.contrib warp with transform_sampling
+    contrib_transform = None
+
+# largest pixel error at the image corners of a transform warped as a pure translation
+TRANSLATION_TOLERANCE = 1e-3
+# smallest H x W x C image warped by a shift, the per plane map_fn of the shift costs more below it
+SHIFT_MIN_SIZE = 4096
+
 def get_homographies(left_cam, right_cam, depth_num, depth_start, depth_interval):
     with tf.name_scope('get_homographies'):
         # cameras (K, R, t)
@@ -19,9 +32,10 @@ def get_homographies(left_cam, right_cam, depth_num, depth_start, depth_interval
 
         # depth 
         depth_num = tf.reshape(tf.cast(depth_num, 'int32'), [])
-        depth = depth_start + tf.cast(tf.range(depth_num), tf.float32) * depth_interval
+        depth = tf.reshape(depth_start, [-1, 1]) + \
+            tf.reshape(tf.cast(tf.range(depth_num), tf.float32), [1, -1]) * tf.reshape(depth_interval, [-1, 1])
         # preparation
-        num_depth = tf.shape(depth)[0]
+        num_depth = tf.shape(depth)[1]
         K_left_inv = tf.matrix_inverse(tf.squeeze(K_left, axis=1))
         R_left_trans = tf.transpose(tf.squeeze(R_left, axis=1), perm=[0, 2, 1])
         R_right_trans = tf.transpose(tf.squeeze(R_right, axis=1), perm=[0, 2, 1])
@@ -97,7 +111,28 @@ def get_homographies_inv_depth(left_cam, right_cam, depth_num, depth_start, dept
 
     return homographies
 
+def static_or_dynamic_shape(tensor):
+    """ shape of the tensor, static sizes where known and scalar tensors elsewhere """
+    dynamic_shape = tf.shape(tensor)
+    return [dynamic_shape[axis] if size is None else size for axis, size in enumerate(tensor.shape.as_list())]
+
+# flattened (3 x H x W) pixel grid constants of get_pixel_grids, per graph and (height, width)
+_pixel_grids = weakref.WeakKeyDictionary()
+
 def get_pixel_grids(height, width):
+    """ flattened (3 x H x W) homogeneous image coordinates of the pixel centers, one constant per graph
+        and (height, width) when both are python ints """
+    if isinstance(height, int) and isinstance(width, int):
+        graph_grids = _pixel_grids.setdefault(tf.get_default_graph(), {})
+        if (height, width) not in graph_grids:
+            x_coordinates, y_coordinates = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+            pixel_grids = np.concatenate(
+                [x_coordinates.ravel(), y_coordinates.ravel(), np.ones(height * width)]).astype(np.float32)
+            # out of the control flow and dependencies of the first caller, shared by all the others
+            with tf.control_dependencies(None):
+                graph_grids[(height, width)] = tf.constant(pixel_grids, name='pixel_grids')
+        return graph_grids[(height, width)]
+
     # texture coordinate
     x_linspace = tf.linspace(0.5, tf.cast(width, 'float32') - 0.5, width)
     y_linspace = tf.linspace(0.5, tf.cast(height, 'float32') - 0.5, height)
@@ -108,27 +143,25 @@ def get_pixel_grids(height, width):
     indices_grid = tf.concat([x_coordinates, y_coordinates, ones], 0)
     return indices_grid
 
-def repeat_int(x, num_repeats):
-    ones = tf.ones((1, num_repeats), dtype='int32')
-    x = tf.reshape(x, shape=(-1, 1))
-    x = tf.matmul(x, ones)
-    return tf.reshape(x, [-1])
-
-def repeat_float(x, num_repeats):
-    ones = tf.ones((1, num_repeats), dtype='float')
-    x = tf.reshape(x, shape=(-1, 1))
-    x = tf.matmul(x, ones)
-    return tf.reshape(x, [-1])
+def gather_pixels(image, x_indices, y_indices):
+    """ pixels (K, B, N, C) of the (B, H, W, C) image at the (K, B, N) pixel indices, read in one gather
+        from the flattened image """
+    image_shape = tf.shape(image)
+    batch_offsets = tf.reshape(tf.range(image_shape[0]) * image_shape[1] * image_shape[2], [1, -1, 1])
+    flat_image = tf.reshape(image, [-1, image_shape[3]])
+    return tf.gather(flat_image, batch_offsets + y_indices * image_shape[2] + x_indices)
 
 def interpolate(image, x, y):
+    """ bilinear samples of the (B, H, W, C) image at the flattened (B x H x W) image coordinates x, y,
+        clamped to the image border, output (B x H x W, C) """
     image_shape = tf.shape(image)
     batch_size = image_shape[0]
     height =image_shape[1]
     width = image_shape[2]
 
-    # image coordinate to pixel coordinate
-    x = x - 0.5
-    y = y - 0.5
+    # image coordinate to pixel coordinate, (B, H x W)
+    x = tf.reshape(x, [batch_size, -1]) - 0.5
+    y = tf.reshape(y, [batch_size, -1]) - 0.5
     x0 = tf.cast(tf.floor(x), 'int32')
     x1 = x0 + 1
     y0 = tf.cast(tf.floor(y), 'int32')
@@ -139,56 +172,33 @@ def interpolate(image, x, y):
     x1 = tf.clip_by_value(x1, 0, max_x)
     y0 = tf.clip_by_value(y0, 0, max_y)
     y1 = tf.clip_by_value(y1, 0, max_y)
-    b = repeat_int(tf.range(batch_size), height * width)
-
-    indices_a = tf.stack([b, y0, x0], axis=1)
-    indices_b = tf.stack([b, y0, x1], axis=1)
-    indices_c = tf.stack([b, y1, x0], axis=1)
-    indices_d = tf.stack([b, y1, x1], axis=1)
-
-    pixel_values_a = tf.gather_nd(image, indices_a)
-    pixel_values_b = tf.gather_nd(image, indices_b)
-    pixel_values_c = tf.gather_nd(image, indices_c)
-    pixel_values_d = tf.gather_nd(image, indices_d)
+    pixel_values = gather_pixels(image, tf.stack([x0, x1, x0, x1]), tf.stack([y0, y0, y1, y1]))
 
     x0 = tf.cast(x0, 'float32')
     x1 = tf.cast(x1, 'float32')
     y0 = tf.cast(y0, 'float32')
     y1 = tf.cast(y1, 'float32')
-    area_a = tf.expand_dims(((y1 - y) * (x1 - x)), 1)
-    area_b = tf.expand_dims(((y1 - y) * (x - x0)), 1)
-    area_c = tf.expand_dims(((y - y0) * (x1 - x)), 1)
-    area_d = tf.expand_dims(((y - y0) * (x - x0)), 1)
-    output = tf.add_n([area_a * pixel_values_a,
-                        area_b * pixel_values_b,
-                        area_c * pixel_values_c,
-                        area_d * pixel_values_d])
-    return output
+    areas = tf.stack([(y1 - y) * (x1 - x), (y1 - y) * (x - x0), (y - y0) * (x1 - x), (y - y0) * (x - x0)])
+    output = tf.reduce_sum(tf.expand_dims(areas, -1) * pixel_values, axis=0)
+    return tf.reshape(output, [-1, image_shape[3]])
 
 def homography_warping(input_image, homography):
     with tf.name_scope('warping_by_homography'):
         image_shape = tf.shape(input_image)
-        batch_size = image_shape[0]
-        height = image_shape[1]
-        width = image_shape[2]
+        height, width = static_or_dynamic_shape(input_image)[1:3]
 
         # turn homography to affine_mat of size (B, 2, 3) and div_mat of size (B, 1, 3)
         affine_mat = tf.slice(homography, [0, 0, 0], [-1, 2, 3])
         div_mat = tf.slice(homography, [0, 2, 0], [-1, 1, 3])
 
-        # generate pixel grids of size (B, 3, (W+1) x (H+1))
-        pixel_grids = get_pixel_grids(height, width)
-        pixel_grids = tf.expand_dims(pixel_grids, 0)
-        pixel_grids = tf.tile(pixel_grids, [batch_size, 1])
-        pixel_grids = tf.reshape(pixel_grids, (batch_size, 3, -1))
-        # return pixel_grids
+        # pixel grids of size (3, H x W), broadcast over the batch
+        pixel_grids = tf.reshape(get_pixel_grids(height, width), (3, -1))
 
         # affine + divide tranform, output (B, 2, (W+1) x (H+1))
         grids_affine = tf.matmul(affine_mat, pixel_grids)
         grids_div = tf.matmul(div_mat, pixel_grids)
         grids_zero_add = tf.cast(tf.equal(grids_div, 0.0), dtype='float32') * 1e-7 # handle div 0
         grids_div = grids_div + grids_zero_add
-        grids_div = tf.tile(grids_div, [1, 2, 1])
         grids_inv_warped = tf.div(grids_affine, grids_div)
         x_warped, y_warped = tf.unstack(grids_inv_warped, axis=1)
         x_warped_flatten = tf.reshape(x_warped, [-1])
@@ -200,7 +210,8 @@ def homography_warping(input_image, homography):
 
     # return input_image
     return warped_image
-def tf_transform_homography(input_image, homography):
+def homography_transform_coefficients(homography):
+    """ 8 tf.contrib.image.transform coefficients of each homography, output (N, 8) """
 
 	# tf.contrib.image.transform is for pixel coordinate but our
 	# homograph parameters are for image coordinate (x_p = x_i + 0.5).
@@ -240,9 +251,330 @@ def tf_transform_homography(input_image, homography):
     homography_linear = tf.slice(homography, begin=[0, 0], size=[-1, 8])
     homography_linear_div = tf.tile(tf.slice(homography, begin=[0, 8], size=[-1, 1]), [1, 8])
     homography_linear = tf.div(homography_linear, homography_linear_div)
-    warped_image = tf.contrib.image.transform(
-        input_image, homography_linear, interpolation='BILINEAR')
+    return homography_linear
+
+def get_transform_coefficients(homographies):
+    """ transform coefficients (B, D, 8) of the (B, D, 3, 3) homographies """
+    homographies_shape = tf.shape(homographies)
+    return tf.reshape(homography_transform_coefficients(homographies),
+                      [homographies_shape[0], homographies_shape[1], 8])
+
+def image_transform(images, coefficients, output_shape=None):
+    """ bilinear tf.contrib.image.transform of the (N, H, W, C) images by the (N, 8) coefficients,
+        transform_sampling where tf.contrib is unavailable """
+    if contrib_transform is None:
+        return transform_sampling(images, coefficients, output_shape)
+    return contrib_transform(images, coefficients, interpolation='BILINEAR', output_shape=output_shape)
+
+def transform_sampling(images, coefficients, output_shape=None):
+    """ tf.contrib.image.transform of the (N, H, W, C) images by the (N, 8) coefficients with
+        bilinear_sampling: same pixel mapping, zero outside of the images and where the projective
+        divisor is zero, output (N, out_h, out_w, C) """
+    with tf.name_scope('transform_sampling'):
+        image_shape = static_or_dynamic_shape(images)
+        height, width = image_shape[1:3] if output_shape is None else output_shape
+
+        # output pixel coordinates (3, out_h x out_w) mapped by the (N, 3, 3) transforms
+        pixel_grids = tf.reshape(get_pixel_grids(height, width), (3, -1)) - [[0.5], [0.5], [0]]
+        transforms = tf.reshape(tf.concat([coefficients, tf.ones_like(coefficients[:, 0:1])], axis=1), [-1, 3, 3])
+        x_warped, y_warped, grids_div = tf.unstack(tf.matmul(transforms, pixel_grids), axis=1)
+        valid = tf.not_equal(grids_div, 0.0)
+        grids_div = tf.where(valid, grids_div, tf.ones_like(grids_div))
+
+        # pixel coordinate to image coordinate
+        warped_images = bilinear_sampling(images, x_warped / grids_div + 0.5, y_warped / grids_div + 0.5)
+        warped_images = warped_images * tf.expand_dims(tf.cast(valid, warped_images.dtype), -1)
+        return tf.reshape(warped_images, [image_shape[0], height, width, image_shape[3]])
+
+def tf_transform_coefficients(input_image, coefficients, output_shape=None):
+    """ warp the (B, H, W, C) image by the (B, 8) transform coefficients of its homographies """
+    return image_transform(input_image, coefficients, output_shape=output_shape)
+
+def tf_transform_homography(input_image, homography, output_shape=None):
+    homography_linear = homography_transform_coefficients(homography)
+    warped_image = tf_transform_coefficients(input_image, homography_linear, output_shape)
 
     # return input_image
     return warped_image
 
+def tf_transform_homography_batch(input_image, homographies):
+    """ warp a (B, H, W, C) image by all the (B, D, 3, 3) homographies in one transform,
+        output (B, D, H, W, C) """
+    return tf_transform_coefficients_batch(input_image, get_transform_coefficients(homographies))
+
+def tf_transform_coefficients_batch(input_image, coefficients):
+    """ warp a (B, H, W, C) image by all the (B, D, 8) transform coefficients in one transform,
+        output (B, D, H, W, C) """
+    with tf.name_scope('batch_warping_by_homography'):
+        image_shape = tf.shape(input_image)
+        depth_num = tf.shape(coefficients)[1]
+
+        # one copy of the image per depth plane, flattened to (B x D, H, W, C)
+        images = tf.tile(tf.expand_dims(input_image, axis=1), [1, depth_num, 1, 1, 1])
+        images = tf.reshape(images, [-1, image_shape[1], image_shape[2], image_shape[3]])
+        warped_images = image_transform(images, tf.reshape(coefficients, [-1, 8]))
+        warped_images = tf.reshape(
+            warped_images, [image_shape[0], depth_num, image_shape[1], image_shape[2], image_shape[3]])
+        warped_images.set_shape(
+            input_image.shape[0:1].concatenate(coefficients.shape[1:2]).concatenate(input_image.shape[1:]))
+    return warped_images
+
+def translation_offsets(coefficients, height, width):
+    """ (x, y) pixel offsets (..., 2) of the (..., 8) transform coefficients, and whether all of them
+        are pure translations of a height x width image, as for the cameras of a camera grid (same K
+        and R, no baseline along the optical axis): the transforms map the image corners to their
+        shifted corners within TRANSLATION_TOLERANCE pixels """
+    a0, a1, a2, b0, b1, b2, c0, c1 = tf.unstack(coefficients, axis=-1)
+    # the error of the near-affine transforms is largest at the corners
+    corner_x = tf.cast(tf.stack([0, width - 1, 0, width - 1]), coefficients.dtype)
+    corner_y = tf.cast(tf.stack([0, 0, height - 1, height - 1]), coefficients.dtype)
+    a0, a1, a2, b0, b1, b2, c0, c1 = [tf.expand_dims(c, -1) for c in [a0, a1, a2, b0, b1, b2, c0, c1]]
+    divisor = c0 * corner_x + c1 * corner_y + 1
+    error_x = (a0 * corner_x + a1 * corner_y + a2) / divisor - (corner_x + a2)
+    error_y = (b0 * corner_x + b1 * corner_y + b2) / divisor - (corner_y + b2)
+    # a singular corner gives an inf or nan error, not a translation
+    is_translation = tf.reduce_all(tf.logical_and(tf.abs(error_x) < TRANSLATION_TOLERANCE,
+                                                  tf.abs(error_y) < TRANSLATION_TOLERANCE))
+    return tf.gather(coefficients, [2, 5], axis=-1), is_translation
+
+def shift_image(input_image, offset):
+    """ sample the (H, W, C) image at the pixels shifted by the (x, y) offset, the bilinear interpolation
+        of tf.contrib.image.transform separated into a row and a column interpolation of one window """
+    image_shape = tf.shape(input_image)
+    image_size = tf.stack([image_shape[1], image_shape[0]])
+    offset_floor = tf.floor(offset)
+    x_fraction, y_fraction = tf.unstack(offset - offset_floor)
+
+    # window of (H + 1, W + 1) input pixels at the integer offset, zero outside of the image
+    window_start = tf.cast(offset_floor, tf.int32)
+    window_size = image_size + 1
+    begin = tf.clip_by_value(window_start, 0, image_size)
+    end = tf.clip_by_value(window_start + window_size, 0, image_size)
+    window = tf.slice(input_image, [begin[1], begin[0], 0], [end[1] - begin[1], end[0] - begin[0], -1])
+    pad_before = tf.clip_by_value(begin - window_start, 0, window_size)
+    pad_after = window_size - pad_before - (end - begin)
+    window = tf.pad(window, [[pad_before[1], pad_after[1]], [pad_before[0], pad_after[0]], [0, 0]])
+
+    # interpolate the rows then the columns
+    rows = (1 - y_fraction) * window[:-1] + y_fraction * window[1:]
+    return (1 - x_fraction) * rows[:, :-1] + x_fraction * rows[:, 1:]
+
+def tf_shift_batch(input_image, offsets):
+    """ shift a (B, H, W, C) image by all the (B, D, 2) pixel offsets, output (B, D, H, W, C) """
+    with tf.name_scope('batch_warping_by_shift'):
+        image_shape = tf.shape(input_image)
+        depth_num = tf.shape(offsets)[1]
+        batch_index = tf.range(image_shape[0] * depth_num) // depth_num
+        warped_images = tf.map_fn(
+            lambda index_offset: shift_image(tf.gather(input_image, index_offset[0]), index_offset[1]),
+            (batch_index, tf.reshape(offsets, [-1, 2])), dtype=input_image.dtype)
+        warped_images = tf.reshape(
+            warped_images, [image_shape[0], depth_num, image_shape[1], image_shape[2], image_shape[3]])
+    return warped_images
+
+def visible_boxes(coefficients, height, width):
+    """ bounding boxes (..., 4) [start_h, start_w, end_h, end_w) of the output pixels of a (height, width)
+        image that the (..., 8) transform coefficients map into the input image of the same size, i.e.
+        the pixels where the bilinear warp may be non-zero; empty boxes have end <= start. The input
+        image is mapped back by the inverse transform, the full image is returned when it crosses the
+        line at infinity of the inverse """
+    with tf.name_scope('visible_boxes'):
+        height = tf.cast(height, coefficients.dtype)
+        width = tf.cast(width, coefficients.dtype)
+        transforms = tf.concat([coefficients, tf.ones_like(coefficients[..., 0:1])], axis=-1)
+        transforms = tf.reshape(transforms, tf.concat([tf.shape(coefficients)[:-1], [3, 3]], axis=0))
+        inverse_transforms = tf.matrix_inverse(transforms)
+
+        # input pixel corners (3, 4) one pixel out of the image, the bilinear neighbours of the border
+        corners = tf.stack([tf.stack([-1.0, width, -1.0, width]),
+                            tf.stack([-1.0, -1.0, height, height]), tf.ones([4])])
+        x_mapped, y_mapped, mapped_div = tf.unstack(tf.matmul(inverse_transforms, corners), axis=-2)
+        bounded = tf.logical_or(tf.reduce_all(mapped_div > 0, axis=-1), tf.reduce_all(mapped_div < 0, axis=-1))
+        mapped_div = tf.where(tf.not_equal(mapped_div, 0.0), mapped_div, tf.ones_like(mapped_div))
+        x_mapped = x_mapped / mapped_div
+        y_mapped = y_mapped / mapped_div
+
+        # output pixels (integer pixel coordinates) within the mapped corners, clipped to the image
+        boxes = tf.stack([tf.floor(tf.reduce_min(y_mapped, axis=-1)),
+                          tf.floor(tf.reduce_min(x_mapped, axis=-1)),
+                          tf.floor(tf.reduce_max(y_mapped, axis=-1)) + 1,
+                          tf.floor(tf.reduce_max(x_mapped, axis=-1)) + 1], axis=-1)
+        full_box = tf.stack([0.0, 0.0, height, width])
+        bounded = tf.cast(tf.expand_dims(bounded, -1), boxes.dtype)
+        boxes = bounded * tf.minimum(tf.maximum(boxes, 0.0), tf.stack([height, width, height, width])) + \
+            (1 - bounded) * full_box
+        return tf.cast(boxes, tf.int32)
+
+def box_masks(boxes, height, width):
+    """ float masks (..., height, width, 1) of the (..., 4) boxes of visible_boxes """
+    start_h, start_w, end_h, end_w = tf.unstack(tf.expand_dims(boxes, -1), axis=-2)
+    rows = tf.range(height)
+    columns = tf.range(width)
+    row_masks = tf.cast(tf.logical_and(rows >= start_h, rows < end_h), tf.float32)
+    column_masks = tf.cast(tf.logical_and(columns >= start_w, columns < end_w), tf.float32)
+    return tf.expand_dims(tf.expand_dims(row_masks, -1) * tf.expand_dims(column_masks, -2), -1)
+
+def offset_coefficients(coefficients, start_w, start_h):
+    """ (..., 8) transform coefficients of the output window starting at (start_w, start_h), the
+        transform renormalized so that its last coefficient stays 1 """
+    start_w = tf.cast(start_w, coefficients.dtype)
+    start_h = tf.cast(start_h, coefficients.dtype)
+    a0, a1, a2, b0, b1, b2, c0, c1 = tf.unstack(coefficients, axis=-1)
+    divisor = c0 * start_w + c1 * start_h + 1
+    offset = tf.stack([a0, a1, a0 * start_w + a1 * start_h + a2,
+                       b0, b1, b0 * start_w + b1 * start_h + b2, c0, c1], axis=-1)
+    return offset / tf.expand_dims(divisor, -1)
+
+def tf_transform_boxes_batch(input_image, coefficients, boxes):
+    """ tf_transform_coefficients_batch where each depth plane is only warped inside the union over the
+        batch of its (B, D, 4) visible_boxes and is zero elsewhere, output (B, D, H, W, C) """
+    with tf.name_scope('batch_warping_by_boxes'):
+        image_shape = tf.shape(input_image)
+        image_size = image_shape[1:3]
+
+        def warp_plane(plane):
+            plane_coefficients, plane_boxes = plane
+            # union of the non-empty boxes of the batch
+            non_empty = tf.logical_and(plane_boxes[:, 2] > plane_boxes[:, 0],
+                                       plane_boxes[:, 3] > plane_boxes[:, 1])
+            starts = tf.where(non_empty, plane_boxes[:, 0:2], tf.zeros_like(plane_boxes[:, 0:2]) + image_size)
+            ends = tf.where(non_empty, plane_boxes[:, 2:4], tf.zeros_like(plane_boxes[:, 2:4]))
+            start = tf.reduce_min(starts, axis=0)
+            end = tf.reduce_max(ends, axis=0)
+
+            def warp_window():
+                # the window keeps the full image origin when the transform is singular at its corner
+                window_start = tf.cast(start, plane_coefficients.dtype)
+                divisors = (plane_coefficients[:, 6] * window_start[1] +
+                            plane_coefficients[:, 7] * window_start[0] + 1)
+                window_start = tf.where(tf.reduce_all(tf.abs(divisors) > 1e-6), start, tf.zeros_like(start))
+                window_coefficients = offset_coefficients(plane_coefficients, window_start[1], window_start[0])
+                window = image_transform(input_image, window_coefficients, output_shape=end - window_start)
+                return tf.pad(window, [[0, 0], [window_start[0], image_size[0] - end[0]],
+                                       [window_start[1], image_size[1] - end[1]], [0, 0]])
+
+            return tf.cond(tf.reduce_any(non_empty), warp_window, lambda: tf.zeros_like(input_image))
+
+        warped_images = tf.map_fn(
+            warp_plane, (tf.transpose(coefficients, [1, 0, 2]), tf.transpose(boxes, [1, 0, 2])),
+            dtype=input_image.dtype)
+        warped_images = tf.transpose(warped_images, [1, 0, 2, 3, 4])
+    return warped_images
+
+def tf_shift_or_transform_batch(input_image, coefficients, boxes=None):
+    """ tf_transform_coefficients_batch, by tf_shift_batch when all the transforms are translations
+        of an image of at least SHIFT_MIN_SIZE values; the (B, D, 4) visible_boxes of the planes
+        restrict the projective transforms to them """
+    if boxes is None:
+        transform = lambda: tf_transform_coefficients_batch(input_image, coefficients)
+    else:
+        transform = lambda: tf_transform_boxes_batch(input_image, coefficients, boxes)
+    image_size = input_image.shape[1:].num_elements()
+    if image_size is not None and image_size < SHIFT_MIN_SIZE:
+        warped_images = transform()
+    else:
+        image_shape = tf.shape(input_image)
+        offsets, is_translation = translation_offsets(coefficients, image_shape[1], image_shape[2])
+        warped_images = tf.cond(is_translation, lambda: tf_shift_batch(input_image, offsets), transform)
+    warped_images.set_shape(
+        input_image.shape[0:1].concatenate(coefficients.shape[1:2]).concatenate(input_image.shape[1:]))
+    return warped_images
+
+def tf_shift_or_transform(input_image, coefficients, boxes=None):
+    """ tf_transform_coefficients of the (B, 8) coefficients, by a shift for translations, restricted
+        to the (B, 4) visible_boxes when given """
+    if boxes is not None:
+        boxes = tf.expand_dims(boxes, axis=1)
+    warped_images = tf_shift_or_transform_batch(input_image, tf.expand_dims(coefficients, axis=1), boxes)
+    return tf.squeeze(warped_images, axis=1)
+
+def offset_homographies(homographies, start_w, start_h):
+    """ homographies (..., 3, 3) of the reference image crop starting at (start_w, start_h) """
+    start_w = tf.cast(start_w, homographies.dtype)
+    start_h = tf.cast(start_h, homographies.dtype)
+    # right product with the translation of the crop, only the last column changes
+    columns = tf.unstack(homographies, axis=-1)
+    offset_column = columns[0] * start_w + columns[1] * start_h + columns[2]
+    return tf.stack([columns[0], columns[1], offset_column], axis=-1)
+
+def get_pixel_homographies(left_cam, right_cam):
+    """ (A, B) of size (B, 3, 3), the homography of the fronto-parallel plane at depth d being A - B / d,
+        so that a different depth can be used at each pixel """
+    with tf.name_scope('get_pixel_homographies'):
+        # cameras (K, R, t)
+        R_left = tf.squeeze(tf.slice(left_cam, [0, 0, 0, 0], [-1, 1, 3, 3]), axis=1)
+        R_right = tf.squeeze(tf.slice(right_cam, [0, 0, 0, 0], [-1, 1, 3, 3]), axis=1)
+        t_left = tf.squeeze(tf.slice(left_cam, [0, 0, 0, 3], [-1, 1, 3, 1]), axis=1)
+        t_right = tf.squeeze(tf.slice(right_cam, [0, 0, 0, 3], [-1, 1, 3, 1]), axis=1)
+        K_left = tf.squeeze(tf.slice(left_cam, [0, 1, 0, 0], [-1, 1, 3, 3]), axis=1)
+        K_right = tf.squeeze(tf.slice(right_cam, [0, 1, 0, 0], [-1, 1, 3, 3]), axis=1)
+
+        # preparation
+        K_left_inv = tf.matrix_inverse(K_left)
+        R_left_trans = tf.transpose(R_left, perm=[0, 2, 1])
+        R_right_trans = tf.transpose(R_right, perm=[0, 2, 1])
+        fronto_direction = tf.slice(R_left, [0, 2, 0], [-1, 1, 3])                   # (B, 1, 3)
+        c_left = -tf.matmul(R_left_trans, t_left)
+        c_right = -tf.matmul(R_right_trans, t_right)                                  # (B, 3, 1)
+        c_relative = tf.subtract(c_right, c_left)
+
+        # compute
+        left_mat = tf.matmul(K_right, R_right)
+        right_mat = tf.matmul(R_left_trans, K_left_inv)
+        homography_a = tf.matmul(left_mat, right_mat)
+        homography_b = tf.matmul(left_mat, tf.matmul(tf.matmul(c_relative, fronto_direction), right_mat))
+    return homography_a, homography_b
+
+def bilinear_sampling(image, x, y):
+    """ bilinear samples of the (B, H, W, C) image at the image coordinates x, y of size (B, N),
+        zero outside of the image like tf.contrib.image.transform, output (B, N, C) """
+    image_shape = tf.shape(image)
+    height = image_shape[1]
+    width = image_shape[2]
+
+    # image coordinate to pixel coordinate
+    x = x - 0.5
+    y = y - 0.5
+    x0 = tf.floor(x)
+    y0 = tf.floor(y)
+
+    # the four neighbours (4, B, N), out of the image ones are read clamped and weighted by zero
+    x_corners = tf.stack([x0, x0 + 1, x0, x0 + 1])
+    y_corners = tf.stack([y0, y0, y0 + 1, y0 + 1])
+    valid = tf.logical_and(
+        tf.logical_and(x_corners >= 0, x_corners <= tf.cast(width - 1, 'float32')),
+        tf.logical_and(y_corners >= 0, y_corners <= tf.cast(height - 1, 'float32')))
+    areas = (1 - tf.abs(x - x_corners)) * (1 - tf.abs(y - y_corners)) * tf.cast(valid, 'float32')
+    x_indices = tf.clip_by_value(tf.cast(x_corners, 'int32'), 0, width - 1)
+    y_indices = tf.clip_by_value(tf.cast(y_corners, 'int32'), 0, height - 1)
+    return tf.reduce_sum(tf.expand_dims(areas, -1) * gather_pixels(image, x_indices, y_indices), axis=0)
+
+def depth_hypotheses_warping(input_image, left_cam, right_cam, depth_hypotheses):
+    """ warp the (B, H, W, C) right image to the left image pixels at the per-pixel depth
+        hypotheses of size (B, D, H, W), output (B, D, H, W, C) """
+    with tf.name_scope('warping_by_depth_hypotheses'):
+        image_shape = tf.shape(input_image)
+        hypotheses_shape = tf.shape(depth_hypotheses)
+        batch_size = hypotheses_shape[0]
+        depth_num = hypotheses_shape[1]
+
+        # per-pixel homographies applied to the pixel grids, (B, D, 3, H x W)
+        homography_a, homography_b = get_pixel_homographies(left_cam, right_cam)
+        pixel_grids = get_pixel_grids(*static_or_dynamic_shape(depth_hypotheses)[2:4])
+        pixel_grids = tf.reshape(pixel_grids, [3, -1])
+        grids_a = tf.expand_dims(tf.matmul(homography_a, pixel_grids), 1)
+        grids_b = tf.expand_dims(tf.matmul(homography_b, pixel_grids), 1)
+        depth = tf.reshape(depth_hypotheses, [batch_size, depth_num, 1, -1])
+        grids = grids_a - grids_b / depth
+
+        # divide, output (B, D x H x W)
+        x_warped, y_warped, grids_div = tf.unstack(grids, axis=2)
+        grids_div = grids_div + tf.cast(tf.equal(grids_div, 0.0), dtype='float32') * 1e-7 # handle div 0
+        x_warped = tf.reshape(x_warped / grids_div, [batch_size, -1])
+        y_warped = tf.reshape(y_warped / grids_div, [batch_size, -1])
+
+        # interpolation
+        warped_image = bilinear_sampling(input_image, x_warped, y_warped)
+        warped_image = tf.reshape(warped_image, tf.concat([hypotheses_shape, image_shape[3:]], axis=0))
+        warped_image.set_shape(depth_hypotheses.get_shape().concatenate(input_image.get_shape()[3:]))
+    return warped_image
@@ -13,6 +13,7 @@ sys.path.append("../")
 from cnn_wrapper.mvsnet import *
 from convgru import ConvGRUCell
 from homography_warping import *
+from cameras import tf_scale_cams
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -69,15 +70,144 @@ def get_propability_map(cv, depth_map, depth_start, depth_interval):
 
     return prob_map
 
-def inference(images, cams, depth_num, depth_start, depth_interval, is_master_gpu=True):
-    """ infer depth image from multi-view images and cameras """
+def get_hypotheses_propability_map(prob_volume, depth_map, hypotheses_start, hypotheses_interval):
+    """ get probability map from the probability volume of per-pixel depth hypotheses,
+        uniformly spaced from hypotheses_start by hypotheses_interval (B, H, W) at each pixel """
+    depth = tf.shape(prob_volume)[1]
+
+    # d coordinate (floored and ceiled) of each pixel
+    d_coordinates = (tf.squeeze(depth_map, axis=-1) - hypotheses_start) / hypotheses_interval
+    d_coordinates_left0 = tf.clip_by_value(tf.cast(tf.floor(d_coordinates), 'int32'), 0, depth - 1)
+    d_coordinates_left1 = tf.clip_by_value(d_coordinates_left0 - 1, 0, depth - 1)
+    d_coordinates1_right0 = tf.clip_by_value(tf.cast(tf.ceil(d_coordinates), 'int32'), 0, depth - 1)
+    d_coordinates1_right1 = tf.clip_by_value(d_coordinates1_right0 + 1, 0, depth - 1)
+
+    # get probability image by gathering the 4 hypotheses around the depth
+    prob_map = []
+    for d_coordinates in [d_coordinates_left0, d_coordinates_left1, d_coordinates1_right0, d_coordinates1_right1]:
+        prob_map.append(tf.reduce_sum(prob_volume * tf.one_hot(d_coordinates, depth, axis=1), axis=1))
+    prob_map = tf.expand_dims(tf.add_n(prob_map), axis=-1)
+
+    return prob_map
+
+def group_correlation(ref_feature, warped_feature, group_num=8):
+    """ mean inner product of the features in each of the group_num channel groups, (..., C) to (..., G) """
+    product = ref_feature * warped_feature
+    static_shape = product.get_shape()
+    channel_num = static_shape[-1].value
+    if channel_num is None or group_num <= 0 or channel_num % group_num != 0:
+        raise ValueError('%s correlation groups do not divide the %s feature channels.' % (group_num, channel_num))
+    product_shape = tf.shape(product)
+    product = tf.reshape(product, tf.concat([product_shape[:-1], [group_num, channel_num // group_num]], axis=0))
+    correlation = tf.reduce_mean(product, axis=-1)
+    correlation.set_shape(static_shape[:-1].concatenate([group_num]))
+    return correlation
+
+def matching_cost(ref_feature, warped_view_features, cost_metric='variance', group_num=8,
+                  cost_dtype=tf.float32, ref_square=None, view_masks=None):
+    """ cost of the reference feature against the warped view features, lower is better: the feature
+        variance ('variance', C channels) or the negated group-wise correlation averaged over the views
+        ('correlation', group_num channels), accumulated in float32 and stored as cost_dtype;
+        ref_square is the square of the reference feature when computed once for a sweep, view_masks
+        the (..., H, W, 1) box_masks of the views, only the views inside their box are averaged (the
+        warped features are zero outside of it) """
+    view_num = len(warped_view_features) + 1
+    if view_masks is not None:
+        view_num = 1 + tf.add_n(view_masks)
+    if cost_metric == 'correlation':
+        correlations = [group_correlation(ref_feature, warped_view_feature, group_num)
+                        for warped_view_feature in warped_view_features]
+        return tf.cast(-tf.add_n(correlations) / tf.maximum(view_num - 1, 1), cost_dtype)
+    elif cost_metric != 'variance':
+        raise ValueError('Unknown cost metric: ' + cost_metric)
+
+    # compute cost (variation metric)
+    ave_feature = ref_feature
+    ave_feature2 = tf.square(ref_feature) if ref_square is None else ref_square
+    for warped_view_feature in warped_view_features:
+        ave_feature = ave_feature + warped_view_feature
+        ave_feature2 = ave_feature2 + tf.square(warped_view_feature)
+    ave_feature = ave_feature / view_num
+    ave_feature2 = ave_feature2 / view_num
+    return tf.cast(ave_feature2 - tf.square(ave_feature), cost_dtype)
+
+def get_view_boxes(feature, view_coefficients, visibility='none'):
+    """ visible_boxes of the (..., 8) coefficients of each view in the (B, H, W, C) feature, None for
+        the 'none' visibility """
+    if visibility == 'none':
+        return None
+    elif visibility not in ('warp', 'cost'):
+        raise ValueError('Unknown visibility: ' + visibility)
+    height, width = static_or_dynamic_shape(feature)[1:3]
+    return [visible_boxes(coefficients, height, width) for coefficients in view_coefficients]
+
+def cost_volume_chunks(ref_feature, view_features, view_coefficients, depth_num, depth_chunk=0,
+                       cost_metric='variance', group_num=8, cost_dtype=tf.float32, visibility='none'):
+    """ cost volume as a list of (B, d, H, W, C) chunks of depth_chunk planes (0 for one chunk),
+        the planes of a chunk are warped by one batched transform per view; visibility 'warp' only
+        warps each plane of a view inside the bounding box of its visible region, 'cost' also leaves
+        the views out of their box out of the cost """
+    if depth_chunk <= 0:
+        depth_chunk = depth_num
+    view_boxes = get_view_boxes(ref_feature, view_coefficients, visibility)
+    feature_shape = static_or_dynamic_shape(ref_feature)
+    ref_feature = tf.expand_dims(ref_feature, axis=1)
+    cost_chunks = []
+    for depth_begin in range(0, depth_num, depth_chunk):
+        chunk_num = min(depth_chunk, depth_num - depth_begin)
+        warped_view_features = []
+        view_masks = [] if visibility == 'cost' else None
+        for view in range(0, len(view_features)):
+            coefficients = tf.slice(
+                view_coefficients[view], begin=[0, depth_begin, 0], size=[-1, chunk_num, 8])
+            boxes = None
+            if view_boxes is not None:
+                boxes = tf.slice(view_boxes[view], begin=[0, depth_begin, 0], size=[-1, chunk_num, 4])
+            if view_masks is not None:
+                view_masks.append(box_masks(boxes, feature_shape[1], feature_shape[2]))
+            # the views of a chunk and the chunks are warped one after another, not all at once
+            with tf.control_dependencies(warped_view_features[-1:] or cost_chunks[-1:]):
+                warped_view_features.append(
+                    tf_shift_or_transform_batch(view_features[view], coefficients, boxes))
+        cost_chunks.append(matching_cost(ref_feature, warped_view_features, cost_metric, group_num, cost_dtype,
+                                         view_masks=view_masks))
+    return cost_chunks
+
+def build_cost_volume(ref_feature, view_features, view_coefficients, depth_num, depth_chunk=0,
+                      cost_metric='variance', group_num=8, cost_dtype=tf.float32, visibility='none'):
+    """ cost volume of size (B, D, H, W, C) """
+    cost_chunks = cost_volume_chunks(ref_feature, view_features, view_coefficients, depth_num, depth_chunk,
+                                     cost_metric, group_num, cost_dtype, visibility)
+    if len(cost_chunks) == 1:
+        return cost_chunks[0]
+    return tf.concat(cost_chunks, axis=1)
+
+def get_view_coefficients(cams, depth_num, depth_start, depth_interval, view_coefficients=None):
+    """ list of the (B, D, 8) transform coefficients of the homographies of each view, sliced from the
+        (B, V - 1, D, 8) view_coefficients of the data pipeline (homography_coefficients.py) when given """
+    if view_coefficients is not None:
+        return tf.unstack(view_coefficients, FLAGS.view_num - 1, axis=1)
+    ref_cam = tf.squeeze(tf.slice(cams, [0, 0, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
+    coefficients = []
+    for view in range(1, FLAGS.view_num):
+        view_cam = tf.squeeze(tf.slice(cams, [0, view, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
+        homographies = get_homographies(ref_cam, view_cam, depth_num=depth_num,
+                                        depth_start=depth_start, depth_interval=depth_interval)
+        coefficients.append(get_transform_coefficients(homographies))
+    return coefficients
+
+def inference(images, cams, depth_num, depth_start, depth_interval, is_master_gpu=True, depth_chunk=0,
+              cost_metric='variance', group_num=8, cost_dtype=tf.float32, view_coefficients=None,
+              visibility='none'):
+    """ infer depth image from multi-view images and cameras, the cost volume and its regularization
+        in cost_dtype (float32, float16 or bfloat16); view_coefficients are the (B, V - 1, D, 8)
+        homography transform coefficients of the data pipeline, computed from the cameras if None """
 
     # dynamic gpu params
     depth_end = depth_start + (tf.cast(depth_num, tf.float32) - 1) * depth_interval
 
     # reference image
     ref_image = tf.squeeze(tf.slice(images, [0, 0, 0, 0, 0], [-1, 1, -1, -1, 3]), axis=1)
-    ref_cam = tf.squeeze(tf.slice(cams, [0, 0, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
 
     # image feature extraction    
     if is_master_gpu:
@@ -91,39 +221,21 @@ def inference(images, cams, depth_num, depth_start, depth_interval, is_master_gp
         view_towers.append(view_tower)
 
     # get all homographies
-    view_homographies = []
-    for view in range(1, FLAGS.view_num):
-        view_cam = tf.squeeze(tf.slice(cams, [0, view, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
-        homographies = get_homographies(ref_cam, view_cam, depth_num=depth_num,
-                                        depth_start=depth_start, depth_interval=depth_interval)
-        view_homographies.append(homographies)
+    view_coefficients = get_view_coefficients(cams, depth_num, depth_start, depth_interval, view_coefficients)
 
     # build cost volume by differentialble homography
     with tf.name_scope('cost_volume_homography'):
-        depth_costs = []
-        for d in range(depth_num):
-            # compute cost (variation metric)
-            ave_feature = ref_tower.get_output()
-            ave_feature2 = tf.square(ref_tower.get_output())
-            for view in range(0, FLAGS.view_num - 1):
-                homography = tf.slice(view_homographies[view], begin=[0, d, 0, 0], size=[-1, 1, 3, 3])
-                homography = tf.squeeze(homography, axis=1)
-				# warped_view_feature = homography_warping(view_towers[view].get_output(), homography)
-                warped_view_feature = tf_transform_homography(view_towers[view].get_output(), homography)
-                ave_feature = ave_feature + warped_view_feature
-                ave_feature2 = ave_feature2 + tf.square(warped_view_feature)
-            ave_feature = ave_feature / FLAGS.view_num
-            ave_feature2 = ave_feature2 / FLAGS.view_num
-            cost = ave_feature2 - tf.square(ave_feature)
-            depth_costs.append(cost)
-        cost_volume = tf.stack(depth_costs, axis=1)
+        view_features = [view_tower.get_output() for view_tower in view_towers]
+        cost_volume = build_cost_volume(ref_tower.get_output(), view_features, view_coefficients,
+                                        depth_num, depth_chunk, cost_metric, group_num, cost_dtype,
+                                        visibility)
 
     # filtered cost volume, size of (B, D, H, W, 1)
     if is_master_gpu:
         filtered_cost_volume_tower = RegNetUS0({'data': cost_volume}, is_training=True, reuse=False)
     else:
         filtered_cost_volume_tower = RegNetUS0({'data': cost_volume}, is_training=True, reuse=True)
-    filtered_cost_volume = tf.squeeze(filtered_cost_volume_tower.get_output(), axis=-1)
+    filtered_cost_volume = tf.cast(tf.squeeze(filtered_cost_volume_tower.get_output(), axis=-1), tf.float32)
 
     # depth map by softArgmin
     with tf.name_scope('soft_arg_min'):
@@ -146,18 +258,19 @@ def inference(images, cams, depth_num, depth_start, depth_interval, is_master_gp
 
     return estimated_depth_map, prob_map#, filtered_depth_map, probability_volume
 
-def inference_mem(images, cams, depth_num, depth_start, depth_interval, is_master_gpu=True):
-    """ infer depth image from multi-view images and cameras """
+def inference_mem(images, cams, depth_num, depth_start, depth_interval, is_master_gpu=True, depth_chunk=8,
+                  cost_metric='variance', group_num=8, cost_dtype=tf.float32, view_coefficients=None,
+                  visibility='none'):
+    """ infer depth image from multi-view images and cameras, the cost volume and its regularization
+        in cost_dtype (float32, float16 or bfloat16), the views warped depth_chunk planes at a time;
+        view_coefficients are the (B, V - 1, D, 8) homography transform coefficients of the data
+        pipeline, computed from the cameras if None """
 
     # dynamic gpu params
     depth_end = depth_start + (tf.cast(depth_num, tf.float32) - 1) * depth_interval
-    feature_c = 32
-    feature_h = FLAGS.max_h / 4
-    feature_w = FLAGS.max_w / 4
 
     # reference image
     ref_image = tf.squeeze(tf.slice(images, [0, 0, 0, 0, 0], [-1, 1, -1, -1, 3]), axis=1)
-    ref_cam = tf.squeeze(tf.slice(cams, [0, 0, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
 
     # image feature extraction    
     if is_master_gpu:
@@ -165,66 +278,29 @@ def inference_mem(images, cams, depth_num, depth_start, depth_interval, is_maste
     else:
         ref_tower = UNetDS2GN({'data': ref_image}, is_training=True, reuse=True)
     ref_feature = ref_tower.get_output()
-    ref_feature2 = tf.square(ref_feature)
 
     view_features = []
     for view in range(1, FLAGS.view_num):
         view_image = tf.squeeze(tf.slice(images, [0, view, 0, 0, 0], [-1, 1, -1, -1, -1]), axis=1)
         view_tower = UNetDS2GN({'data': view_image}, is_training=True, reuse=True)
         view_features.append(view_tower.get_output())
-    view_features = tf.stack(view_features, axis=0)
 
     # get all homographies
-    view_homographies = []
-    for view in range(1, FLAGS.view_num):
-        view_cam = tf.squeeze(tf.slice(cams, [0, view, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
-        homographies = get_homographies(ref_cam, view_cam, depth_num=depth_num,
-                                        depth_start=depth_start, depth_interval=depth_interval)
-        view_homographies.append(homographies)
-    view_homographies = tf.stack(view_homographies, axis=0)
+    view_coefficients = get_view_coefficients(cams, depth_num, depth_start, depth_interval, view_coefficients)
 
     # build cost volume by differentialble homography
     with tf.name_scope('cost_volume_homography'):
-        depth_costs = []
-
-        for d in range(depth_num):
-            # compute cost (standard deviation feature)
-            ave_feature = tf.Variable(tf.zeros(
-                [FLAGS.batch_size, feature_h, feature_w, feature_c]),
-                name='ave', trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
-            ave_feature2 = tf.Variable(tf.zeros(
-                [FLAGS.batch_size, feature_h, feature_w, feature_c]),
-                name='ave2', trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
-            ave_feature = tf.assign(ave_feature, ref_feature)
-            ave_feature2 = tf.assign(ave_feature2, ref_feature2)
-
-            def body(view, ave_feature, ave_feature2):
-                """Loop body."""
-                homography = tf.slice(view_homographies[view], begin=[0, d, 0, 0], size=[-1, 1, 3, 3])
-                homography = tf.squeeze(homography, axis=1)
-                # warped_view_feature = homography_warping(view_features[view], homography)
-                warped_view_feature = tf_transform_homography(view_features[view], homography)
-                ave_feature = tf.assign_add(ave_feature, warped_view_feature)
-                ave_feature2 = tf.assign_add(ave_feature2, tf.square(warped_view_feature))
-                view = tf.add(view, 1)
-                return view, ave_feature, ave_feature2
-
-            view = tf.constant(0)
-            cond = lambda view, *_: tf.less(view, FLAGS.view_num - 1)
-            _, ave_feature, ave_feature2 = tf.while_loop(
-                cond, body, [view, ave_feature, ave_feature2], back_prop=False, parallel_iterations=1)
-
-            ave_feature = tf.assign(ave_feature, tf.square(ave_feature) / (FLAGS.view_num * FLAGS.view_num))
-            ave_feature2 = tf.assign(ave_feature2, ave_feature2 / FLAGS.view_num - ave_feature)
-            depth_costs.append(ave_feature2)
-        cost_volume = tf.stack(depth_costs, axis=1)
+        # warped in chunks of depth_chunk planes to bound the memory
+        cost_volume = build_cost_volume(ref_feature, view_features, view_coefficients,
+                                        depth_num, depth_chunk, cost_metric, group_num, cost_dtype,
+                                        visibility)
 
     # filtered cost volume, size of (B, D, H, W, 1)
     if is_master_gpu:
         filtered_cost_volume_tower = RegNetUS0({'data': cost_volume}, is_training=True, reuse=False)
     else:
         filtered_cost_volume_tower = RegNetUS0({'data': cost_volume}, is_training=True, reuse=True)
-    filtered_cost_volume = tf.squeeze(filtered_cost_volume_tower.get_output(), axis=-1)
+    filtered_cost_volume = tf.cast(tf.squeeze(filtered_cost_volume_tower.get_output(), axis=-1), tf.float32)
 
     # depth map by softArgmin
     with tf.name_scope('soft_arg_min'):
@@ -250,8 +326,24 @@ def inference_mem(images, cams, depth_num, depth_start, depth_interval, is_maste
     return estimated_depth_map, prob_map
 
 
-def inference_prob_recurrent(images, cams, depth_num, depth_start, depth_interval, is_master_gpu=True):
-    """ infer disparity image from stereo images and cameras """
+# batch normalization layers of RegNetUS0, the inputs of a group only depend on the previous groups
+REG_NET_BN_GROUPS = [['3dconv0_1/bn', '3dconv1_0/bn'],
+                     ['3dconv1_1/bn', '3dconv2_0/bn'],
+                     ['3dconv2_1/bn', '3dconv3_0/bn'],
+                     ['3dconv3_1/bn'],
+                     ['3dconv4_0/bn'],
+                     ['3dconv5_0/bn'],
+                     ['3dconv6_0/bn']]
+# receptive field radius of RegNetUS0 in cost volume pixels, a multiple of its downsampling (8)
+REG_NET_TILE_HALO = 32
+
+def inference_mem_tiled(images, cams, depth_num, depth_start, depth_interval, tile_size,
+                        tile_halo=REG_NET_TILE_HALO, is_master_gpu=True, cost_metric='variance', group_num=8,
+                        cost_dtype=tf.float32):
+    """ infer depth image like inference_mem, regularizing the cost volume in tiles of tile_size
+        cost volume pixels (multiple of 8) with tile_halo pixels of context on each side """
+    if tile_size <= 0 or tile_size % 8 != 0:
+        raise ValueError('Tile size of %d cost volume pixels, not a multiple of 8.' % tile_size)
 
     # dynamic gpu params
     depth_end = depth_start + (tf.cast(depth_num, tf.float32) - 1) * depth_interval
@@ -260,16 +352,18 @@ def inference_prob_recurrent(images, cams, depth_num, depth_start, depth_interva
     ref_image = tf.squeeze(tf.slice(images, [0, 0, 0, 0, 0], [-1, 1, -1, -1, 3]), axis=1)
     ref_cam = tf.squeeze(tf.slice(cams, [0, 0, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
 
-    # image feature extraction    
+    # image feature extraction on the whole images
     if is_master_gpu:
         ref_tower = UNetDS2GN({'data': ref_image}, is_training=True, reuse=False)
     else:
         ref_tower = UNetDS2GN({'data': ref_image}, is_training=True, reuse=True)
-    view_towers = []
+    ref_feature = ref_tower.get_output()
+
+    view_features = []
     for view in range(1, FLAGS.view_num):
         view_image = tf.squeeze(tf.slice(images, [0, view, 0, 0, 0], [-1, 1, -1, -1, -1]), axis=1)
         view_tower = UNetDS2GN({'data': view_image}, is_training=True, reuse=True)
-        view_towers.append(view_tower)
+        view_features.append(view_tower.get_output())
 
     # get all homographies
     view_homographies = []
@@ -279,14 +373,264 @@ def inference_prob_recurrent(images, cams, depth_num, depth_start, depth_interva
                                         depth_start=depth_start, depth_interval=depth_interval)
         view_homographies.append(homographies)
 
+    # tile grid, the core of each tile is extended by the halo
+    feature_shape = tf.shape(ref_feature)
+    height = feature_shape[1]
+    width = feature_shape[2]
+    tile_cols = (width + tile_size - 1) // tile_size
+    tile_num = ((height + tile_size - 1) // tile_size) * tile_cols
+
+    def tile_bounds(tile):
+        core_h = (tile // tile_cols) * tile_size
+        core_w = (tile % tile_cols) * tile_size
+        core = [core_h, core_w, tf.minimum(core_h + tile_size, height), tf.minimum(core_w + tile_size, width)]
+        bounds = [tf.maximum(core[0] - tile_halo, 0), tf.maximum(core[1] - tile_halo, 0),
+                  tf.minimum(core[2] + tile_halo, height), tf.minimum(core[3] + tile_halo, width)]
+        return bounds, core
+
+    def tile_cost_volume(bounds):
+        """ cost volume of the tile, size of (B, D, h, w, C) """
+        start_h, start_w, end_h, end_w = bounds
+        ref_tile = tf.expand_dims(ref_feature[:, start_h:end_h, start_w:end_w], axis=1)
+        warped_view_features = []
+        for view in range(0, FLAGS.view_num - 1):
+            homographies = offset_homographies(view_homographies[view], start_w, start_h)
+            # one plane at a time, a batched warp would copy the whole view feature for each plane
+            warped_view_feature = tf.map_fn(
+                lambda homography, view=view: tf_transform_homography(
+                    view_features[view], homography, output_shape=[end_h - start_h, end_w - start_w]),
+                tf.transpose(homographies, perm=[1, 0, 2, 3]), back_prop=False)
+            warped_view_feature = tf.transpose(warped_view_feature, perm=[1, 0, 2, 3, 4])
+            warped_view_feature.set_shape(ref_tile.get_shape()[:1].concatenate(
+                [depth_num, None, None, ref_feature.get_shape()[-1]]))
+            warped_view_features.append(warped_view_feature)
+        return matching_cost(ref_tile, warped_view_features, cost_metric, group_num, cost_dtype)
+
+    # batch normalization statistics of the whole cost volume (RegNetUS0 normalizes with the batch
+    # statistics), accumulated over the tile cores one group of layers after another
+    bn_stats = {}
+    reuse = not is_master_gpu
+    with tf.name_scope('tiled_bn_statistics'):
+        for bn_group in REG_NET_BN_GROUPS:
+
+            def stats_body(tile, tile_stats):
+                """Loop body."""
+                bounds, core = tile_bounds(tile)
+                tower = RegNetUS0({'data': tile_cost_volume(bounds)}, is_training=True, reuse=reuse,
+                                  bn_stats=bn_stats)
+                new_tile_stats = []
+                for name, layer_stats in zip(bn_group, tile_stats):
+                    bn_input = tower.bn_inputs[name]
+                    # the tile core at the resolution of the layer
+                    scale = (bounds[2] - bounds[0]) // tf.shape(bn_input)[2]
+                    core_input = bn_input[:, :, (core[0] - bounds[0]) // scale:(core[2] - bounds[0]) // scale,
+                                          (core[1] - bounds[1]) // scale:(core[3] - bounds[1]) // scale]
+                    core_input = tf.cast(core_input, tf.float64)
+                    count = tf.cast(tf.size(core_input), tf.float64) / tf.cast(tf.shape(core_input)[-1], tf.float64)
+                    layer_stats = layer_stats.write(tile, tf.stack([
+                        tf.reduce_sum(core_input, axis=[0, 1, 2, 3]),
+                        tf.reduce_sum(tf.square(core_input), axis=[0, 1, 2, 3]),
+                        tf.ones_like(core_input[0, 0, 0, 0]) * count]))
+                    new_tile_stats.append(layer_stats)
+                return tile + 1, new_tile_stats
+
+            tile_stats = [tf.TensorArray(tf.float64, size=tile_num) for _ in bn_group]
+            _, tile_stats = tf.while_loop(
+                lambda tile, *_: tf.less(tile, tile_num), stats_body, [tf.constant(0), tile_stats],
+                back_prop=False, parallel_iterations=1)
+            for name, layer_stats in zip(bn_group, tile_stats):
+                layer_sums = tf.reduce_sum(layer_stats.stack(), axis=0)
+                mean = layer_sums[0] / layer_sums[2]
+                variance = layer_sums[1] / layer_sums[2] - tf.square(mean)
+                bn_stats[name] = (tf.cast(mean, tf.float32), tf.cast(variance, tf.float32))
+            reuse = True
+
+    # depth values of the soft argmin
+    soft_2d = []
+    for i in range(FLAGS.batch_size):
+        soft_1d = tf.linspace(depth_start[i], depth_end[i], tf.cast(depth_num, tf.int32))
+        soft_2d.append(soft_1d)
+    soft_2d = tf.reshape(tf.stack(soft_2d, axis=0), [FLAGS.batch_size, depth_num, 1, 1])
+
+    def tile_body(tile, estimated_depth_map, prob_map):
+        """Loop body."""
+        bounds, core = tile_bounds(tile)
+
+        # filtered cost volume, size of (B, D, h, w, 1)
+        filtered_cost_volume_tower = RegNetUS0({'data': tile_cost_volume(bounds)}, is_training=True,
+                                               reuse=True, bn_stats=bn_stats)
+        filtered_cost_volume = tf.cast(tf.squeeze(filtered_cost_volume_tower.get_output(), axis=-1), tf.float32)
+
+        # depth map by softArgmin
+        probability_volume = tf.nn.softmax(tf.scalar_mul(-1, filtered_cost_volume),
+                                           axis=1, name='prob_volume')
+        volume_shape = tf.shape(probability_volume)
+        soft_4d = tf.tile(soft_2d, [1, 1, volume_shape[2], volume_shape[3]])
+        tile_depth_map = tf.expand_dims(tf.reduce_sum(soft_4d * probability_volume, axis=1), axis=3)
+        tile_prob_map = get_propability_map(probability_volume, tile_depth_map, depth_start, depth_interval)
+        tile_prob_map.set_shape(tile_depth_map.get_shape())
+
+        # paste the tile core
+        core_paddings = [[0, 0], [core[0], height - core[2]], [core[1], width - core[3]], [0, 0]]
+        core_h = [core[0] - bounds[0], core[2] - bounds[0]]
+        core_w = [core[1] - bounds[1], core[3] - bounds[1]]
+        tile_depth_map = tile_depth_map[:, core_h[0]:core_h[1], core_w[0]:core_w[1]]
+        tile_prob_map = tile_prob_map[:, core_h[0]:core_h[1], core_w[0]:core_w[1]]
+        estimated_depth_map = estimated_depth_map + tf.pad(tile_depth_map, core_paddings)
+        prob_map = prob_map + tf.pad(tile_prob_map, core_paddings)
+        return tile + 1, estimated_depth_map, prob_map
+
+    map_shape = tf.stack([feature_shape[0], height, width, 1])
+    with tf.name_scope('tiled_regularization'):
+        _, estimated_depth_map, prob_map = tf.while_loop(
+            lambda tile, *_: tf.less(tile, tile_num), tile_body,
+            [tf.constant(0), tf.zeros(map_shape), tf.zeros(map_shape)],
+            back_prop=False, parallel_iterations=1)
+
+    return estimated_depth_map, prob_map
+
+def regularize_depth_hypotheses(ref_feature, view_features, cams, depth_hypotheses, reuse=False,
+                                cost_metric='variance', group_num=8, cost_dtype=tf.float32):
+    """ depth and probability maps of the cost volume sampling the per-pixel depth hypotheses
+        (B, D, H, W), uniformly spaced at each pixel """
+
+    ref_cam = tf.squeeze(tf.slice(cams, [0, 0, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
+
+    # build cost volume by per-pixel homography
+    with tf.name_scope('cost_volume_depth_hypotheses'):
+        warped_view_features = []
+        for view in range(0, FLAGS.view_num - 1):
+            view_cam = tf.squeeze(tf.slice(cams, [0, view + 1, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
+            warped_view_features.append(depth_hypotheses_warping(
+                view_features[view], ref_cam, view_cam, depth_hypotheses))
+        cost_volume = matching_cost(tf.expand_dims(ref_feature, axis=1), warped_view_features,
+                                    cost_metric, group_num, cost_dtype)
+
+    # filtered cost volume, size of (B, D, H, W, 1)
+    filtered_cost_volume_tower = RegNetUS0({'data': cost_volume}, is_training=True, reuse=reuse)
+    filtered_cost_volume = tf.cast(tf.squeeze(filtered_cost_volume_tower.get_output(), axis=-1), tf.float32)
+
+    # depth map by softArgmin over the hypotheses
+    with tf.name_scope('soft_arg_min'):
+        probability_volume = tf.nn.softmax(tf.scalar_mul(-1, filtered_cost_volume),
+                                           axis=1, name='prob_volume')
+        estimated_depth_map = tf.reduce_sum(depth_hypotheses * probability_volume, axis=1)
+        estimated_depth_map = tf.expand_dims(estimated_depth_map, axis=3)
+
+    # probability map
+    hypotheses_start = depth_hypotheses[:, 0]
+    hypotheses_interval = depth_hypotheses[:, 1] - depth_hypotheses[:, 0]
+    prob_map = get_hypotheses_propability_map(
+        probability_volume, estimated_depth_map, hypotheses_start, hypotheses_interval)
+
+    return estimated_depth_map, prob_map
+
+def inference_cascade(images, cams, depth_num, depth_start, depth_interval, coarse_depth_num=64,
+                      fine_depth_num=32, range_scale=2.0, is_master_gpu=True, cost_metric='variance', group_num=8,
+                      cost_dtype=tf.float32, visibility='none'):
+    """ infer depth image by a sweep of coarse_depth_num planes at half the cost volume resolution,
+        then a sweep of fine_depth_num per-pixel hypotheses within range_scale standard deviations
+        of the coarse probability volume around the coarse depth; visibility applies to the coarse sweep """
+
+    # dynamic gpu params
+    depth_end = depth_start + (tf.cast(depth_num, tf.float32) - 1) * depth_interval
+
+    # reference image
+    ref_image = tf.squeeze(tf.slice(images, [0, 0, 0, 0, 0], [-1, 1, -1, -1, 3]), axis=1)
+
+    # image feature extraction    
+    if is_master_gpu:
+        ref_tower = UNetDS2GN({'data': ref_image}, is_training=True, reuse=False)
+    else:
+        ref_tower = UNetDS2GN({'data': ref_image}, is_training=True, reuse=True)
+    ref_feature = ref_tower.get_output()
+    view_features = []
+    for view in range(1, FLAGS.view_num):
+        view_image = tf.squeeze(tf.slice(images, [0, view, 0, 0, 0], [-1, 1, -1, -1, -1]), axis=1)
+        view_tower = UNetDS2GN({'data': view_image}, is_training=True, reuse=True)
+        view_features.append(view_tower.get_output())
+
+    # coarse sweep on the features pooled to half the resolution
+    pool = lambda feature: tf.nn.avg_pool(feature, [1, 2, 2, 1], [1, 2, 2, 1], 'VALID')
+    coarse_cams = tf_scale_cams(cams, 0.5)
+    coarse_interval = (depth_end - depth_start) / (coarse_depth_num - 1)
+    coarse_coefficients = get_view_coefficients(coarse_cams, coarse_depth_num, depth_start, coarse_interval)
+    with tf.name_scope('coarse_cost_volume_homography'):
+        cost_volume = build_cost_volume(pool(ref_feature), [pool(feature) for feature in view_features],
+                                        coarse_coefficients, coarse_depth_num,
+                                        cost_metric=cost_metric, group_num=group_num, cost_dtype=cost_dtype,
+                                        visibility=visibility)
+
+    # RegNetUS0 needs a multiple of 8 pixels, the coarse volume is padded then cropped back
+    coarse_shape = tf.shape(cost_volume)
+    paddings = [[0, 0], [0, 0], [0, -coarse_shape[2] % 8], [0, -coarse_shape[3] % 8], [0, 0]]
+    filtered_cost_volume_tower = RegNetUS0({'data': tf.pad(cost_volume, paddings, 'SYMMETRIC')},
+                                           is_training=True, reuse=not is_master_gpu)
+    filtered_cost_volume = tf.cast(tf.squeeze(filtered_cost_volume_tower.get_output(), axis=-1), tf.float32)
+    filtered_cost_volume = filtered_cost_volume[:, :, :coarse_shape[2], :coarse_shape[3]]
+
+    # coarse depth and its standard deviation under the probability volume
+    with tf.name_scope('coarse_soft_arg_min'):
+        probability_volume = tf.nn.softmax(tf.scalar_mul(-1, filtered_cost_volume), axis=1)
+        coarse_depths = tf.reshape(depth_start, [-1, 1, 1, 1]) + tf.reshape(
+            tf.range(coarse_depth_num, dtype=tf.float32), [1, -1, 1, 1]) * tf.reshape(coarse_interval, [-1, 1, 1, 1])
+        coarse_depth_map = tf.reduce_sum(coarse_depths * probability_volume, axis=1, keepdims=True)
+        coarse_variance = tf.reduce_sum(tf.square(coarse_depths - coarse_depth_map) * probability_volume, axis=1)
+        coarse_maps = tf.stack([tf.squeeze(coarse_depth_map, axis=1), tf.sqrt(coarse_variance)], axis=-1)
+
+    # per-pixel hypotheses at the cost volume resolution, at least depth_interval apart
+    with tf.name_scope('depth_hypotheses'):
+        fine_shape = tf.shape(ref_feature)
+        coarse_maps = tf.compat.v1.image.resize_bilinear(
+            coarse_maps, fine_shape[1:3], half_pixel_centers=True)
+        coarse_depth_map, coarse_deviation = tf.unstack(coarse_maps, axis=-1)
+        depth_start_map = tf.reshape(depth_start, [-1, 1, 1])
+        depth_end_map = tf.reshape(depth_end, [-1, 1, 1])
+        half_range = tf.maximum(range_scale * coarse_deviation,
+                                tf.reshape(depth_interval, [-1, 1, 1]) * (fine_depth_num - 1) / 2.0)
+        half_range = tf.minimum(half_range, (depth_end_map - depth_start_map) / 2)
+        hypotheses_start = tf.minimum(tf.maximum(coarse_depth_map - half_range, depth_start_map),
+                                      depth_end_map - 2 * half_range)
+        hypotheses_interval = 2 * half_range / (fine_depth_num - 1)
+        depth_hypotheses = tf.expand_dims(hypotheses_start, 1) + tf.reshape(
+            tf.range(fine_depth_num, dtype=tf.float32), [1, -1, 1, 1]) * tf.expand_dims(hypotheses_interval, 1)
+
+    # fine sweep
+    return regularize_depth_hypotheses(ref_feature, view_features, cams, depth_hypotheses, True,
+                                       cost_metric, group_num, cost_dtype)
+
+def inference_prob_recurrent(images, cams, depth_num, depth_start, depth_interval, is_master_gpu=True,
+                             depth_chunk=0, cost_metric='variance', group_num=8, bidirectional=False,
+                             view_coefficients=None, visibility='none'):
+    """ infer disparity image from stereo images and cameras, bidirectional returns the probability
+        volumes of the forward and backward (reversed depth order) sweeps over the same costs;
+        view_coefficients are the (B, V - 1, D, 8) homography coefficients of the data pipeline """
+
+    # dynamic gpu params
+    depth_end = depth_start + (tf.cast(depth_num, tf.float32) - 1) * depth_interval
+
+    # reference image
+    ref_image = tf.squeeze(tf.slice(images, [0, 0, 0, 0, 0], [-1, 1, -1, -1, 3]), axis=1)
+
+    # image feature extraction    
+    if is_master_gpu:
+        ref_tower = UNetDS2GN({'data': ref_image}, is_training=True, reuse=False)
+    else:
+        ref_tower = UNetDS2GN({'data': ref_image}, is_training=True, reuse=True)
+    view_towers = []
+    for view in range(1, FLAGS.view_num):
+        view_image = tf.squeeze(tf.slice(images, [0, view, 0, 0, 0], [-1, 1, -1, -1, -1]), axis=1)
+        view_tower = UNetDS2GN({'data': view_image}, is_training=True, reuse=True)
+        view_towers.append(view_tower)
+
+    # get all homographies
+    view_coefficients = get_view_coefficients(cams, depth_num, depth_start, depth_interval, view_coefficients)
+
     gru1_filters = 16
     gru2_filters = 4
     gru3_filters = 2
     feature_shape = [FLAGS.batch_size, FLAGS.max_h/4, FLAGS.max_w/4, 32]
     gru_input_shape = [feature_shape[1], feature_shape[2]]
-    state1 = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], gru1_filters])
-    state2 = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], gru2_filters])
-    state3 = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], gru3_filters])
     conv_gru1 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru1_filters)
     conv_gru2 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru2_filters)
     conv_gru3 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru3_filters)
@@ -294,28 +638,14 @@ def inference_prob_recurrent(images, cams, depth_num, depth_start, depth_interva
     exp_div = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], 1])
     soft_depth_map = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], 1])
 
-    with tf.name_scope('cost_volume_homography'):
-
-        # forward cost volume
+    def gru_sweep(costs):
+        """ probability volume of a sweep over the depth costs """
+        state1 = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], gru1_filters])
+        state2 = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], gru2_filters])
+        state3 = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], gru3_filters])
         depth_costs = []
-        for d in range(depth_num):
-
-            # compute cost (variation metric)
-            ave_feature = ref_tower.get_output()
-            ave_feature2 = tf.square(ref_tower.get_output())
-
-            for view in range(0, FLAGS.view_num - 1):
-                homography = tf.slice(
-                    view_homographies[view], begin=[0, d, 0, 0], size=[-1, 1, 3, 3])
-                homography = tf.squeeze(homography, axis=1)
-                # warped_view_feature = homography_warping(view_towers[view].get_output(), homography)
-                warped_view_feature = tf_transform_homography(view_towers[view].get_output(), homography)
-                ave_feature = ave_feature + warped_view_feature
-                ave_feature2 = ave_feature2 + tf.square(warped_view_feature)
-            ave_feature = ave_feature / FLAGS.view_num
-            ave_feature2 = ave_feature2 / FLAGS.view_num 
-            cost = ave_feature2 - tf.square(ave_feature) 
-            
+        for cost in costs:
+
             # gru
             reg_cost1, state1 = conv_gru1(-cost, state1, scope='conv_gru1')
             reg_cost2, state2 = conv_gru2(reg_cost1, state2, scope='conv_gru2')
@@ -323,15 +653,30 @@ def inference_prob_recurrent(images, cams, depth_num, depth_start, depth_interva
             reg_cost = tf.layers.conv2d(
                 reg_cost3, 1, 3, padding='same', reuse=tf.AUTO_REUSE, name='prob_conv')
             depth_costs.append(reg_cost)
-            
+
         prob_volume = tf.stack(depth_costs, axis=1)
-        prob_volume = tf.nn.softmax(prob_volume, axis=1, name='prob_volume')
+        return tf.nn.softmax(prob_volume, axis=1, name='prob_volume')
+
+    with tf.name_scope('cost_volume_homography'):
+
+        # forward cost volume, the costs of a chunk of planes are built together
+        view_features = [view_tower.get_output() for view_tower in view_towers]
+        cost_chunks = cost_volume_chunks(ref_tower.get_output(), view_features, view_coefficients,
+                                         depth_num, depth_chunk, cost_metric, group_num, visibility=visibility)
+        costs = [cost for cost_chunk in cost_chunks for cost in tf.unstack(cost_chunk, axis=1)]
+        prob_volume = gru_sweep(costs)
+        if bidirectional:
+            # backward sweep over the same costs, from the far plane to the near one
+            backward_prob_volume = gru_sweep(costs[::-1])
+            return prob_volume, backward_prob_volume
 
     return prob_volume
 
 def inference_winner_take_all(images, cams, depth_num, depth_start, depth_end, 
-                              is_master_gpu=True, reg_type='GRU', inverse_depth=False):
-    """ infer disparity image from stereo images and cameras """
+                              is_master_gpu=True, reg_type='GRU', inverse_depth=False,
+                              cost_metric='variance', group_num=8, view_coefficients=None, visibility='none'):
+    """ infer disparity image from stereo images and cameras, view_coefficients are the (B, V - 1, D, 8)
+        homography transform coefficients of the data pipeline, computed from the cameras if None """
 
     if not inverse_depth:
         depth_interval = (depth_end - depth_start) / (tf.cast(depth_num, tf.float32) - 1)
@@ -352,16 +697,19 @@ def inference_winner_take_all(images, cams, depth_num, depth_start, depth_end,
         view_towers.append(view_tower)
 
     # get all homographies
-    view_homographies = []
-    for view in range(1, FLAGS.view_num):
-        view_cam = tf.squeeze(tf.slice(cams, [0, view, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
-        if inverse_depth:
-            homographies = get_homographies_inv_depth(ref_cam, view_cam, depth_num=depth_num,
-                                depth_start=depth_start, depth_end=depth_end)
-        else:
-            homographies = get_homographies(ref_cam, view_cam, depth_num=depth_num,
-                                            depth_start=depth_start, depth_interval=depth_interval)
-        view_homographies.append(homographies)
+    if view_coefficients is not None:
+        view_coefficients = tf.unstack(view_coefficients, FLAGS.view_num - 1, axis=1)
+    else:
+        view_coefficients = []
+        for view in range(1, FLAGS.view_num):
+            view_cam = tf.squeeze(tf.slice(cams, [0, view, 0, 0, 0], [-1, 1, 2, 4, 4]), axis=1)
+            if inverse_depth:
+                homographies = get_homographies_inv_depth(ref_cam, view_cam, depth_num=depth_num,
+                                    depth_start=depth_start, depth_end=depth_end)
+            else:
+                homographies = get_homographies(ref_cam, view_cam, depth_num=depth_num,
+                                                depth_start=depth_start, depth_interval=depth_interval)
+            view_coefficients.append(get_transform_coefficients(homographies))
 
     # gru unit
     gru1_filters = 16
@@ -376,37 +724,42 @@ def inference_winner_take_all(images, cams, depth_num, depth_start, depth_end,
     conv_gru2 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru2_filters)
     conv_gru3 = ConvGRUCell(shape=gru_input_shape, kernel=[3, 3], filters=gru3_filters)
 
-    # initialize variables
-    exp_sum = tf.Variable(tf.zeros(
-        [FLAGS.batch_size, feature_shape[1], feature_shape[2], 1]),
-        name='exp_sum', trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
-    depth_image = tf.Variable(tf.zeros(
-        [FLAGS.batch_size, feature_shape[1], feature_shape[2], 1]),
-        name='depth_image', trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
-    max_prob_image = tf.Variable(tf.zeros(
-        [FLAGS.batch_size, feature_shape[1], feature_shape[2], 1]),
-        name='max_prob_image', trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
-    init_map = tf.zeros([FLAGS.batch_size, feature_shape[1], feature_shape[2], 1])
-
-    # define winner take all loop
-    def body(depth_index, state1, state2, state3, depth_image, max_prob_image, exp_sum, incre):
-        """Loop body."""
+    # loop invariants: the reference terms of the cost, the transform coefficients and visible boxes
+    # of each plane (D, B, 8) and (D, B, 4), and the depth of each plane (B, D)
+    ref_feature = ref_tower.get_output()
+    ref_square = tf.square(ref_feature) if cost_metric == 'variance' else None
+    view_features = [view_tower.get_output() for view_tower in view_towers]
+    view_coefficients = [tf.transpose(coefficients, perm=[1, 0, 2]) for coefficients in view_coefficients]
+    view_boxes = get_view_boxes(ref_feature, view_coefficients, visibility)
+    depth_indices = tf.reshape(tf.cast(tf.range(depth_num), tf.float32), [1, -1])
+    if inverse_depth:
+        inv_depth_start = tf.div(1.0, depth_start)
+        inv_depth_end = tf.div(1.0, depth_end)
+        inv_interval = (inv_depth_start - inv_depth_end) / (tf.cast(depth_num, 'float32') - 1)
+        depth_values = tf.div(1.0, tf.reshape(inv_depth_start, [-1, 1]) -
+                              depth_indices * tf.reshape(inv_interval, [-1, 1]))
+    else:
+        depth_values = tf.reshape(depth_start, [-1, 1]) + depth_indices * tf.reshape(depth_interval, [-1, 1])
+
+    def gru_step(depth_index, states):
+        """ score of the plane depth_index (B, H, W, 1) and the new gru states """
+        state1, state2, state3 = states
 
-        # calculate cost 
-        ave_feature = ref_tower.get_output()
-        ave_feature2 = tf.square(ref_tower.get_output())
+        # calculate cost
+        warped_view_features = []
+        view_masks = [] if visibility == 'cost' else None
         for view in range(0, FLAGS.view_num - 1):
-            homographies = view_homographies[view]
-            homographies = tf.transpose(homographies, perm=[1, 0, 2, 3])
-            homography = homographies[depth_index]
-            # warped_view_feature = homography_warping(view_towers[view].get_output(), homography)
-            warped_view_feature = tf_transform_homography(view_towers[view].get_output(), homography)
-            ave_feature = ave_feature + warped_view_feature
-            ave_feature2 = ave_feature2 + tf.square(warped_view_feature)
-        ave_feature = ave_feature / FLAGS.view_num
-        ave_feature2 = ave_feature2 / FLAGS.view_num
-        cost = ave_feature2 - tf.square(ave_feature)
-        cost.set_shape([FLAGS.batch_size, feature_shape[1], feature_shape[2], 32])
+            boxes = None if view_boxes is None else view_boxes[view][depth_index]
+            if view_masks is not None:
+                view_masks.append(box_masks(boxes, feature_shape[1], feature_shape[2]))
+            warped_view_feature = tf_shift_or_transform(
+                view_features[view], view_coefficients[view][depth_index], boxes)
+            warped_view_feature.set_shape(ref_feature.get_shape())
+            warped_view_features.append(warped_view_feature)
+        cost = matching_cost(ref_feature, warped_view_features, cost_metric, group_num, ref_square=ref_square,
+                             view_masks=view_masks)
+        cost.set_shape([FLAGS.batch_size, feature_shape[1], feature_shape[2],
+                        group_num if cost_metric == 'correlation' else 32])
 
         # gru
         reg_cost1, state1 = conv_gru1(-cost, state1, scope='conv_gru1')
@@ -414,51 +767,40 @@ def inference_winner_take_all(images, cams, depth_num, depth_start, depth_end,
         reg_cost3, state3 = conv_gru3(reg_cost2, state3, scope='conv_gru3')
         reg_cost = tf.layers.conv2d(
             reg_cost3, 1, 3, padding='same', reuse=tf.AUTO_REUSE, name='prob_conv')
-        prob = tf.exp(reg_cost)
-
-        # index
-        d_idx = tf.cast(depth_index, tf.float32) 
-        if inverse_depth:
-            inv_depth_start = tf.div(1.0, depth_start)
-            inv_depth_end = tf.div(1.0, depth_end)
-            inv_interval = (inv_depth_start - inv_depth_end) / (tf.cast(depth_num, 'float32') - 1)
-            inv_depth = inv_depth_start - d_idx * inv_interval
-            depth = tf.div(1.0, inv_depth)
-        else:
-            depth = depth_start + d_idx * depth_interval
-        temp_depth_image = tf.reshape(depth, [FLAGS.batch_size, 1, 1, 1])
-        temp_depth_image = tf.tile(
-            temp_depth_image, [1, feature_shape[1], feature_shape[2], 1])
-
-        # update the best
-        update_flag_image = tf.cast(tf.less(max_prob_image, prob), dtype='float32')
-        new_max_prob_image = update_flag_image * prob + (1 - update_flag_image) * max_prob_image
-        new_depth_image = update_flag_image * temp_depth_image + (1 - update_flag_image) * depth_image
-        max_prob_image = tf.assign(max_prob_image, new_max_prob_image)
-        depth_image = tf.assign(depth_image, new_depth_image)
-
-        # update counter
-        exp_sum = tf.assign_add(exp_sum, prob)
-        depth_index = tf.add(depth_index, incre)
-
-        return depth_index, state1, state2, state3, depth_image, max_prob_image, exp_sum, incre
-    
+        return reg_cost, (state1, state2, state3)
+
+    map_shape = [FLAGS.batch_size, feature_shape[1], feature_shape[2], 1]
+    return winner_take_all_sweep(gru_step, (state1, state2, state3), depth_values, map_shape)
+
+def winner_take_all_sweep(step_fn, states, depth_values, map_shape):
+    """ sweep over the planes of depth_values (B, D), step_fn(depth_index, states) giving the score
+        (B, H, W, 1) of the plane and the new states: the depth map of the highest score and its
+        probability, the softmax of the scores over the planes """
+
+    def body(depth_index, states, best_index, max_prob_image, exp_sum):
+        """Loop body."""
+        score, states = step_fn(depth_index, states)
+        prob = tf.exp(score)
+
+        # update the best plane, its probability and the softmax denominator together
+        update_flag_image = tf.less(max_prob_image, prob)
+        best_index = tf.where(update_flag_image, tf.fill(tf.shape(best_index), depth_index), best_index)
+        max_prob_image = tf.where(update_flag_image, prob, max_prob_image)
+        exp_sum = exp_sum + prob
+        return depth_index + 1, states, best_index, max_prob_image, exp_sum
+
     # run forward loop
-    exp_sum = tf.assign(exp_sum, init_map)
-    depth_image = tf.assign(depth_image, init_map)
-    max_prob_image = tf.assign(max_prob_image, init_map)
-    depth_index = tf.constant(0)
-    incre = tf.constant(1)
-    cond = lambda depth_index, *_: tf.less(depth_index, depth_num)
-    _, state1, state2, state3, depth_image, max_prob_image, exp_sum, incre = tf.while_loop(
-        cond, body
-        , [depth_index, state1, state2, state3, depth_image, max_prob_image, exp_sum, incre]
-        , back_prop=False, parallel_iterations=1)
+    depth_num = tf.shape(depth_values)[1]
+    init_map = tf.zeros(map_shape)
+    _, _, best_index, max_prob_image, exp_sum = tf.while_loop(
+        lambda depth_index, *_: tf.less(depth_index, depth_num), body,
+        [tf.constant(0), states, tf.zeros(map_shape, tf.int32), init_map, init_map],
+        back_prop=False, parallel_iterations=1)
 
     # get output
-    forward_exp_sum = exp_sum + 1e-7
-    forward_depth_map = depth_image
-    return forward_depth_map, max_prob_image / forward_exp_sum
+    depth_map = tf.batch_gather(depth_values, tf.reshape(best_index, [map_shape[0], -1]))
+    depth_map = tf.reshape(depth_map, tf.shape(best_index))
+    return depth_map, max_prob_image / (exp_sum + 1e-7)
 
 def depth_refine(init_depth_map, image, depth_num, depth_start, depth_interval, is_master_gpu=True):
     """ refine depth image with the image """
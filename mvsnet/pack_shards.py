@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Pack a training / validation dataset into shards of pre-decoded samples (see shards.py).
+"""
+
+from __future__ import print_function
+
+import collections
+import os
+import sys
+
+import cv2
+import tensorflow as tf
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+sys.path.append("../")
+from tools.common import Notify
+
+import preprocess
+from preprocess import *
+from pfm import load_pfm_mmap
+from shards import ShardWriter
+
+# dataset to pack
+tf.app.flags.DEFINE_string('dataset', 'blendedmvs',
+                           """Dataset to pack, including 'blendedmvs', 'blendedmvg', 'dtu', 'eth3d' and 'revery'.""")
+tf.app.flags.DEFINE_string('mode', 'training',
+                           """Sample list to pack, 'training' or 'validation'.""")
+tf.app.flags.DEFINE_string('blendedmvs_data_root', '/data/BlendedMVS/dataset_low_res',
+                           """Path to blendedmvs dataset.""")
+tf.app.flags.DEFINE_string('eth3d_data_root', '/data/eth3d/lowres/training/undistorted',
+                           """Path to eth3d dataset.""")
+tf.app.flags.DEFINE_string('dtu_data_root', '/data/dtu',
+                           """Path to dtu dataset.""")
+tf.app.flags.DEFINE_string('revery_data_root', '/data/dtu',
+                           """Path to revery dataset.""")
+tf.app.flags.DEFINE_string('revery_cams_dir', '/data/dtu',
+                           """Path to cameras for revery dataset.""")
+tf.app.flags.DEFINE_string('shard_folder', None,
+                           """Output folder of the shards.""")
+tf.app.flags.DEFINE_integer('shard_size_mb', 1024,
+                            """Maximum size of one shard in MB.""")
+
+# settings used to build the sample list and parse the cameras
+tf.app.flags.DEFINE_integer('view_num', 3,
+                            """Number of images (1 ref image and view_num - 1 view images).""")
+tf.app.flags.DEFINE_integer('max_d', 192,
+                            """Maximum depth step, used for cameras without depth number.""")
+tf.app.flags.DEFINE_float('interval_scale', 1,
+                          """Depth interval scale applied to the parsed cameras.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def gen_sample_list():
+    """ sample paths of the dataset to pack """
+    if FLAGS.dataset == 'blendedmvs':
+        mode = 'training_mvs' if FLAGS.mode == 'training' else FLAGS.mode
+        return gen_blendedmvs_path(FLAGS.blendedmvs_data_root, mode=mode)
+    elif FLAGS.dataset == 'blendedmvg':
+        return gen_blendedmvs_path(FLAGS.blendedmvs_data_root, mode='training_mvg')
+    elif FLAGS.dataset == 'dtu':
+        return gen_dtu_resized_path(FLAGS.dtu_data_root, mode=FLAGS.mode)
+    elif FLAGS.dataset == 'eth3d':
+        return gen_eth3d_path(FLAGS.eth3d_data_root, mode=FLAGS.mode)
+    elif FLAGS.dataset == 'revery':
+        return gen_revery_path(FLAGS.revery_data_root, FLAGS.mode + '_list.txt', FLAGS.revery_cams_dir)
+    print(Notify.FAIL, 'Unknown dataset', FLAGS.dataset, Notify.ENDC)
+    exit(-1)
+
+def load_depth(path):
+    if preprocess.revery_opts.read_png_depth:
+        return load_depth_packed_png(path)
+    return load_pfm_mmap(path)
+
+def load_shard_cam(path):
+    return load_cam(open(path), FLAGS.interval_scale)
+
+def main(argv=None):  # pylint: disable=unused-argument
+    """ program entrance """
+    if FLAGS.shard_folder is None:
+        print(Notify.FAIL, 'Please specify --shard_folder.', Notify.ENDC)
+        exit(-1)
+    if not os.path.isdir(FLAGS.shard_folder):
+        os.makedirs(FLAGS.shard_folder)
+
+    # group the samples by scene (folder of the reference image)
+    scenes = collections.OrderedDict()
+    for paths in gen_sample_list():
+        scenes.setdefault(os.path.dirname(paths[0]), []).append(paths)
+    print(Notify.INFO, 'Packing %d scenes to %s' % (len(scenes), FLAGS.shard_folder), Notify.ENDC)
+
+    load_fns = {'image': cv2.imread, 'cam': load_shard_cam, 'depth': load_depth}
+    settings = {'view_num': FLAGS.view_num,
+                'max_d': FLAGS.max_d,
+                'interval_scale': FLAGS.interval_scale,
+                'read_png_depth': preprocess.revery_opts.read_png_depth}
+    for scene_index, scene_folder in enumerate(scenes):
+        print(Notify.INFO, 'Scene %d/%d: %s' % (scene_index + 1, len(scenes), scene_folder), Notify.ENDC)
+        writer = ShardWriter(FLAGS.shard_folder, '%s_%05d' % (FLAGS.mode, scene_index), load_fns,
+                             settings, FLAGS.shard_size_mb * 1024 * 1024)
+        for paths in scenes[scene_folder]:
+            writer.add(paths)
+        writer.flush()
+
+
+if __name__ == '__main__':
+    tf.app.run()
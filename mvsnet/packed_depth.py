@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Codec of the ReVeRy packed disparity maps.
+
+A disparity d is stored in an 8-bit RGBA png as the 32 bit fixed point number
+N = d * 2^19 with the bytes R (most significant), G, B, A, i.e.
+
+    d = 32 * (r + g / 2^8 + b / 2^16 + a / 2^24)
+
+and converted to depth with depth = numerator / d, the numerator being baseline x focal
+length in pixels (REVERY_DISPARITY_NUMERATOR, see mvsnet_wrapper/cams.py).
+"""
+
+from __future__ import print_function
+
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+DISPARITY_SCALE = 2.0 ** 19
+
+
+def check_disparity_numerator(numerator):
+    """ the disparity to depth numerator must be a positive finite number """
+    if numerator is None or not np.isfinite(numerator) or numerator <= 0:
+        raise Exception('Invalid disparity numerator %r, please set REVERY_DISPARITY_NUMERATOR.' % numerator)
+    return numerator
+
+def _packed_fixed_point(packed):
+    """ float32 fixed point value N of a packed BGRA image """
+    if packed is None or packed.dtype != np.uint8 or packed.ndim != 3 or packed.shape[2] != 4:
+        raise Exception('Not a packed disparity map (8-bit BGRA image expected).')
+    # r, g, b, a bytes are a big-endian uint32
+    rgba = cv2.cvtColor(packed, cv2.COLOR_BGRA2RGBA)
+    return rgba.view('>u4')[:, :, 0].astype(np.float32)
+
+def decode_packed_disparity(packed):
+    """ H x W x 4 uint8 BGRA image to float32 disparity """
+    disparity = _packed_fixed_point(packed)
+    disparity *= np.float32(1.0 / DISPARITY_SCALE)
+    return disparity
+
+def decode_packed_depth(packed, numerator):
+    """ H x W x 4 uint8 BGRA image to float32 depth, zero disparity gives infinite depth """
+    depth_image = _packed_fixed_point(packed)
+    with np.errstate(divide='ignore'):
+        np.divide(np.float32(numerator * DISPARITY_SCALE), depth_image, out=depth_image)
+    return depth_image
+
+def encode_packed_disparity(disparity):
+    """ disparity to H x W x 4 uint8 BGRA image, negative and invalid values are stored as 0 """
+    disparity = np.nan_to_num(np.asarray(disparity, dtype=np.float64))
+    fixed_point = np.clip(np.rint(disparity * DISPARITY_SCALE), 0, 2 ** 32 - 1).astype('>u4')
+    rgba = fixed_point.reshape(fixed_point.shape + (1,)).view(np.uint8)
+    return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA)
+
+def depth_to_disparity(depth_image, numerator):
+    """ disparity of the depth map, zero depth gives zero disparity """
+    depth_image = np.asarray(depth_image, dtype=np.float64)
+    disparity = np.zeros(depth_image.shape, dtype=np.float64)
+    valid = depth_image > 0
+    disparity[valid] = numerator / depth_image[valid]
+    return disparity
+
+def read_packed_depth(path, numerator):
+    """ read a packed disparity png as a float32 depth map """
+    check_disparity_numerator(numerator)
+    packed = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if packed is None:
+        raise Exception('Failed to read %s' % path)
+    return decode_packed_depth(packed, numerator)
+
+def write_packed_depth(path, depth_image, numerator):
+    """ write a depth map (H x W or H x W x 1) as a packed disparity png """
+    check_disparity_numerator(numerator)
+    depth_image = np.asarray(depth_image)
+    if depth_image.ndim == 3:
+        depth_image = depth_image[:, :, 0]
+    if not cv2.imwrite(path, encode_packed_disparity(depth_to_disparity(depth_image, numerator))):
+        raise Exception('Failed to write %s' % path)
+
+def read_packed_depth_batch(paths, numerator, num_threads=4):
+    """ read many packed disparity pngs, decoding in threads (cv2 releases the GIL) """
+    check_disparity_numerator(numerator)
+    if num_threads <= 1:
+        return [read_packed_depth(path, numerator) for path in paths]
+    pool = ThreadPool(num_threads)
+    try:
+        return pool.map(lambda path: read_packed_depth(path, numerator), paths)
+    finally:
+        pool.close()
+        pool.join()
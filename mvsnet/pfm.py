@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Zero-copy PFM reader and writer.
+
+load_pfm_mmap returns a read-only view into the mapped file (rows flipped with a negative
+stride), pages are only read from disk when the values are used. write_pfm_direct writes
+the rows straight from the array memory instead of building a flipped copy and a string.
+"""
+
+from __future__ import print_function
+
+import re
+
+import numpy as np
+
+
+def read_pfm_header(pfm_file):
+    """ parse the header of a PFM file opened in binary mode, return (shape, dtype, scale) """
+    header = pfm_file.readline().decode('UTF-8').rstrip()
+    if header == 'PF':
+        color = True
+    elif header == 'Pf':
+        color = False
+    else:
+        raise Exception('Not a PFM file.')
+    dim_match = re.match(r'^(\d+)\s(\d+)\s$', pfm_file.readline().decode('UTF-8'))
+    if dim_match:
+        width, height = map(int, dim_match.groups())
+    else:
+        raise Exception('Malformed PFM header.')
+    scale = float(pfm_file.readline().decode('UTF-8').rstrip())
+    # negative scale for little-endian data
+    dtype = np.dtype('<f4') if scale < 0 else np.dtype('>f4')
+    shape = (height, width, 3) if color else (height, width)
+    return shape, dtype, abs(scale)
+
+def load_pfm_mmap(path):
+    """ read-only float32 view of a PFM file, same values as load_pfm without copying """
+    with open(path, 'rb') as pfm_file:
+        shape, dtype, _ = read_pfm_header(pfm_file)
+        offset = pfm_file.tell()
+    data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape).view(np.ndarray)
+    # rows are stored from bottom to top
+    data = data[::-1]
+    if not dtype.isnative:
+        data = data.astype(np.float32)
+    return data
+
+def write_pfm_direct(path, image, scale=1):
+    """ write a float32 H x W (x 1 or 3) image as little-endian PFM without building a copy """
+    if image.dtype.name != 'float32':
+        raise Exception('Image dtype must be float32.')
+    if len(image.shape) == 3 and image.shape[2] == 3: # color image
+        color = True
+    elif len(image.shape) == 2 or len(image.shape) == 3 and image.shape[2] == 1: # greyscale
+        color = False
+        image = image.reshape(image.shape[0:2])
+    else:
+        raise Exception('Image must have H x W x 3, H x W x 1 or H x W dimensions.')
+
+    header = '%s\n%d %d\n%f\n' % ('PF' if color else 'Pf', image.shape[1], image.shape[0], -scale)
+    image = np.ascontiguousarray(image, dtype='<f4')
+    with open(path, 'wb') as pfm_file:
+        pfm_file.write(header.encode('UTF-8'))
+        # rows from bottom to top, each written from the array memory
+        pfm_file.writelines(row.data for row in image[::-1])
@@ -23,25 +23,67 @@ import scipy.io
 import urllib
 from tensorflow.python.lib.io import file_io
 
+from pfm import write_pfm_direct
+from packed_depth import read_packed_depth
+
 FLAGS = tf.app.flags.FLAGS
 
-revery_opts = {
-    "image_width": os.environ.get("REVERY_IMAGE_WIDTH"),
-    "image_height": os.environ.get("REVERY_IMAGE_HEIGHT"),
+class Options(dict):
+    """ dict with attribute access """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+def _int_env(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+revery_opts = Options({
+    "image_width": _int_env("REVERY_IMAGE_WIDTH"),
+    "image_height": _int_env("REVERY_IMAGE_HEIGHT"),
     "write_png_depth": os.getenv("REVERY_WRITE_PNG_DEPTH", "False").lower() in ('true', '1', 'yes'),
     "read_png_depth": os.getenv("REVERY_READ_PNG_DEPTH", "False").lower() in ('true', '1', 'yes'),
+    "image_interpolation": os.getenv("REVERY_IMAGE_INTERPOLATION", "linear"),
     "disparity_numerator": float(os.environ.get("REVERY_DISPARITY_NUMERATOR") or "0")
-}
+})
+
+REVERY_INTERPOLATIONS = {'nearest': cv2.INTER_NEAREST,
+                         'linear': cv2.INTER_LINEAR,
+                         'cubic': cv2.INTER_CUBIC,
+                         'area': cv2.INTER_AREA}
+
+# written in each scene of a resized copy once all its files are resized (see resize_revery.py)
+REVERY_RESIZED_MARKER = 'resized.json'
 
 def revery_preprocess_images(image):
     w = revery_opts.image_width
     h = revery_opts.image_height
 
-    if w is not None and h is not None:
-        return cv2.resize(image, dsize=(w, h), interpolation=cv2.INTER_LINEAR)
+    # images of a resized copy are already at the size
+    if w is not None and h is not None and image.shape[0:2] != (h, w):
+        interpolation = REVERY_INTERPOLATIONS[revery_opts.image_interpolation]
+        return cv2.resize(image, dsize=(w, h), interpolation=interpolation)
     else:
         return image
 
+def revery_resized_folder(revery_data_folder, width, height, interpolation):
+    """ folder of the resized copy of a revery dataset """
+    return os.path.join(revery_data_folder, 'resized', '%dx%d_%s' % (width, height, interpolation))
+
+def revery_scene_folder(revery_data_folder, data_name):
+    """ resized copy of a revery scene for REVERY_IMAGE_WIDTH/HEIGHT if it exists, else the scene """
+    w = revery_opts.image_width
+    h = revery_opts.image_height
+
+    if w is not None and h is not None:
+        resized_folder = os.path.join(
+            revery_resized_folder(revery_data_folder, w, h, revery_opts.image_interpolation), data_name)
+        if os.path.isfile(os.path.join(resized_folder, REVERY_RESIZED_MARKER)):
+            return resized_folder
+    return os.path.join(revery_data_folder, data_name)
+
 def center_image(img):
     """ normalize image input """
     img = img.astype(np.float32)
@@ -49,6 +91,12 @@ def center_image(img):
     mean = np.mean(img, axis=(0,1), keepdims=True)
     return (img - mean) / (np.sqrt(var) + 0.00000001)
 
+def writable_cam(cam):
+    """ copy read-only (cached) cameras before modifying them in place """
+    if cam.flags.writeable:
+        return cam
+    return np.copy(cam)
+
 def scale_camera(cam, scale=1):
     """ resize input in order to produce sampled depth map """
     new_cam = np.copy(cam)
@@ -112,6 +160,7 @@ def crop_mvs_input(images, cams, depth_image=None, max_w=0, max_h=0):
         finish_h = start_h + new_h
         finish_w = start_w + new_w
         images[view] = images[view][start_h:finish_h, start_w:finish_w]
+        cams[view] = writable_cam(cams[view])
         cams[view][1][0][2] = cams[view][1][0][2] - start_w
         cams[view][1][1][2] = cams[view][1][1][2] - start_h
 
@@ -196,23 +245,8 @@ def load_depth_packed_png(filename):
 
     print("\033[1;35m[DEBUG] Loading disparity map: '" + str(filename) + "'...\033[0m")
 
-    # Fonction readPacked() du disparity_reader.py
-    tmp = cv2.imread(filename, -1)
-
-    try:
-        # print(path)
-        b, g, r, a = cv2.split(tmp)
-
-    except:
-        print(path)
-        exit(1)
-
-    res = r + g / 256.0 + b / (256.0 * 256.0) + a / (256.0 * 256.0 * 256.0)
-    disparity_map = 32 * res
-
-    depth_map = revery_opts.disparity_numerator / disparity_map
-
-    return depth_map
+    # Fonction readPacked() du disparity_reader.py, float32 (see packed_depth.py)
+    return read_packed_depth(filename, revery_opts.disparity_numerator)
 
 def load_pfm(file):
 
@@ -254,6 +288,13 @@ def write_pfm(file, image, scale=1):
 
     print("\033[1;35m[DEBUG] Writing PFM image: '" + file + "'...\033[0m")
 
+    if not '://' in file:
+        # local file, written straight from the array buffer
+        write_pfm_direct(file, image, scale)
+        if revery_opts.write_png_depth:
+            cv2.imwrite(file + ".png", image)
+        return
+
     file = file_io.FileIO(file, mode='wb')
     color = None
 
@@ -668,7 +709,8 @@ def gen_revery_path(revery_data_folder, list_path, cams_dir):
     revery_input_list = []
     for data_name in proj_list:
 
-        dataset_folder = os.path.join(revery_data_folder, data_name)
+        # Copie redimensionnée de la scène si elle existe (voir resize_revery.py)
+        dataset_folder = revery_scene_folder(revery_data_folder, data_name)
 
         # get per-image info
         for idx in range(0, image_num):
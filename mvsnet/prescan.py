@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Pre-flight scan of a training / validation dataset.
+
+Every file referenced by the sample list is checked once in worker processes (exists,
+decodes, image / depth shapes, camera depth range), then the samples with a missing or
+corrupt file, an invalid reference depth range or inconsistent shapes are quarantined.
+The remaining samples are saved as a sample index (see sample_index.py) to be used with
+--sample_index_folder in train.py and validate.py, the rejected ones in quarantine.json.
+"""
+
+from __future__ import print_function
+
+import collections
+import json
+import multiprocessing as mp
+import os
+import sys
+
+import cv2
+import tensorflow as tf
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+sys.path.append("../")
+from tools.common import Notify
+
+import preprocess
+from preprocess import *
+from pfm import load_pfm_mmap
+from sample_index import save_sample_index
+
+# dataset to scan
+tf.app.flags.DEFINE_string('dataset', 'blendedmvs',
+                           """Dataset to scan, including 'blendedmvs', 'blendedmvg', 'dtu', 'eth3d' and 'revery'.""")
+tf.app.flags.DEFINE_string('mode', 'training',
+                           """Sample list to scan, 'training' or 'validation'.""")
+tf.app.flags.DEFINE_string('blendedmvs_data_root', '/data/BlendedMVS/dataset_low_res',
+                           """Path to blendedmvs dataset.""")
+tf.app.flags.DEFINE_string('eth3d_data_root', '/data/eth3d/lowres/training/undistorted',
+                           """Path to eth3d dataset.""")
+tf.app.flags.DEFINE_string('dtu_data_root', '/data/dtu',
+                           """Path to dtu dataset.""")
+tf.app.flags.DEFINE_string('revery_data_root', '/data/dtu',
+                           """Path to revery dataset.""")
+tf.app.flags.DEFINE_string('revery_cams_dir', '/data/dtu',
+                           """Path to cameras for revery dataset.""")
+tf.app.flags.DEFINE_string('output_folder', None,
+                           """Output folder of the cleaned sample index and the quarantine report.""")
+tf.app.flags.DEFINE_integer('num_workers', mp.cpu_count(),
+                            """Number of processes checking the files.""")
+
+# settings used to build the sample list and parse the cameras
+tf.app.flags.DEFINE_integer('view_num', 3,
+                            """Number of images (1 ref image and view_num - 1 view images).""")
+tf.app.flags.DEFINE_integer('max_d', 192,
+                            """Maximum depth step, used for cameras without depth number.""")
+tf.app.flags.DEFINE_float('interval_scale', 1,
+                          """Depth interval scale applied to the parsed cameras.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def gen_sample_list():
+    """ sample paths of the dataset to scan """
+    if FLAGS.dataset == 'blendedmvs':
+        mode = 'training_mvs' if FLAGS.mode == 'training' else FLAGS.mode
+        return gen_blendedmvs_path(FLAGS.blendedmvs_data_root, mode=mode)
+    elif FLAGS.dataset == 'blendedmvg':
+        return gen_blendedmvs_path(FLAGS.blendedmvs_data_root, mode='training_mvg')
+    elif FLAGS.dataset == 'dtu':
+        return gen_dtu_resized_path(FLAGS.dtu_data_root, mode=FLAGS.mode)
+    elif FLAGS.dataset == 'eth3d':
+        return gen_eth3d_path(FLAGS.eth3d_data_root, mode=FLAGS.mode)
+    elif FLAGS.dataset == 'revery':
+        return gen_revery_path(FLAGS.revery_data_root, FLAGS.mode + '_list.txt', FLAGS.revery_cams_dir)
+    print(Notify.FAIL, 'Unknown dataset', FLAGS.dataset, Notify.ENDC)
+    exit(-1)
+
+def check_file(kind_path):
+    """ (path, error, info) of one file, info is the image / depth shape or the camera depth range """
+    kind, path = kind_path
+    try:
+        if not os.path.isfile(path):
+            return path, 'missing file', None
+        if kind == 'image':
+            image = cv2.imread(path)
+            if image is None:
+                return path, 'image does not decode', None
+            return path, None, image.shape[0:2]
+        if kind == 'cam':
+            cam = load_cam(open(path), FLAGS.interval_scale)
+            return path, None, (float(cam[1][3][0]), float(cam[1][3][3]))
+        if preprocess.revery_opts.read_png_depth:
+            depth_image = load_depth_packed_png(path)
+        else:
+            depth_image = load_pfm_mmap(path)
+        return path, None, depth_image.shape[0:2]
+    except Exception as error:
+        return path, 'failed to read: %s' % error, None
+
+def check_sample(paths, files):
+    """ reasons to quarantine a sample, files maps each path to (error, info) """
+    reasons = []
+    for path in paths:
+        error = files[path][0]
+        if error is not None:
+            reasons.append('%s: %s' % (path, error))
+    if reasons:
+        return reasons
+
+    view_num = (len(paths) - 1) // 2
+    image_shapes = set(tuple(files[paths[2 * view]][1]) for view in range(view_num))
+    if len(image_shapes) > 1:
+        reasons.append('views of different sizes %s' % sorted(image_shapes))
+    # the dtu depth range is set by the training script
+    depth_min, depth_max = files[paths[1]][1]
+    if FLAGS.dataset != 'dtu' and (depth_min <= 0 or depth_max <= depth_min):
+        reasons.append('invalid reference depth range [%f, %f]' % (depth_min, depth_max))
+    return reasons
+
+def main(argv=None):  # pylint: disable=unused-argument
+    """ program entrance """
+    if FLAGS.output_folder is None:
+        print(Notify.FAIL, 'Please specify --output_folder.', Notify.ENDC)
+        exit(-1)
+    if not os.path.isdir(FLAGS.output_folder):
+        os.makedirs(FLAGS.output_folder)
+
+    sample_list = gen_sample_list()
+    print(Notify.INFO, 'Scanning %d samples' % len(sample_list), Notify.ENDC)
+
+    # each file is checked once, source views are shared by the neighbouring samples
+    kinds = ['image', 'cam'] * FLAGS.view_num + ['depth']
+    kind_paths = collections.OrderedDict()
+    for paths in sample_list:
+        for kind, path in zip(kinds, paths):
+            kind_paths[path] = kind
+    pool = mp.Pool(max(FLAGS.num_workers, 1))
+    files = {}
+    try:
+        for index, (path, error, info) in enumerate(pool.imap_unordered(
+                check_file, [(kind, path) for path, kind in kind_paths.items()], chunksize=64)):
+            files[path] = (error, info)
+            if (index + 1) % 10000 == 0:
+                print('Checked %d / %d files' % (index + 1, len(kind_paths)))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    quarantine = []
+    valid_samples = []
+    for paths in sample_list:
+        reasons = check_sample(paths, files)
+        if reasons:
+            quarantine.append({'sample': paths, 'reasons': reasons})
+        else:
+            valid_samples.append(paths)
+
+    # batches need one image / depth size, keep the most common one
+    shape_counts = collections.Counter(
+        (tuple(files[paths[0]][1]), tuple(files[paths[-1]][1])) for paths in valid_samples)
+    clean_list = []
+    if shape_counts:
+        shapes = shape_counts.most_common(1)[0][0]
+        print(Notify.INFO, 'Image size %s, depth size %s' % shapes, Notify.ENDC)
+        for paths in valid_samples:
+            sample_shapes = (tuple(files[paths[0]][1]), tuple(files[paths[-1]][1]))
+            if sample_shapes == shapes:
+                clean_list.append(paths)
+            else:
+                quarantine.append({'sample': paths, 'reasons': [
+                    'image size %s and depth size %s, expected %s and %s' % (sample_shapes + shapes)]})
+
+    report = {'dataset': FLAGS.dataset,
+              'mode': FLAGS.mode,
+              'sample_num': len(sample_list),
+              'valid_sample_num': len(clean_list),
+              'quarantined_sample_num': len(quarantine),
+              'quarantine': quarantine}
+    with open(os.path.join(FLAGS.output_folder, 'quarantine.json'), 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    if clean_list:
+        settings = {'dataset': FLAGS.dataset, 'mode': FLAGS.mode, 'view_num': FLAGS.view_num}
+        save_sample_index(os.path.join(FLAGS.output_folder, 'samples'), clean_list, {'settings': settings})
+    print(Notify.INFO, '%d valid samples, %d quarantined (see %s)' % (
+        len(clean_list), len(quarantine), os.path.join(FLAGS.output_folder, 'quarantine.json')), Notify.ENDC)
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Write a resized copy of a revery dataset, so that the images and depth maps are not resized
+at load time. The copy is saved in <revery_data_root>/resized/<W>x<H>_<interpolation>/ and used
+by gen_revery_path when REVERY_IMAGE_WIDTH/HEIGHT (and REVERY_IMAGE_INTERPOLATION) match.
+Depth maps are resized like revery_preprocess_images does and packed again as disparity pngs.
+"""
+
+from __future__ import print_function
+
+import json
+import multiprocessing as mp
+import os
+import sys
+
+import cv2
+import tensorflow as tf
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+sys.path.append("../")
+from tools.common import Notify
+
+from preprocess import revery_opts, revery_resized_folder, REVERY_INTERPOLATIONS, REVERY_RESIZED_MARKER
+from packed_depth import check_disparity_numerator, read_packed_depth, write_packed_depth
+
+tf.app.flags.DEFINE_string('revery_data_root', '/data/dtu',
+                           """Path to revery dataset.""")
+tf.app.flags.DEFINE_string('list_files', 'training_list.txt,validation_list.txt',
+                           """Comma separated scene lists of the scenes to resize.""")
+tf.app.flags.DEFINE_integer('image_width', revery_opts.image_width,
+                            """Resized width (REVERY_IMAGE_WIDTH by default).""")
+tf.app.flags.DEFINE_integer('image_height', revery_opts.image_height,
+                            """Resized height (REVERY_IMAGE_HEIGHT by default).""")
+tf.app.flags.DEFINE_string('interpolation', revery_opts.image_interpolation,
+                           """Interpolation, including 'nearest', 'linear', 'cubic' and 'area'.""")
+tf.app.flags.DEFINE_float('disparity_numerator', revery_opts.disparity_numerator,
+                          """Disparity to depth numerator (REVERY_DISPARITY_NUMERATOR by default).""")
+tf.app.flags.DEFINE_integer('num_workers', mp.cpu_count(),
+                            """Number of resizing processes.""")
+tf.app.flags.DEFINE_boolean('overwrite', False,
+                            """Resize the scenes that were already resized.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def resize_file(task):
+    """ resize one image or packed depth map, return the error message or None """
+    kind, src_path, dst_path = task
+    try:
+        dsize = (FLAGS.image_width, FLAGS.image_height)
+        interpolation = REVERY_INTERPOLATIONS[FLAGS.interpolation]
+        if kind == 'image':
+            image = cv2.imread(src_path, cv2.IMREAD_UNCHANGED)
+            if image is None:
+                return '%s: image does not decode' % src_path
+            cv2.imwrite(dst_path, cv2.resize(image, dsize=dsize, interpolation=interpolation))
+        else:
+            depth_image = read_packed_depth(src_path, FLAGS.disparity_numerator)
+            depth_image = cv2.resize(depth_image, dsize=dsize, interpolation=interpolation)
+            write_packed_depth(dst_path, depth_image, FLAGS.disparity_numerator)
+    except Exception as error:
+        return '%s: %s' % (src_path, error)
+    return None
+
+def scene_tasks(scene_folder, resized_scene_folder):
+    tasks = []
+    for kind, folder_name in [('image', 'images'), ('depth', 'rendered_depth_maps')]:
+        src_folder = os.path.join(scene_folder, folder_name)
+        dst_folder = os.path.join(resized_scene_folder, folder_name)
+        if not os.path.isdir(dst_folder):
+            os.makedirs(dst_folder)
+        for file_name in sorted(os.listdir(src_folder)):
+            if file_name.endswith('.png'):
+                tasks.append((kind, os.path.join(src_folder, file_name), os.path.join(dst_folder, file_name)))
+    return tasks
+
+def main(argv=None):  # pylint: disable=unused-argument
+    """ program entrance """
+    if FLAGS.image_width is None or FLAGS.image_height is None:
+        print(Notify.FAIL, 'Please specify --image_width and --image_height.', Notify.ENDC)
+        exit(-1)
+    if FLAGS.interpolation not in REVERY_INTERPOLATIONS:
+        print(Notify.FAIL, 'Unknown interpolation', FLAGS.interpolation, Notify.ENDC)
+        exit(-1)
+    check_disparity_numerator(FLAGS.disparity_numerator)
+
+    resized_folder = revery_resized_folder(
+        FLAGS.revery_data_root, FLAGS.image_width, FLAGS.image_height, FLAGS.interpolation)
+    data_names = []
+    for list_file in FLAGS.list_files.split(','):
+        for data_name in open(os.path.join(FLAGS.revery_data_root, list_file)).read().splitlines():
+            if data_name and data_name not in data_names:
+                data_names.append(data_name)
+    print(Notify.INFO, 'Resizing %d scenes to %s' % (len(data_names), resized_folder), Notify.ENDC)
+
+    settings = {'image_width': FLAGS.image_width,
+                'image_height': FLAGS.image_height,
+                'interpolation': FLAGS.interpolation,
+                'disparity_numerator': FLAGS.disparity_numerator}
+    pool = mp.Pool(max(FLAGS.num_workers, 1))
+    try:
+        for index, data_name in enumerate(data_names):
+            resized_scene_folder = os.path.join(resized_folder, data_name)
+            marker_path = os.path.join(resized_scene_folder, REVERY_RESIZED_MARKER)
+            if os.path.isfile(marker_path) and not FLAGS.overwrite:
+                continue
+            if os.path.isfile(marker_path):
+                os.remove(marker_path)
+
+            tasks = scene_tasks(os.path.join(FLAGS.revery_data_root, data_name), resized_scene_folder)
+            errors = [error for error in pool.imap_unordered(resize_file, tasks, chunksize=8) if error]
+            if errors:
+                # without the marker, gen_revery_path keeps using the original scene
+                print(Notify.FAIL, 'Scene %s not resized:\n%s' % (data_name, '\n'.join(errors)), Notify.ENDC)
+                continue
+            with open(marker_path, 'w') as marker_file:
+                json.dump(settings, marker_file)
+            print('Resized scene %d/%d: %s (%d files)' % (index + 1, len(data_names), data_name, len(tasks)))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+if __name__ == '__main__':
+    tf.app.run()
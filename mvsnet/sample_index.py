@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Compact on-disk index of the sample lists built by the gen_*_path functions.
+
+The index saved in <data_root>/sample_index/<name>/ holds each sample as a row of path ids
+(samples.npy, int32) and the deduplicated paths as one utf-8 buffer with offsets
+(path_data.npy, path_offsets.npy). The arrays are memory-mapped at startup, the paths of
+a sample are only built when it is read. The index is rebuilt when the files the list is
+parsed from (pair.txt, list files) or the settings change.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from preprocess import gen_blendedmvs_path, gen_dtu_resized_path, gen_revery_path, \
+    revery_scene_folder, REVERY_RESIZED_MARKER
+
+INDEX_VERSION = 1
+
+BLENDEDMVS_LISTS = {'training_mvs': 'training_list.txt',
+                    'training_mvg': 'BlendedMVG_training.txt',
+                    'validation': 'validation_list.txt'}
+
+
+def _to_bytes(path):
+    return path if isinstance(path, bytes) else path.encode('utf-8')
+
+def _to_str(data):
+    return data if isinstance(data, str) else data.decode('utf-8')
+
+
+class SampleIndex:
+    """ memory-mapped sample list, indexing returns the sample paths as a list """
+    def __init__(self, index_folder):
+        self.index_folder = index_folder
+        self.samples = np.load(os.path.join(index_folder, 'samples.npy'), mmap_mode='r')
+        self.path_offsets = np.load(os.path.join(index_folder, 'path_offsets.npy'), mmap_mode='r')
+        self.path_data = np.load(os.path.join(index_folder, 'path_data.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.samples)
+
+    def path(self, path_id):
+        start, end = self.path_offsets[path_id], self.path_offsets[path_id + 1]
+        return _to_str(self.path_data[start:end].tostring())
+
+    def __getitem__(self, index):
+        return [self.path(path_id) for path_id in self.samples[index]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def _source_stamps(sources):
+    return [[path, os.path.getmtime(path), os.path.getsize(path)] for path in sources]
+
+def save_sample_index(index_folder, sample_list, meta):
+    """ write a sample list (rows of paths of equal length) as an index folder """
+    path_ids = {}
+    paths = []
+    samples = np.empty((len(sample_list), len(sample_list[0])), dtype=np.int32)
+    for sample_id, sample in enumerate(sample_list):
+        for column, path in enumerate(sample):
+            path_id = path_ids.get(path)
+            if path_id is None:
+                path_id = path_ids[path] = len(paths)
+                paths.append(_to_bytes(path))
+            samples[sample_id, column] = path_id
+    path_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in paths], out=path_offsets[1:])
+    path_data = np.frombuffer(b''.join(paths), dtype=np.uint8)
+
+    # write to a temporary folder first, so that an interrupted build is never loaded
+    tmp_folder = index_folder + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    np.save(os.path.join(tmp_folder, 'samples.npy'), samples)
+    np.save(os.path.join(tmp_folder, 'path_offsets.npy'), path_offsets)
+    np.save(os.path.join(tmp_folder, 'path_data.npy'), path_data)
+    with open(os.path.join(tmp_folder, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    if os.path.isdir(index_folder):
+        shutil.rmtree(index_folder)
+    os.rename(tmp_folder, index_folder)
+
+def gen_indexed_path(data_root, sources, gen_fn, *args, **kwargs):
+    """ gen_fn(*args, **kwargs) through the index in data_root/sample_index, sources are the parsed files """
+    view_num = kwargs.pop('view_num')
+    settings = {'gen_fn': gen_fn.__name__,
+                'args': [str(arg) for arg in args],
+                'kwargs': dict((key, str(value)) for key, value in kwargs.items()),
+                'view_num': view_num}
+    key = hashlib.md5(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    index_folder = os.path.join(data_root, 'sample_index', '%s_%s' % (gen_fn.__name__, key))
+    meta = {'version': INDEX_VERSION, 'settings': settings, 'sources': _source_stamps(sources)}
+
+    meta_path = os.path.join(index_folder, 'meta.json')
+    if os.path.isfile(meta_path):
+        with open(meta_path) as meta_file:
+            # compare through json, stored tuples and strings come back as lists and unicode
+            if json.load(meta_file) == json.loads(json.dumps(meta)):
+                return SampleIndex(index_folder)
+        print('Sample index %s is outdated, rebuilding.' % index_folder)
+
+    sample_list = gen_fn(*args, **kwargs)
+    if not sample_list:
+        return sample_list
+    try:
+        save_sample_index(index_folder, sample_list, meta)
+    except (IOError, OSError) as error:
+        print('Failed to save the sample index to %s (%s), using the sample list.' % (index_folder, error))
+        return sample_list
+    print('Saved the index of %d samples to %s' % (len(sample_list), index_folder))
+    return SampleIndex(index_folder)
+
+def gen_blendedmvs_index(blendedmvs_data_folder, view_num, mode='training_mvs'):
+    """ indexed gen_blendedmvs_path """
+    list_path = os.path.join(blendedmvs_data_folder, BLENDEDMVS_LISTS[mode])
+    sources = [list_path] + [os.path.join(blendedmvs_data_folder, data_name, 'cams', 'pair.txt')
+                             for data_name in open(list_path).read().splitlines()]
+    return gen_indexed_path(blendedmvs_data_folder, sources, gen_blendedmvs_path,
+                            blendedmvs_data_folder, mode=mode, view_num=view_num)
+
+def gen_dtu_resized_index(dtu_data_folder, view_num, mode='training'):
+    """ indexed gen_dtu_resized_path """
+    sources = [os.path.join(dtu_data_folder, 'Cameras', 'pair.txt')]
+    return gen_indexed_path(dtu_data_folder, sources, gen_dtu_resized_path,
+                            dtu_data_folder, mode=mode, view_num=view_num)
+
+def gen_revery_index(revery_data_folder, list_path, cams_dir, view_num):
+    """ indexed gen_revery_path """
+    sources = [os.path.join(revery_data_folder, list_path), os.path.join(cams_dir, 'pair.txt')]
+    # the paths change when a resized copy of a scene is added (see resize_revery.py)
+    for data_name in open(os.path.join(revery_data_folder, list_path)).read().splitlines():
+        marker_path = os.path.join(revery_scene_folder(revery_data_folder, data_name), REVERY_RESIZED_MARKER)
+        if os.path.isfile(marker_path):
+            sources.append(marker_path)
+    return gen_indexed_path(revery_data_folder, sources, gen_revery_path,
+                            revery_data_folder, list_path, cams_dir, view_num=view_num)
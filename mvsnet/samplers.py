@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Sample orders of the training and validation generators, resumable from a saved state.
+
+SceneGroupedSampler keeps the samples of a few scenes together (the scene order is shuffled,
+then the samples inside each window of scenes), so that the decoded images and cameras of
+a scene are reused from the caches before being evicted.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+
+from sample_index import SampleIndex
+from shards import ShardSample
+
+
+class ShuffleSampler:
+    """ seeded permutation of the sample indices for each epoch, resumable from (epoch, offset) """
+    def __init__(self, sample_num, seed=0, epoch=0, offset=0):
+        self.sample_num = sample_num
+        self.seed = seed
+        self.epoch = epoch
+        self.offset = offset
+
+    def permutation(self, epoch):
+        # the order of an epoch only depends on the seed and the epoch
+        return np.random.RandomState([self.seed, epoch]).permutation(self.sample_num)
+
+    def __iter__(self):
+        """ sample indices of all epochs, the state is the position after the last index """
+        while True:
+            order = self.permutation(self.epoch)
+            while self.offset < self.sample_num:
+                index = order[self.offset]
+                self.offset += 1
+                yield index
+            self.epoch += 1
+            self.offset = 0
+
+    def state(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'offset': self.offset}
+
+    def load_state(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.offset = state['offset']
+
+
+class SceneGroupedSampler(ShuffleSampler):
+    """ shuffled scenes, the samples of each window of scene_window scenes are shuffled together """
+    def __init__(self, scene_ids, scene_window=1, seed=0, epoch=0, offset=0):
+        ShuffleSampler.__init__(self, len(scene_ids), seed, epoch, offset)
+        self.scene_window = scene_window
+        scene_ids = np.asarray(scene_ids)
+        # sample indices of each scene, in list order
+        order = np.argsort(scene_ids, kind='mergesort')
+        self.scenes = np.split(order, np.flatnonzero(np.diff(scene_ids[order])) + 1) if len(order) else []
+
+    def permutation(self, epoch):
+        random_state = np.random.RandomState([self.seed, epoch])
+        scene_order = random_state.permutation(len(self.scenes))
+        windows = []
+        for start in range(0, len(scene_order), self.scene_window):
+            window = np.concatenate([self.scenes[scene] for scene in scene_order[start:start + self.scene_window]])
+            windows.append(random_state.permutation(window))
+        return np.concatenate(windows) if windows else np.zeros(0, dtype=np.int64)
+
+    def state(self):
+        state = ShuffleSampler.state(self)
+        state['scene_window'] = self.scene_window
+        return state
+
+    def load_state(self, state):
+        ShuffleSampler.load_state(self, state)
+        self.scene_window = state.get('scene_window', self.scene_window)
+
+
+def sample_scene_ids(sample_list):
+    """ scene id of each sample: the shard of a packed sample, the reference image folder otherwise """
+    if isinstance(sample_list, SampleIndex):
+        # reference image path ids of the index, only the distinct paths are built
+        ref_ids, inverse = np.unique(np.asarray(sample_list.samples[:, 0]), return_inverse=True)
+        scene_keys = [os.path.dirname(sample_list.path(ref_id)) for ref_id in ref_ids]
+    else:
+        inverse = np.arange(len(sample_list))
+        scene_keys = [sample.shard_path if isinstance(sample, ShardSample) else os.path.dirname(sample[0])
+                      for sample in sample_list]
+    scene_index = {}
+    key_ids = np.array([scene_index.setdefault(key, len(scene_index)) for key in scene_keys], dtype=np.int64)
+    return key_ids[inverse] if len(key_ids) else key_ids
+
+def make_sampler(sample_list, scene_window=0, seed=0):
+    """ scene-grouped sampler when scene_window > 0, plain shuffle otherwise; packed samples are always
+        grouped by shard (one shard per window by default) so that the shards are read sequentially """
+    if scene_window <= 0 and not isinstance(sample_list, SampleIndex) and \
+            any(isinstance(sample, ShardSample) for sample in sample_list[:1]):
+        scene_window = 1
+    if scene_window > 0:
+        return SceneGroupedSampler(sample_scene_ids(sample_list), scene_window, seed=seed)
+    return ShuffleSampler(len(sample_list), seed=seed)
+
+
+def sampler_state_path(ckpt_path):
+    """ sampler state saved next to a checkpoint (model.ckpt-<step>) """
+    return ckpt_path + '.sampler.json'
+
+def save_sampler_state(ckpt_path, state):
+    with open(sampler_state_path(ckpt_path), 'w') as state_file:
+        json.dump(state, state_file)
+
+def load_sampler_state(ckpt_path):
+    """ state saved with the checkpoint, None for checkpoints saved without it """
+    state_path = sampler_state_path(ckpt_path)
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path) as state_file:
+        return json.load(state_file)
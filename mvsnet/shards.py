@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Packed binary shards of pre-decoded training samples.
+
+A shard file holds the decoded images, parsed cameras and depth maps used by a group of
+samples (usually one scene), so that reading a scene is one large sequential read instead
+of 2 x view_num + 1 small file opens per sample. Layout:
+
+    MVSSHARD | header length (uint64, little-endian) | json header | array payloads
+
+Each payload is aligned to 64 bytes. The header lists the arrays (dtype, shape, offset), the
+samples as rows of array indices [image_0, cam_0, image_1, cam_1, ..., depth] and the
+settings the cameras were parsed with.
+"""
+
+from __future__ import print_function
+
+import collections
+import glob
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+SHARD_MAGIC = b'MVSSHARD'
+SHARD_VERSION = 1
+SHARD_ALIGNMENT = 64
+MAX_OPEN_SHARDS = 4
+
+ShardSample = collections.namedtuple('ShardSample', ['shard_path', 'index'])
+
+
+def _aligned(offset):
+    return (offset + SHARD_ALIGNMENT - 1) // SHARD_ALIGNMENT * SHARD_ALIGNMENT
+
+
+def write_shard(path, arrays, samples, sample_names, settings):
+    """ write arrays and the sample table to a shard file """
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+
+    # payload offsets are relative to the (aligned) end of the header
+    array_info = []
+    offset = 0
+    for array in arrays:
+        array_info.append({'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset = _aligned(offset + array.nbytes)
+    header = {'version': SHARD_VERSION,
+              'settings': settings,
+              'arrays': array_info,
+              'samples': [[int(i) for i in sample] for sample in samples],
+              'sample_names': list(sample_names)}
+    header_bytes = json.dumps(header).encode('utf-8')
+    payload_start = _aligned(len(SHARD_MAGIC) + 8 + len(header_bytes))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as shard_file:
+        shard_file.write(SHARD_MAGIC)
+        shard_file.write(struct.pack('<Q', len(header_bytes)))
+        shard_file.write(header_bytes)
+        for info, array in zip(array_info, arrays):
+            shard_file.write(b'\0' * (payload_start + info['offset'] - shard_file.tell()))
+            array.tofile(shard_file)
+    os.rename(tmp_path, path)
+
+
+class ShardFile:
+    """ memory-mapped shard, arrays are read-only views into the file """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as shard_file:
+            if shard_file.read(len(SHARD_MAGIC)) != SHARD_MAGIC:
+                raise Exception('Not a shard file: %s' % path)
+            header_length = struct.unpack('<Q', shard_file.read(8))[0]
+            self.header = json.loads(shard_file.read(header_length).decode('utf-8'))
+            self.payload_start = _aligned(len(SHARD_MAGIC) + 8 + header_length)
+            if self.header['version'] != SHARD_VERSION:
+                raise Exception('Unsupported shard version %d: %s' % (self.header['version'], path))
+            self.buffer = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.settings = self.header['settings']
+        self.samples = self.header['samples']
+        self.sample_names = self.header['sample_names']
+
+    def __len__(self):
+        return len(self.samples)
+
+    def array(self, index):
+        info = self.header['arrays'][index]
+        dtype = np.dtype(str(info['dtype']))
+        count = int(np.prod(info['shape']))
+        array = np.frombuffer(self.buffer, dtype=dtype, count=count,
+                              offset=self.payload_start + info['offset'])
+        return array.reshape(info['shape'])
+
+    def sample(self, index):
+        """ images, cameras and depth map of one sample """
+        entries = self.samples[index]
+        view_num = (len(entries) - 1) // 2
+        images = [self.array(entries[2 * view]) for view in range(view_num)]
+        # read-only like the cached cameras, copied by the preprocessing before modification
+        cams = [self.array(entries[2 * view + 1]) for view in range(view_num)]
+        depth_image = self.array(entries[2 * view_num])
+        return images, cams, depth_image
+
+
+_open_shards = collections.OrderedDict()
+
+def open_shard(path):
+    """ process-wide cache of the recently used shards """
+    if path in _open_shards:
+        shard = _open_shards.pop(path)
+    else:
+        shard = ShardFile(path)
+        if len(_open_shards) >= MAX_OPEN_SHARDS:
+            _open_shards.popitem(last=False)
+    _open_shards[path] = shard
+    return shard
+
+def read_shard_sample(sample):
+    """ read a ShardSample, same output as reading the sample files """
+    return open_shard(sample.shard_path).sample(sample.index)
+
+def gen_shard_path(shard_folder, **expected_settings):
+    """ list the samples of all shards in a folder, checking the packing settings """
+    shard_paths = sorted(glob.glob(os.path.join(shard_folder, '*.shard')))
+    if not shard_paths:
+        raise Exception('No shard found in %s' % shard_folder)
+    sample_list = []
+    for shard_path in shard_paths:
+        shard = ShardFile(shard_path)
+        for key, value in expected_settings.items():
+            if shard.settings.get(key) != value:
+                raise Exception('Shard %s was packed with %s = %s, expected %s.'
+                                % (shard_path, key, shard.settings.get(key), value))
+        sample_list.extend(ShardSample(shard_path, index) for index in range(len(shard)))
+    return sample_list
+
+
+class ShardWriter:
+    """ pack path samples into shards of bounded size, decoding each file once per shard """
+    def __init__(self, output_folder, name, load_fns, settings, max_shard_bytes):
+        self.output_folder = output_folder
+        self.name = name
+        # load_fns maps 'image', 'cam' and 'depth' to functions reading a path
+        self.load_fns = load_fns
+        self.settings = settings
+        self.max_shard_bytes = max_shard_bytes
+        self.shard_paths = []
+        self._reset()
+
+    def _reset(self):
+        self.arrays = []
+        self.array_index = {}
+        self.samples = []
+        self.sample_names = []
+        self.shard_bytes = 0
+
+    def add(self, paths):
+        """ add one sample given as [image_0, cam_0, image_1, cam_1, ..., depth] paths """
+        kinds = ['image', 'cam'] * ((len(paths) - 1) // 2) + ['depth']
+        new_arrays = collections.OrderedDict()
+        for kind, path in zip(kinds, paths):
+            if path not in self.array_index and path not in new_arrays:
+                array = self.load_fns[kind](path)
+                if array is None:
+                    raise Exception('Failed to read %s' % path)
+                new_arrays[path] = array
+        new_bytes = sum(array.nbytes for array in new_arrays.values())
+
+        # start a new shard when this one is full, files are then decoded again for the new shard
+        if self.samples and self.shard_bytes + new_bytes > self.max_shard_bytes:
+            self.flush()
+            return self.add(paths)
+
+        for path, array in new_arrays.items():
+            self.array_index[path] = len(self.arrays)
+            self.arrays.append(array)
+        self.shard_bytes += new_bytes
+        self.samples.append([self.array_index[path] for path in paths])
+        self.sample_names.append(paths[0])
+
+    def flush(self):
+        if not self.samples:
+            return
+        shard_path = os.path.join(
+            self.output_folder, '%s_%05d.shard' % (self.name, len(self.shard_paths)))
+        write_shard(shard_path, self.arrays, self.samples, self.sample_names, self.settings)
+        print('Wrote %d samples (%.1f MB) to %s' % (
+            len(self.samples), self.shard_bytes / (1024.0 * 1024.0), shard_path))
+        self.shard_paths.append(shard_path)
+        self._reset()
@@ -11,15 +11,21 @@ import time
 import sys
 import math
 import argparse
+import functools
 import numpy as np
 
 import cv2
+import PIL.Image
 import tensorflow as tf
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
 sys.path.append("../")
 from tools.common import Notify
 from preprocess import *
+from data_cache import load_cam_cached, image_cache
+from data_pipeline import *
+from homography_coefficients import linear_depth_values, inverse_depth_values, view_transform_coefficients
+from homography_table import HomographyTable, cam_id
 from model import *
 from loss import *
 
@@ -45,12 +51,44 @@ tf.app.flags.DEFINE_float('sample_scale', 0.25,
                             """Downsample scale for building cost volume (W and H).""")
 tf.app.flags.DEFINE_float('interval_scale', 0.8, 
                             """Downsample scale for building cost volume (D).""")
+tf.app.flags.DEFINE_integer('depth_chunk', 8, 
+                            """Number of depth planes warped together when building the cost volume (0 for all).""")
+tf.app.flags.DEFINE_string('cost_metric', 'variance', 
+                            """Cost volume metric, 'variance' or 'correlation' (group-wise, fewer channels).""")
+tf.app.flags.DEFINE_integer('correlation_groups', 8, 
+                            """Number of feature channel groups of the correlation metric, a divisor of the feature channels.""")
+tf.app.flags.DEFINE_string('visibility', 'none', 
+                            """'warp' to warp the depth planes only inside their visible box, 'cost' to also average only the visible views.""")
+tf.app.flags.DEFINE_string('cost_dtype', 'float32', 
+                            """Data type of the 3DCNNs cost volume and regularization, 'float32', 'float16' or 'bfloat16'.""")
+tf.app.flags.DEFINE_boolean('host_homographies', False, 
+                            """Compute the homography transform coefficients in the data pipeline with NumPy instead of in the graph.""")
+tf.app.flags.DEFINE_string('homography_table', None, 
+                           """Homography transform coefficients table of the --host_homographies (scenes sharing the cameras of one rig), filled by the first scene and saved.""")
+tf.app.flags.DEFINE_boolean('cascade', False, 
+                            """Coarse-to-fine 3DCNNs inference: a coarse sweep at half the cost volume resolution, then per-pixel hypotheses around it.""")
+tf.app.flags.DEFINE_integer('cascade_coarse_d', 64, 
+                            """Number of depth planes of the coarse cascade sweep.""")
+tf.app.flags.DEFINE_integer('cascade_fine_d', 32, 
+                            """Number of per-pixel depth hypotheses of the fine cascade sweep.""")
+tf.app.flags.DEFINE_float('cascade_range_scale', 2.0, 
+                            """Half range of the fine cascade hypotheses, in standard deviations of the coarse depth.""")
+tf.app.flags.DEFINE_integer('tile_size', 0, 
+                            """Regularize the 3DCNNs cost volume in tiles of n x n image pixels (multiple of 32, 0 for the whole volume).""")
 tf.app.flags.DEFINE_float('base_image_size', 8, 
                             """Base image size""")
 tf.app.flags.DEFINE_integer('batch_size', 1, 
                             """Testing batch size.""")
 tf.app.flags.DEFINE_bool('adaptive_scaling', True, 
                             """Let image size to fit the network, including 'scaling', 'cropping'""")
+tf.app.flags.DEFINE_bool('reduced_decode', False, 
+                            """Decode the images at 1/2, 1/4 or 1/8 resolution when the adaptive scale allows it.""")
+tf.app.flags.DEFINE_integer('image_cache_mb', 0,
+                            """Memory budget in MB of the decoded image cache (per process, 0 to disable).""")
+tf.app.flags.DEFINE_integer('image_cache_report', 1000,
+                            """Print the image cache stats every n image reads (0 to disable).""")
+tf.app.flags.DEFINE_boolean('tf_data', False,
+                            """Read the samples with the native tf.data pipeline instead of the python generator.""")
 
 # network architecture
 tf.app.flags.DEFINE_string('regularization', 'GRU',
@@ -62,6 +100,141 @@ tf.app.flags.DEFINE_bool('inverse_depth', True,
 
 FLAGS = tf.app.flags.FLAGS
 
+# homography table of --homography_table, loaded in main
+homography_table = None
+
+def read_image(path):
+    """ decode one input image as BGR """
+    image_file = file_io.FileIO(path, mode='r')
+    image = scipy.misc.imread(image_file, mode='RGB')
+    return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+def read_image_size(path):
+    """ (height, width) of an image, read from its header """
+    with file_io.FileIO(path, mode='rb') as image_file:
+        width, height = PIL.Image.open(image_file).size
+    return height, width
+
+def read_image_reduced(path, factor=1):
+    """ decode one input image as BGR at 1 / factor resolution (jpeg dct scaling) """
+    # cv2.imdecode ignores the reduced flags, remote images are decoded at full resolution
+    if factor == 1 or not os.path.isfile(path):
+        return read_image(path)
+    return cv2.imread(path, REDUCED_DECODE_FLAGS[factor])
+
+REDUCED_DECODE_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2,
+                        4: cv2.IMREAD_REDUCED_COLOR_4,
+                        8: cv2.IMREAD_REDUCED_COLOR_8}
+# one decode function per factor, the image cache is keyed by the decode function
+reduced_image_readers = dict((factor, functools.partial(read_image_reduced, factor=factor))
+                             for factor in [1, 2, 4, 8])
+
+def reduced_decode_factor(resize_scale):
+    """ largest decode reduction keeping the reduced image at least as large as the resized one """
+    factor = 1
+    for reduction in [2, 4, 8]:
+        if reduction * resize_scale <= 1:
+            factor = reduction
+    return factor
+
+def adaptive_resize_scale(image_sizes):
+    """ scale fitting the (height, width) image sizes to max_h x max_w """
+    h_scale = 0
+    w_scale = 0
+    for height, width in image_sizes:
+        height_scale = float(FLAGS.max_h) / height
+        width_scale = float(FLAGS.max_w) / width
+        if height_scale > h_scale:
+            h_scale = height_scale
+        if width_scale > w_scale:
+            w_scale = width_scale
+    if h_scale > 1 or w_scale > 1:
+        print ("max_h, max_w should < W and H!")
+        exit(-1)
+    resize_scale = h_scale
+    if w_scale > h_scale:
+        resize_scale = w_scale
+    return resize_scale
+
+def scale_cropped_image(image, scale_x, scale_y, start_h, start_w, new_h, new_w, out_scale):
+    """ out_scale resize of the (start_h, start_w, new_h, new_w) crop of the image resized by (scale_x, scale_y),
+        sampled from the image in one pass """
+    out_w = int(round(new_w * out_scale))
+    out_h = int(round(new_h * out_scale))
+    # pixel centers: (x_out + 0.5) = ((x + 0.5) * scale - start) * out_scale
+    transform = np.array([[scale_x * out_scale, 0, (0.5 * scale_x - start_w) * out_scale - 0.5],
+                          [0, scale_y * out_scale, (0.5 * scale_y - start_h) * out_scale - 0.5]])
+    return cv2.warpAffine(image, transform, (out_w, out_h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+def sample_depth_values(scaled_cams):
+    """ depth planes of the sweep of mvsnet_pipeline for the sample cameras """
+    depth_start, depth_interval, depth_num = scaled_cams[0][1, 3, 0:3]
+    if FLAGS.regularization == '3DCNNs':
+        return linear_depth_values(depth_start, depth_interval, FLAGS.max_d)
+    depth_num = int(depth_num)
+    if FLAGS.inverse_depth:
+        depth_end = depth_start + (depth_num - 1) * depth_interval
+        return inverse_depth_values(depth_start, depth_end, depth_num)
+    return linear_depth_values(depth_start, depth_interval, depth_num)
+
+def sample_transform_coefficients(scaled_cams, view_ids=None):
+    """ (V - 1, D, 8) homography transform coefficients of the sample cameras, looked up in the
+        homography table by the image ids of the views when given """
+    depth_values = sample_depth_values(scaled_cams)
+    if homography_table is not None and view_ids is not None:
+        return homography_table.coefficients(view_ids[0], view_ids[1:], scaled_cams, depth_values)
+    return view_transform_coefficients(scaled_cams, depth_values)
+
+def fill_views(data):
+    """ sample paths of view_num views, the reference view replaces the missing views """
+    data = list(data[:2 * FLAGS.view_num])
+    return data + data[0:2] * (FLAGS.view_num - len(data) // 2)
+
+def load_sample_tf(paths, position):
+    """ tf.data version of the MVSGenerator sample reading (paths of fill_views) """
+    image_name = tf.strings.split([paths[0]], '/').values[-1]
+    image_index = tf.strings.to_number(tf.strings.regex_replace(image_name, r'\.[^.]*$', ''), tf.int32)
+
+    # read input data
+    images = []
+    cams = []
+    for view in range(FLAGS.view_num):
+        images.append(tf_read_image(paths[2 * view]))
+        cams.append(tf_read_cam(paths[2 * view + 1], FLAGS.interval_scale, FLAGS.max_d))
+    images = tf.stack(images, axis=0)
+    cams = tf.stack(cams, axis=0)
+    cams = tf_set_cam_entry(cams, (1, 3, 2), tf.where(
+        tf.equal(cams[:, 1, 3, 2], 0), tf.fill([FLAGS.view_num], tf.constant(FLAGS.max_d, cams.dtype)), cams[:, 1, 3, 2]))
+
+    # determine a proper scale to resize input 
+    if FLAGS.adaptive_scaling:
+        image_size = tf.cast(tf.shape(images)[1:3], tf.float64)
+        resize_scale = tf.reduce_max(tf.constant([FLAGS.max_h, FLAGS.max_w], tf.float64) / image_size)
+        with tf.control_dependencies([tf.debugging.assert_less_equal(
+                resize_scale, tf.constant(1, tf.float64), message='max_h, max_w should < W and H!')]):
+            images = tf_scale_image(images, scale=resize_scale)
+        cams = tf_scale_cams(cams, scale=resize_scale)
+
+    # crop to fit network
+    image_size = tf.shape(images)[1:3]
+    base_size = tf.cast(tf.ceil(tf.cast(image_size, tf.float64) / FLAGS.base_image_size) * FLAGS.base_image_size, tf.int32)
+    new_size = tf.where(image_size > [FLAGS.max_h, FLAGS.max_w], tf.constant([FLAGS.max_h, FLAGS.max_w]), base_size)
+    croped_images, croped_cams = tf_crop_mvs_input(images, cams, new_size[0], new_size[1])
+
+    # center images
+    centered_images = tf_center_images(croped_images)
+
+    # sample cameras for building cost volume
+    scaled_cams = tf_scale_cams(croped_cams, scale=FLAGS.sample_scale)
+    scaled_images = tf_scale_image(croped_images, scale=FLAGS.sample_scale)
+    if FLAGS.host_homographies:
+        cam_paths = tf.stack([paths[2 * view + 1] for view in range(FLAGS.view_num)])
+        coefficients = tf.py_func(lambda cams, cam_paths: sample_transform_coefficients(
+            cams, [cam_id(path) for path in cam_paths]), [scaled_cams, cam_paths], tf.float32)
+        return (tf.cast(scaled_images, tf.float32), centered_images, tf.cast(scaled_cams, tf.float32),
+                image_index, coefficients)
+    return tf.cast(scaled_images, tf.float32), centered_images, tf.cast(scaled_cams, tf.float32), image_index
+
 class MVSGenerator:
     """ data generator class, tf only accept generator without param """
     def __init__(self, sample_list, view_num):
@@ -80,47 +253,53 @@ class MVSGenerator:
                 image_index = int(os.path.splitext(os.path.basename(data[0]))[0])
                 selected_view_num = int(len(data) / 2)
 
+                # the resize scale only needs the image sizes, the images are then decoded reduced
+                decode_factor = 1
+                if FLAGS.reduced_decode and FLAGS.adaptive_scaling:
+                    view_paths = [data[2 * view] for view in range(min(self.view_num, selected_view_num))]
+                    view_paths += [data[0]] * (self.view_num - len(view_paths))
+                    image_sizes = [read_image_size(path) for path in view_paths]
+                    resize_scale = adaptive_resize_scale(image_sizes)
+                    decode_factor = reduced_decode_factor(resize_scale)
+                decode_fn = reduced_image_readers[decode_factor]
+
                 for view in range(min(self.view_num, selected_view_num)):
-                    image_file = file_io.FileIO(data[2 * view], mode='r')
-                    image = scipy.misc.imread(image_file, mode='RGB')
-                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-                    cam_file = file_io.FileIO(data[2 * view + 1], mode='r')
-                    cam = load_cam(cam_file, FLAGS.interval_scale)
+                    image = image_cache.load(data[2 * view], decode_fn)
+                    cam = load_cam_cached(data[2 * view + 1], FLAGS.interval_scale)
                     if cam[1][3][2] == 0:
+                        cam = writable_cam(cam)
                         cam[1][3][2] = FLAGS.max_d
                     images.append(image)
                     cams.append(cam)
 
                 if selected_view_num < self.view_num:
                     for view in range(selected_view_num, self.view_num):
-                        image_file = file_io.FileIO(data[0], mode='r')
-                        image = scipy.misc.imread(image_file, mode='RGB')
-                        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-                        cam_file = file_io.FileIO(data[1], mode='r')
-                        cam = load_cam(cam_file, FLAGS.interval_scale)
+                        image = image_cache.load(data[0], decode_fn)
+                        cam = load_cam_cached(data[1], FLAGS.interval_scale)
                         images.append(image)
                         cams.append(cam)
                 print ('range: ', cams[0][1, 3, 0], cams[0][1, 3, 1], cams[0][1, 3, 2], cams[0][1, 3, 3])
 
-                # determine a proper scale to resize input 
-                resize_scale = 1
-                if FLAGS.adaptive_scaling:
-                    h_scale = 0
-                    w_scale = 0
+                if decode_factor > 1:
+                    # resize the reduced images to the size of the resized full images
+                    reduced_images = images
+                    scaled_input_images = []
+                    scaled_input_cams = []
                     for view in range(self.view_num):
-                        height_scale = float(FLAGS.max_h) / images[view].shape[0]
-                        width_scale = float(FLAGS.max_w) / images[view].shape[1]
-                        if height_scale > h_scale:
-                            h_scale = height_scale
-                        if width_scale > w_scale:
-                            w_scale = width_scale
-                    if h_scale > 1 or w_scale > 1:
-                        print ("max_h, max_w should < W and H!")
-                        exit(-1)
-                    resize_scale = h_scale
-                    if w_scale > h_scale:
-                        resize_scale = w_scale
-                scaled_input_images, scaled_input_cams = scale_mvs_input(images, cams, scale=resize_scale)
+                        height, width = image_sizes[view]
+                        scaled_size = (int(round(width * resize_scale)), int(round(height * resize_scale)))
+                        scaled_input_images.append(cv2.resize(
+                            reduced_images[view], scaled_size, interpolation=cv2.INTER_LINEAR))
+                        scaled_input_cams.append(scale_camera(cams[view], scale=resize_scale))
+                    # crop_mvs_input crops in place, keep the resized sizes and principal points
+                    scaled_sizes = [image.shape[0:2] for image in scaled_input_images]
+                    scaled_principal_points = [np.copy(cam[1, 0:2, 2]) for cam in scaled_input_cams]
+                else:
+                    # determine a proper scale to resize input 
+                    resize_scale = 1
+                    if FLAGS.adaptive_scaling:
+                        resize_scale = adaptive_resize_scale([image.shape[0:2] for image in images])
+                    scaled_input_images, scaled_input_cams = scale_mvs_input(images, cams, scale=resize_scale)
 
                 # crop to fit network
                 croped_images, croped_cams = crop_mvs_input(scaled_input_images, scaled_input_cams)
@@ -137,12 +316,27 @@ class MVSGenerator:
                 # return mvs input
                 scaled_images = []
                 for view in range(self.view_num):
-                    scaled_images.append(scale_image(croped_images[view], scale=FLAGS.sample_scale))
+                    if decode_factor > 1:
+                        # sampled from the reduced image rather than resized twice
+                        new_h, new_w = croped_images[view].shape[0:2]
+                        start_w, start_h = np.round(scaled_principal_points[view] - real_cams[view][1, 0:2, 2])
+                        scaled_images.append(scale_cropped_image(
+                            reduced_images[view],
+                            float(scaled_sizes[view][1]) / reduced_images[view].shape[1],
+                            float(scaled_sizes[view][0]) / reduced_images[view].shape[0],
+                            int(start_h), int(start_w), new_h, new_w, FLAGS.sample_scale))
+                    else:
+                        scaled_images.append(scale_image(croped_images[view], scale=FLAGS.sample_scale))
                 scaled_images = np.stack(scaled_images, axis=0)
                 croped_images = np.stack(croped_images, axis=0)
                 scaled_cams = np.stack(scaled_cams, axis=0)
                 self.counter += 1
-                yield (scaled_images, centered_images, scaled_cams, image_index) 
+                if FLAGS.host_homographies:
+                    view_ids = [cam_id(path) for path in fill_views(data)[1::2]]
+                    yield (scaled_images, centered_images, scaled_cams, image_index,
+                           sample_transform_coefficients(scaled_cams, view_ids))
+                else:
+                    yield (scaled_images, centered_images, scaled_cams, image_index) 
 
 def mvsnet_pipeline(mvs_list):
 
@@ -155,15 +349,28 @@ def mvsnet_pipeline(mvs_list):
         os.mkdir(output_folder)
 
     # testing set
-    mvs_generator = iter(MVSGenerator(mvs_list, FLAGS.view_num))
-    generator_data_type = (tf.float32, tf.float32, tf.float32, tf.int32)   
-    mvs_set = tf.data.Dataset.from_generator(lambda: mvs_generator, generator_data_type)
-    mvs_set = mvs_set.batch(FLAGS.batch_size)
-    mvs_set = mvs_set.prefetch(buffer_size=1)
+    if FLAGS.tf_data:
+        # samples decoded by a parallel map over the sample indices
+        mvs_set = mvs_dataset([fill_views(data) for data in mvs_list], load_sample_tf)
+        mvs_set = mvs_set.batch(FLAGS.batch_size)
+        mvs_set = mvs_set.prefetch(buffer_size=AUTOTUNE)
+    else:
+        mvs_generator = iter(MVSGenerator(mvs_list, FLAGS.view_num))
+        generator_data_type = (tf.float32, tf.float32, tf.float32, tf.int32)   
+        if FLAGS.host_homographies:
+            generator_data_type += (tf.float32,)
+        mvs_set = tf.data.Dataset.from_generator(lambda: mvs_generator, generator_data_type)
+        mvs_set = mvs_set.batch(FLAGS.batch_size)
+        mvs_set = mvs_set.prefetch(buffer_size=1)
 
     # data from dataset via iterator
     mvs_iterator = mvs_set.make_initializable_iterator()
-    scaled_images, centered_images, scaled_cams, image_index = mvs_iterator.get_next()
+    view_coefficients = None
+    if FLAGS.host_homographies:
+        scaled_images, centered_images, scaled_cams, image_index, view_coefficients = mvs_iterator.get_next()
+        view_coefficients.set_shape(tf.TensorShape([None, FLAGS.view_num - 1, None, 8]))
+    else:
+        scaled_images, centered_images, scaled_cams, image_index = mvs_iterator.get_next()
 
     # set shapes
     scaled_images.set_shape(tf.TensorShape([None, FLAGS.view_num, None, None, 3]))
@@ -185,8 +392,23 @@ def mvsnet_pipeline(mvs_list):
 
     # depth map inference using 3DCNNs
     if FLAGS.regularization == '3DCNNs':
-        init_depth_map, prob_map = inference_mem(
-            centered_images, scaled_cams, FLAGS.max_d, depth_start, depth_interval)
+        if FLAGS.cascade:
+            init_depth_map, prob_map = inference_cascade(
+                centered_images, scaled_cams, FLAGS.max_d, depth_start, depth_interval,
+                FLAGS.cascade_coarse_d, FLAGS.cascade_fine_d, FLAGS.cascade_range_scale,
+                cost_metric=FLAGS.cost_metric, group_num=FLAGS.correlation_groups, cost_dtype=FLAGS.cost_dtype,
+                visibility=FLAGS.visibility)
+        elif FLAGS.tile_size > 0:
+            # the peak memory depends on the tile size instead of the image size
+            init_depth_map, prob_map = inference_mem_tiled(
+                centered_images, scaled_cams, FLAGS.max_d, depth_start, depth_interval,
+                int(FLAGS.tile_size * FLAGS.sample_scale), cost_metric=FLAGS.cost_metric,
+                group_num=FLAGS.correlation_groups, cost_dtype=FLAGS.cost_dtype)
+        else:
+            init_depth_map, prob_map = inference_mem(
+                centered_images, scaled_cams, FLAGS.max_d, depth_start, depth_interval,
+                depth_chunk=FLAGS.depth_chunk, cost_metric=FLAGS.cost_metric, group_num=FLAGS.correlation_groups,
+                cost_dtype=FLAGS.cost_dtype, view_coefficients=view_coefficients, visibility=FLAGS.visibility)
 
         if FLAGS.refinement:
             ref_image = tf.squeeze(tf.slice(centered_images, [0, 0, 0, 0, 0], [-1, 1, -1, -1, 3]), axis=1)
@@ -196,7 +418,9 @@ def mvsnet_pipeline(mvs_list):
     # depth map inference using GRU
     elif FLAGS.regularization == 'GRU':
         init_depth_map, prob_map = inference_winner_take_all(centered_images, scaled_cams, 
-            depth_num, depth_start, depth_end, reg_type='GRU', inverse_depth=FLAGS.inverse_depth)
+            depth_num, depth_start, depth_end, reg_type='GRU', inverse_depth=FLAGS.inverse_depth,
+            cost_metric=FLAGS.cost_metric, group_num=FLAGS.correlation_groups,
+            view_coefficients=view_coefficients, visibility=FLAGS.visibility)
 
     # init option
     init_op = tf.global_variables_initializer()
@@ -261,9 +485,30 @@ def mvsnet_pipeline(mvs_list):
             write_cam(out_ref_cam_path, out_ref_cam)
             total_step += 1
 
+    # the following scenes of the rig look the coefficients up
+    if homography_table is not None and homography_table.modified:
+        homography_table.save()
+        print(Notify.INFO, 'Homography table of %d entries saved to %s'
+              % (len(homography_table), FLAGS.homography_table), Notify.ENDC)
+
 
 def main(_):  # pylint: disable=unused-argument
     """ program entrance """
+    global homography_table
+    image_cache.configure(FLAGS.image_cache_mb * 1024 * 1024, FLAGS.image_cache_report)
+    if FLAGS.host_homographies and (FLAGS.cascade or FLAGS.tile_size > 0):
+        raise Exception('--host_homographies is for the single sweep, not --cascade or --tile_size.')
+    if FLAGS.tile_size > 0 and (FLAGS.tile_size % 32 != 0 or int(FLAGS.tile_size * FLAGS.sample_scale) % 8 != 0):
+        # RegNetUS0 downsamples the cost volume by 8, its deconvolutions only rebuild multiples of 8 pixels
+        raise Exception('--tile_size must be a multiple of 32 image pixels and of 8 cost volume pixels '
+                        '(tile_size * sample_scale = %g).' % (FLAGS.tile_size * FLAGS.sample_scale))
+    if FLAGS.visibility != 'none' and FLAGS.tile_size > 0:
+        raise Exception('--visibility is not supported by the windowed warps of --tile_size.')
+    if FLAGS.homography_table is not None:
+        if not FLAGS.host_homographies:
+            raise Exception('--homography_table looks up the coefficients of --host_homographies.')
+        homography_table = HomographyTable(FLAGS.homography_table)
+
     # generate input path list
     mvs_list = gen_pipeline_mvs_list(FLAGS.dense_folder)
     # mvsnet inference
@@ -8,6 +8,7 @@ from __future__ import print_function
 
 import os
 import time
+import collections
 import sys
 import math
 import argparse
@@ -29,6 +30,15 @@ from preprocess import *
 from model import *
 from loss import * 
 from homography_warping import get_homographies, homography_warping
+from worker_pool import OrderedWorkerPool
+from pfm import load_pfm_mmap
+from data_cache import load_cam_cached, image_cache
+from homography_coefficients import linear_depth_values, view_transform_coefficients
+from homography_table import HomographyTable, cam_id
+from sample_index import SampleIndex, gen_blendedmvs_index, gen_dtu_resized_index, gen_revery_index
+from shards import ShardSample, read_shard_sample, gen_shard_path
+from samplers import ShuffleSampler, make_sampler, load_sampler_state, save_sampler_state
+from data_pipeline import *
 import photometric_augmentation as photaug
 
 # paths
@@ -52,6 +62,10 @@ tf.app.flags.DEFINE_boolean('train_eth3d', False,
                             """Whether to train.""")
 tf.app.flags.DEFINE_boolean('train_revery', False, 
                             """Whether to train.""")
+tf.app.flags.DEFINE_string('shard_folder', None, 
+                           """Path to packed shards of the training set (see pack_shards.py).""")
+tf.app.flags.DEFINE_string('sample_index_folder', None, 
+                           """Path to a cleaned sample index of the training set (see prescan.py).""")
 tf.app.flags.DEFINE_string('log_folder', '/data/tf_log',
                            """Path to store the log.""")
 tf.app.flags.DEFINE_string('model_folder', '/data/tf_model',
@@ -60,6 +74,10 @@ tf.app.flags.DEFINE_integer('ckpt_step', 0,
                             """ckpt step.""")
 tf.app.flags.DEFINE_boolean('use_pretrain', False, 
                             """Whether to train.""")
+tf.app.flags.DEFINE_integer('seed', 0, 
+                            """Seed of the training sample order (restored from the checkpoint when resuming).""")
+tf.app.flags.DEFINE_integer('scene_window', 0, 
+                            """Shuffle the samples of windows of n scenes together for cache reuse (0 to shuffle all).""")
 
 # input parameters
 tf.app.flags.DEFINE_integer('view_num', 3, 
@@ -72,10 +90,20 @@ tf.app.flags.DEFINE_integer('max_h', 512,
                             """Maximum image height when training.""")
 tf.app.flags.DEFINE_float('sample_scale', 0.25, 
                             """Downsample scale for building cost volume.""")
+tf.app.flags.DEFINE_integer('depth_chunk', 0, 
+                            """Number of depth planes warped together when building the cost volume (0 for all).""")
+tf.app.flags.DEFINE_string('cost_metric', 'variance', 
+                            """Cost volume metric, 'variance' or 'correlation' (group-wise, fewer channels).""")
+tf.app.flags.DEFINE_integer('correlation_groups', 8, 
+                            """Number of feature channel groups of the correlation metric, a divisor of the feature channels.""")
+tf.app.flags.DEFINE_string('visibility', 'none', 
+                            """'warp' to warp the depth planes only inside their visible box, 'cost' to also average only the visible views.""")
 
 # network architectures
 tf.app.flags.DEFINE_string('regularization', 'GRU',
                            """Regularization method.""")
+tf.app.flags.DEFINE_boolean('bidirectional_gru', False,
+                           """Train the GRU forward and backward sweeps on the same cost volume in one step.""")
 tf.app.flags.DEFINE_boolean('refinement', False,
                            """Whether to apply depth map refinement for 3DCNNs""")
 
@@ -99,8 +127,27 @@ tf.app.flags.DEFINE_float('gamma', 0.9,
 tf.app.flags.DEFINE_boolean('online_augmentation', False,
                            """Whether to apply image online augmentation during training""")
 
+# data loading parameters
+tf.app.flags.DEFINE_integer('num_workers', 0,
+                            """Number of processes decoding training samples (0 to decode in the generator).""")
+tf.app.flags.DEFINE_integer('worker_queue_size', 8,
+                            """Maximum number of decoded samples waiting in the worker queue.""")
+tf.app.flags.DEFINE_integer('image_cache_mb', 0,
+                            """Memory budget in MB of the decoded image cache (per process, 0 to disable).""")
+tf.app.flags.DEFINE_integer('image_cache_report', 1000,
+                            """Print the image cache stats every n image reads (0 to disable).""")
+tf.app.flags.DEFINE_boolean('tf_data', False,
+                            """Read the samples with the native tf.data pipeline instead of the python generator.""")
+tf.app.flags.DEFINE_boolean('host_homographies', False, 
+                            """Compute the homography transform coefficients in the data pipeline with NumPy instead of in the graph.""")
+tf.app.flags.DEFINE_string('homography_table', None,
+                           """Homography transform coefficients table of the revery cameras (--train_revery), built from the pair.txt and cameras of revery_cams_dir if the file does not exist.""")
+
 FLAGS = tf.app.flags.FLAGS
 
+# dataset-wide homography table, loaded in main before the worker processes are forked
+homography_table = None
+
 
 def online_augmentation(image, random_order=True):
     primitives = photaug.augmentations
@@ -130,94 +177,254 @@ def online_augmentation(image, random_order=True):
 
     return aug_image
 
+def decode_image(path):
+    """ decode and resize one input image """
+    return preprocess.revery_preprocess_images(cv2.imread(path))
+
+def read_sample(data):
+    """ read images, cameras and depth map of one sample (paths or packed shard sample) """
+    if isinstance(data, ShardSample):
+        images, cams, depth_image = read_shard_sample(data)
+        images = [preprocess.revery_preprocess_images(image) for image in images]
+    else:
+        images = []
+        cams = []
+        for view in range(FLAGS.view_num):
+            # source views are shared by the neighbouring samples
+            images.append(image_cache.load(data[2 * view], decode_image))
+            cams.append(load_cam_cached(data[2 * view + 1]))
+    
+        if preprocess.revery_opts.read_png_depth:
+            depth_image = preprocess.load_depth_packed_png(data[2 * FLAGS.view_num])
+        else:
+            depth_image = load_pfm_mmap(data[2 * FLAGS.view_num])
+    depth_image = preprocess.revery_preprocess_images(depth_image)
+    return images, cams, depth_image
+
+def process_cams(cams):
+    """ dataset specified camera process of load_sample (after the eth3d crop) and depth range,
+        return None for invalid samples """
+    if FLAGS.train_blendedmvs:
+        # downsize by 4 to fit depth map output
+        cams = scale_mvs_camera(cams, scale=FLAGS.sample_scale)
+
+    elif FLAGS.train_dtu:
+        # set depth range to [425, 937]
+        cams[0] = writable_cam(cams[0])
+        cams[0][1, 3, 0] = 425
+        cams[0][1, 3, 3] = 937
+
+    elif FLAGS.train_eth3d:
+        # downsize by 4 to fit depth map output
+        cams = scale_mvs_camera(cams, scale=FLAGS.sample_scale)
+
+    # skip invalid views
+    if cams[0][1, 3, 0] <= 0 or cams[0][1, 3, 3] <= 0:
+        return None
+
+    # fix depth range and adapt depth sample number 
+    cams[0] = writable_cam(cams[0])
+    cams[0][1, 3, 2] = FLAGS.max_d
+    cams[0][1, 3, 1] = (cams[0][1, 3, 3] - cams[0][1, 3, 0]) / FLAGS.max_d
+    return cams
+
+def sample_depth_values(cams):
+    """ depth planes of the forward sweep of the sample cameras """
+    return linear_depth_values(cams[0][1, 3, 0], cams[0][1, 3, 1], FLAGS.max_d)
+
+def sample_transform_coefficients(cams):
+    """ (V - 1, D, 8) homography transform coefficients of the forward sweep of the sample cameras """
+    return view_transform_coefficients(cams, sample_depth_values(cams))
+
+def load_sample(data):
+    """ read and preprocess one training sample, return None for invalid samples; the view
+        coefficients are None without --host_homographies or --homography_table """
+
+    ###### read input data ######
+    images, cams, depth_image = read_sample(data)
+    
+    # dataset specified process
+    if FLAGS.train_blendedmvs:
+        # downsize by 4 to fit depth map output
+        depth_image = scale_image(depth_image, scale=FLAGS.sample_scale)
+
+    elif FLAGS.train_dtu:
+        # the depth range is set by process_cams
+        pass
+
+    elif FLAGS.train_eth3d:
+        # crop images
+        images, cams, depth_image = crop_mvs_input(
+            images, cams, depth_image, max_w=FLAGS.max_w, max_h=FLAGS.max_h)
+        # downsize by 4 to fit depth map output
+        depth_image = scale_image(depth_image, scale=FLAGS.sample_scale)
+    
+    else:
+        # raised in the parent process too when loaded by a worker
+        raise Exception('Please specify a valid training dataset.')
+
+    cams = process_cams(cams)
+    if cams is None:
+        return None
+
+    # mask out-of-range depth pixels (in a relaxed range)
+    depth_start = cams[0][1, 3, 0] + cams[0][1, 3, 1]
+    depth_end = cams[0][1, 3, 0] + (FLAGS.max_d - 2) * cams[0][1, 3, 1]
+    depth_image = mask_depth_image(depth_image, depth_start, depth_end)
+
+    # homography coefficients of the forward sweep, packed samples have no camera ids
+    view_coefficients = None
+    if homography_table is not None and not isinstance(data, ShardSample):
+        view_ids = [cam_id(data[2 * view + 1]) for view in range(FLAGS.view_num)]
+        view_coefficients = homography_table.lookup(view_ids[0], view_ids[1:], cams, sample_depth_values(cams))
+    if view_coefficients is None and (FLAGS.host_homographies or homography_table is not None):
+        view_coefficients = sample_transform_coefficients(cams)
+
+    images = np.stack(images, axis=0)
+    cams = np.stack(cams, axis=0)
+    return images, cams, depth_image, view_coefficients
+
+def load_sample_tf(paths, position):
+    """ tf.data version of load_sample, also returns whether the sample is valid """
+
+    ###### read input data ######
+    images = []
+    cams = []
+    for view in range(FLAGS.view_num):
+        images.append(tf_revery_preprocess_images(tf_read_image(paths[2 * view])))
+        cams.append(tf_read_cam(paths[2 * view + 1], max_d=FLAGS.max_d))
+    images = tf.cast(tf.stack(images, axis=0), tf.float32)
+    cams = tf.stack(cams, axis=0)
+    depth_image = tf_revery_preprocess_images(tf_read_depth(paths[2 * FLAGS.view_num]))
+
+    # dataset specified process
+    if FLAGS.train_blendedmvs:
+        # downsize by 4 to fit depth map output
+        depth_image = tf_scale_image(depth_image, scale=FLAGS.sample_scale)
+        cams = tf_scale_cams(cams, scale=FLAGS.sample_scale)
+
+    elif FLAGS.train_dtu:
+        # set depth range to [425, 937]
+        ref_cam = tf_set_cam_entry(cams[0], (1, 3, 0), 425)
+        ref_cam = tf_set_cam_entry(ref_cam, (1, 3, 3), 937)
+        cams = tf.concat([tf.expand_dims(ref_cam, 0), cams[1:]], axis=0)
+
+    elif FLAGS.train_eth3d:
+        # crop images
+        images, cams, depth_image = tf_crop_mvs_input(
+            images, cams, FLAGS.max_h, FLAGS.max_w, depth_image)
+        # downsize by 4 to fit depth map output
+        depth_image = tf_scale_image(depth_image, scale=FLAGS.sample_scale)
+        cams = tf_scale_cams(cams, scale=FLAGS.sample_scale)
+
+    else:
+        raise Exception('Please specify a valid training dataset.')
+
+    # skip invalid views
+    valid = tf.logical_and(cams[0, 1, 3, 0] > 0, cams[0, 1, 3, 3] > 0)
+
+    # fix depth range and adapt depth sample number 
+    ref_cam = tf_set_cam_entry(cams[0], (1, 3, 2), FLAGS.max_d)
+    ref_cam = tf_set_cam_entry(ref_cam, (1, 3, 1), (ref_cam[1, 3, 3] - ref_cam[1, 3, 0]) / FLAGS.max_d)
+    cams = tf.cast(tf.concat([tf.expand_dims(ref_cam, 0), cams[1:]], axis=0), tf.float32)
+
+    # mask out-of-range depth pixels (in a relaxed range)
+    depth_start = ref_cam[1, 3, 0] + ref_cam[1, 3, 1]
+    depth_end = ref_cam[1, 3, 0] + (FLAGS.max_d - 2) * ref_cam[1, 3, 1]
+    depth_image = tf_mask_depth_image(depth_image, depth_start, depth_end)
+    if FLAGS.host_homographies:
+        coefficients = tf.py_func(sample_transform_coefficients, [cams], tf.float32)
+        return images, cams, depth_image, position, coefficients, valid
+    return images, cams, depth_image, position, valid
+
+def gru_passes_tf(images, cams, depth_image, position, view_coefficients=None):
+    """ forward and backward (reversed depth range) passes of a sample, like MVSGenerator """
+    ref_cam = cams[0]
+    backward_cam = tf_set_cam_entry(ref_cam, (1, 3, 0), ref_cam[1, 3, 0] + (FLAGS.max_d - 1) * ref_cam[1, 3, 1])
+    backward_cam = tf_set_cam_entry(backward_cam, (1, 3, 1), -ref_cam[1, 3, 1])
+    backward_cams = tf.concat([tf.expand_dims(backward_cam, 0), cams[1:]], axis=0)
+    passes = (tf.stack([images, images]), tf.stack([cams, backward_cams]),
+              tf.stack([depth_image, depth_image]), tf.stack([position, position]))
+    if view_coefficients is not None:
+        # the backward planes are the forward ones in reverse order
+        passes += (tf.stack([view_coefficients, tf.reverse(view_coefficients, axis=[1])]),)
+    return tf.data.Dataset.from_tensor_slices(passes)
+
 class MVSGenerator:
     """ data generator class, tf only accept generator without param """
-    def __init__(self, sample_list, view_num):
+    def __init__(self, sample_list, view_num, num_workers=0, queue_size=8, sampler=None):
         self.sample_list = sample_list
         self.view_num = view_num
         self.sample_num = len(sample_list)
         self.counter = 0
-    
-    def __iter__(self):
-        while True:
-            for data in self.sample_list: 
-                start_time = time.time()
-
-                ###### read input data ######
-                images = []
-                cams = []
-                for view in range(self.view_num):
-                    image = cv2.imread(data[2 * view])
-                    image = preprocess.revery_preprocess_images(image)
-                    cam = load_cam(open(data[2 * view + 1]))
-                    images.append(image)
-                    cams.append(cam)
-                
-                if preprocess.revery_opts.read_png_depth:
-                    depth_image = preprocess.load_depth_packed_png(data[2 * self.view_num])
-                else:
-                    depth_image = load_pfm(open(data[2 * self.view_num]))
-                
-                depth_image = preprocess.revery_preprocess_images(depth_image)
-                
-                # dataset specified process
-                if FLAGS.train_blendedmvs:
-                    # downsize by 4 to fit depth map output
-                    depth_image = scale_image(depth_image, scale=FLAGS.sample_scale)
-                    cams = scale_mvs_camera(cams, scale=FLAGS.sample_scale)
-
-                elif FLAGS.train_dtu:
-                    # set depth range to [425, 937]
-                    cams[0][1, 3, 0] = 425
-                    cams[0][1, 3, 3] = 937
-
-                elif FLAGS.train_eth3d:
-                    # crop images
-                    images, cams, depth_image = crop_mvs_input(
-                        images, cams, depth_image, max_w=FLAGS.max_w, max_h=FLAGS.max_h)
-                    # downsize by 4 to fit depth map output
-                    depth_image = scale_image(depth_image, scale=FLAGS.sample_scale)
-                    cams = scale_mvs_camera(cams, scale=FLAGS.sample_scale)
-                
-                else:
-                    print ('Please specify a valid training dataset.')
-                    exit(-1)
-		
-                # skip invalid views
-                if cams[0][1, 3, 0] <= 0 or cams[0][1, 3, 3] <= 0:
-                    continue			
+        # sample order, also gives the dataset position saved with the checkpoints
+        self.sampler = sampler if sampler is not None else ShuffleSampler(self.sample_num)
+        self.positions = collections.deque()
+        # samples are decoded in worker processes when num_workers > 0, by one pool per iteration
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.pool = None
+
+    def iter_data(self):
+        for index in self.sampler:
+            # sampler position after this sample, read back in generate in the same order
+            self.positions.append((self.sampler.epoch, self.sampler.offset))
+            yield self.sample_list[index]
 
-                # fix depth range and adapt depth sample number 
-                cams[0][1, 3, 2] = FLAGS.max_d
-                cams[0][1, 3, 1] = (cams[0][1, 3, 3] - cams[0][1, 3, 0]) / FLAGS.max_d
+    def __iter__(self):
+        """ the worker pool is started here, before the generator is first run by the tf.data threads;
+            the pool of a previous iteration is closed """
+        self.close()
+        self.positions.clear()
+        if self.num_workers > 0:
+            self.pool = OrderedWorkerPool(load_sample, self.num_workers, self.queue_size)
+        return self.generate(self.pool)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def generate(self, pool):
+        try:
+            if pool is None:
+                samples = (load_sample(data) for data in self.iter_data())
+            else:
+                samples = pool.imap(self.iter_data())
+
+            for sample in samples:
+                position = np.array(self.positions.popleft(), dtype=np.int64)
 
-                # mask out-of-range depth pixels (in a relaxed range)
-                depth_start = cams[0][1, 3, 0] + cams[0][1, 3, 1]
-                depth_end = cams[0][1, 3, 0] + (FLAGS.max_d - 2) * cams[0][1, 3, 1]
-                depth_image = mask_depth_image(depth_image, depth_start, depth_end)
+                # skip invalid views
+                if sample is None:
+                    continue
 
                 # return mvs input
+                images, cams, depth_image, view_coefficients = sample
                 self.counter += 1
-                duration = time.time() - start_time
-                images = np.stack(images, axis=0)
-                cams = np.stack(cams, axis=0)
                 print('Forward pass: d_min = %f, d_max = %f.' % \
                     (cams[0][1, 3, 0], cams[0][1, 3, 0] + (FLAGS.max_d - 1) * cams[0][1, 3, 1]))
-                
-                #print("[DEBUG]", images, cams, depth_image)
-                #import pdb; pdb.set_trace()
-                yield (images, cams, depth_image) 
+                if view_coefficients is not None:
+                    yield (images, cams, depth_image, position, view_coefficients)
+                else:
+                    yield (images, cams, depth_image, position) 
 
                 # return backward mvs input for GRU
-                if FLAGS.regularization == 'GRU':
+                if FLAGS.regularization == 'GRU' and not FLAGS.bidirectional_gru:
                     self.counter += 1
-                    start_time = time.time()
                     cams[0][1, 3, 0] = cams[0][1, 3, 0] + (FLAGS.max_d - 1) * cams[0][1, 3, 1]
                     cams[0][1, 3, 1] = -cams[0][1, 3, 1]
-                    duration = time.time() - start_time
                     print('Back pass: d_min = %f, d_max = %f.' % \
                         (cams[0][1, 3, 0], cams[0][1, 3, 0] + (FLAGS.max_d - 1) * cams[0][1, 3, 1]))
-                    yield (images, cams, depth_image) 
+                    if view_coefficients is not None:
+                        # the backward planes are the forward ones in reverse order
+                        yield (images, cams, depth_image, position, view_coefficients[:, ::-1])
+                    else:
+                        yield (images, cams, depth_image, position) 
+        finally:
+            # the workers stop with the generator, also when a worker raised
+            if pool is not None:
+                pool.close()
 
 def average_gradients(tower_grads):
     """Calculate the average gradient for each shared variable across all towers.
@@ -257,20 +464,48 @@ def average_gradients(tower_grads):
 def train(traning_list):
     """ training mvsnet """
     training_sample_size = len(traning_list)
-    if FLAGS.regularization == 'GRU':
+    if FLAGS.regularization == 'GRU' and not FLAGS.bidirectional_gru:
         training_sample_size = training_sample_size * 2
     print ('Training sample number: ', training_sample_size)
 
+    # homography coefficients computed in the data pipeline (or looked up in the table)
+    host_coefficients = FLAGS.host_homographies or homography_table is not None
+
+    # sample order, restored with the pre-trained model
+    sampler = make_sampler(traning_list, FLAGS.scene_window, FLAGS.seed)
+    sampler_state = None
+    if FLAGS.use_pretrain:
+        pretrained_model_path = os.path.join(FLAGS.model_folder, FLAGS.regularization, 'model.ckpt')
+        sampler_state = load_sampler_state('-'.join([pretrained_model_path, str(FLAGS.ckpt_step)]))
+        if sampler_state is not None:
+            sampler.load_state(sampler_state)
+            print(Notify.INFO, 'Resuming training data at epoch %d, sample %d (seed %d)'
+                  % (sampler.epoch, sampler.offset, sampler.seed), Notify.ENDC)
+
     with tf.Graph().as_default(), tf.device('/cpu:0'): 
 
         ########## data iterator #########
-        # training generators
-        training_generator = iter(MVSGenerator(traning_list, FLAGS.view_num))
-        generator_data_type = (tf.float32, tf.float32, tf.float32)
-        # dataset from generator
-        training_set = tf.data.Dataset.from_generator(lambda: training_generator, generator_data_type)
-        training_set = training_set.batch(FLAGS.batch_size)
-        training_set = training_set.prefetch(buffer_size=1)
+        if FLAGS.tf_data:
+            # samples decoded by a parallel map over the sample indices
+            training_set = mvs_dataset(traning_list, load_sample_tf, sampler)
+            training_set = training_set.filter(lambda *sample: sample[-1])
+            training_set = training_set.map(lambda *sample: sample[:-1])
+            if FLAGS.regularization == 'GRU' and not FLAGS.bidirectional_gru:
+                training_set = training_set.flat_map(gru_passes_tf)
+            training_set = training_set.batch(FLAGS.batch_size)
+            training_set = training_set.prefetch(buffer_size=AUTOTUNE)
+        else:
+            # training generators
+            mvs_generator = MVSGenerator(traning_list, FLAGS.view_num,
+                                         FLAGS.num_workers, FLAGS.worker_queue_size, sampler)
+            training_generator = iter(mvs_generator)
+            generator_data_type = (tf.float32, tf.float32, tf.float32, tf.int64)
+            if host_coefficients:
+                generator_data_type += (tf.float32,)
+            # dataset from generator
+            training_set = tf.data.Dataset.from_generator(lambda: training_generator, generator_data_type)
+            training_set = training_set.batch(FLAGS.batch_size)
+            training_set = training_set.prefetch(buffer_size=1)
         # iterators
         training_iterator = training_set.make_initializable_iterator()
 
@@ -285,7 +520,13 @@ def train(traning_list):
             with tf.device('/gpu:%d' % i):
                 with tf.name_scope('Model_tower%d' % i) as scope:
                     # get data
-                    images, cams, depth_image = training_iterator.get_next()
+                    view_coefficients = None
+                    if host_coefficients:
+                        images, cams, depth_image, sample_position, view_coefficients = \
+                            training_iterator.get_next()
+                        view_coefficients.set_shape(tf.TensorShape([None, FLAGS.view_num - 1, FLAGS.max_d, 8]))
+                    else:
+                        images, cams, depth_image, sample_position = training_iterator.get_next()
 
                     # photometric augmentation and image normalization 
                     arg_images = []
@@ -314,7 +555,10 @@ def train(traning_list):
 
                         # initial depth map
                         depth_map, prob_map = inference(
-                            images, cams, FLAGS.max_d, depth_start, depth_interval, is_master_gpu)
+                            images, cams, FLAGS.max_d, depth_start, depth_interval, is_master_gpu,
+                            depth_chunk=FLAGS.depth_chunk, cost_metric=FLAGS.cost_metric,
+                            group_num=FLAGS.correlation_groups, view_coefficients=view_coefficients,
+                            visibility=FLAGS.visibility)
 
                         # refinement
                         if FLAGS.refinement:
@@ -332,11 +576,35 @@ def train(traning_list):
                             refined_depth_map, depth_image, depth_interval)
                         loss = (loss0 + loss1) / 2
 
+                    elif FLAGS.regularization == 'GRU' and FLAGS.bidirectional_gru:
+
+                        # probability volumes of both sweeps, the features and costs are computed once
+                        prob_volume, backward_prob_volume = inference_prob_recurrent(
+                            images, cams, FLAGS.max_d, depth_start, depth_interval, is_master_gpu,
+                            depth_chunk=FLAGS.depth_chunk, cost_metric=FLAGS.cost_metric,
+                            group_num=FLAGS.correlation_groups, bidirectional=True,
+                            view_coefficients=view_coefficients, visibility=FLAGS.visibility)
+
+                        # classification loss of both sweeps, the backward one starts at the far plane
+                        loss0, mae0, less_one_temp, less_three_temp, depth_map = \
+                            mvsnet_classification_loss(
+                                prob_volume, depth_image, FLAGS.max_d, depth_start, depth_interval)
+                        backward_depth_start = depth_start + (FLAGS.max_d - 1) * depth_interval
+                        loss1, mae1, less_one_accuracy, less_three_accuracy, _ = \
+                            mvsnet_classification_loss(backward_prob_volume, depth_image, FLAGS.max_d,
+                                                       backward_depth_start, -depth_interval)
+                        loss = (loss0 + loss1) / 2
+                        less_one_accuracy = (less_one_temp + less_one_accuracy) / 2
+                        less_three_accuracy = (less_three_temp + less_three_accuracy) / 2
+
                     elif FLAGS.regularization == 'GRU':
 
                         # probability volume
                         prob_volume = inference_prob_recurrent(
-                            images, cams, FLAGS.max_d, depth_start, depth_interval, is_master_gpu)
+                            images, cams, FLAGS.max_d, depth_start, depth_interval, is_master_gpu,
+                            depth_chunk=FLAGS.depth_chunk, cost_metric=FLAGS.cost_metric,
+                            group_num=FLAGS.correlation_groups, view_coefficients=view_coefficients,
+                            visibility=FLAGS.visibility)
 
                         # classification loss
                         loss, mae, less_one_accuracy, less_three_accuracy, depth_map = \
@@ -358,6 +626,9 @@ def train(traning_list):
         # training opt
         train_opt = opt.apply_gradients(grads, global_step=global_step)
 
+        # sampler position after the last sample of the step (last tower)
+        last_sample_position = sample_position[-1]
+
         # summary 
         summaries.append(tf.summary.scalar('loss', loss))
         summaries.append(tf.summary.scalar('less_one_accuracy', less_one_accuracy))
@@ -395,19 +666,34 @@ def train(traning_list):
                     ('-'.join([pretrained_model_path, str(FLAGS.ckpt_step)])), Notify.ENDC)
                 total_step = FLAGS.ckpt_step
 
+            # continue the interrupted epoch
+            start_epoch = 0
+            start_step = 0
+            if sampler_state is not None:
+                start_epoch = sampler_state['train_epoch']
+                start_step = sampler_state['train_step']
+
+            # the forward and backward passes of a GRU sample are consecutive, a checkpoint saved between
+            # them would resume after the backward pass: the save waits for the end of the pair
+            paired_passes = FLAGS.regularization == 'GRU' and not FLAGS.bidirectional_gru
+            save_pending = False
+
+            # the sampler is endless: the iterator is initialized once, a new initialization per epoch would
+            # drop the samples already read ahead from the sampler into the buffers and the worker queue
+            sess.run(training_iterator.initializer)
+
             # training several epochs
-            for epoch in range(FLAGS.epoch):
+            for epoch in range(start_epoch, FLAGS.epoch):
 
                 # training of one epoch
-                step = 0
-                sess.run(training_iterator.initializer)
-                for _ in range(int(training_sample_size / FLAGS.num_gpus)):
+                step = start_step if epoch == start_epoch else 0
+                for _ in range(int(training_sample_size / FLAGS.num_gpus) - step // (FLAGS.batch_size * FLAGS.num_gpus)):
 
                     # run one batch
                     start_time = time.time()
                     try:
-                        out_summary_op, out_opt, out_loss, out_less_one, out_less_three = sess.run(
-                        [summary_op, train_opt, loss, less_one_accuracy, less_three_accuracy])
+                        out_summary_op, out_opt, out_loss, out_less_one, out_less_three, out_position = sess.run(
+                        [summary_op, train_opt, loss, less_one_accuracy, less_three_accuracy, last_sample_position])
                     except tf.errors.OutOfRangeError:
                         print("End of dataset")  # ==> "End of dataset"
                         break
@@ -425,36 +711,71 @@ def train(traning_list):
                    
                     # save the model checkpoint periodically
                     if (total_step % FLAGS.snapshot == 0 or step == (training_sample_size - 1)):
+                        save_pending = True
+                    pair_open = paired_passes and (step + FLAGS.batch_size * FLAGS.num_gpus) % 2 == 1
+                    if save_pending and not pair_open:
+                        save_pending = False
                         model_folder = os.path.join(FLAGS.model_folder, FLAGS.regularization)
                         if not os.path.exists(model_folder):
                             os.mkdir(model_folder)
                         ckpt_path = os.path.join(model_folder, 'model.ckpt')
                         print(Notify.INFO, 'Saving model to %s' % ckpt_path, Notify.ENDC)
-                        saver.save(sess, ckpt_path, global_step=total_step)
+                        saved_path = saver.save(sess, ckpt_path, global_step=total_step)
+                        saved_state = sampler.state()
+                        saved_state.update({
+                            'epoch': int(out_position[0]), 'offset': int(out_position[1]),
+                            'train_epoch': epoch, 'train_step': step + FLAGS.batch_size * FLAGS.num_gpus})
+                        save_sampler_state(saved_path, saved_state)
                     step += FLAGS.batch_size * FLAGS.num_gpus
                     total_step += FLAGS.batch_size * FLAGS.num_gpus
 
+        # stop the sample loading workers
+        if not FLAGS.tf_data:
+            mvs_generator.close()
+
 def main(argv=None):  # pylint: disable=unused-argument
     """ program entrance """
+    global homography_table
+    # decoded image cache, copied to the worker processes
+    image_cache.configure(FLAGS.image_cache_mb * 1024 * 1024, FLAGS.image_cache_report)
+
     # Prepare all training samples
-    if FLAGS.train_blendedmvs:
-        sample_list = gen_blendedmvs_path(FLAGS.blendedmvs_data_root, mode='training_mvs')
-    if FLAGS.train_blendedmvg:
-        sample_list = gen_blendedmvs_path(FLAGS.blendedmvs_data_root, mode='training_mvg')
-    if FLAGS.train_dtu:
-        sample_list = gen_dtu_resized_path(FLAGS.dtu_data_root)
-    if FLAGS.train_eth3d:
-        sample_list = gen_eth3d_path(FLAGS.eth3d_data_root, mode='training')
-    if FLAGS.train_revery:
-
-        print("Revery flags:")
-        pprint.pprint(preprocess.revery_opts)
-
-        sample_list = gen_revery_path(FLAGS.revery_data_root, 'training_list.txt', FLAGS.revery_cams_dir)
+    if FLAGS.shard_folder is not None:
+        # packed samples, the dataset flags still select the dataset specified process
+        sample_list = gen_shard_path(
+            FLAGS.shard_folder, view_num=FLAGS.view_num, max_d=FLAGS.max_d, interval_scale=1)
+    elif FLAGS.sample_index_folder is not None:
+        # pre-scanned samples, the dataset flags still select the dataset specified process
+        sample_list = SampleIndex(FLAGS.sample_index_folder)
+    else:
+        if FLAGS.train_blendedmvs:
+            sample_list = gen_blendedmvs_index(FLAGS.blendedmvs_data_root, FLAGS.view_num, mode='training_mvs')
+        if FLAGS.train_blendedmvg:
+            sample_list = gen_blendedmvs_index(FLAGS.blendedmvs_data_root, FLAGS.view_num, mode='training_mvg')
+        if FLAGS.train_dtu:
+            sample_list = gen_dtu_resized_index(FLAGS.dtu_data_root, FLAGS.view_num)
+        if FLAGS.train_eth3d:
+            sample_list = gen_eth3d_path(FLAGS.eth3d_data_root, mode='training')
+        if FLAGS.train_revery:
+
+            print("Revery flags:")
+            pprint.pprint(preprocess.revery_opts)
+
+            sample_list = gen_revery_index(
+                FLAGS.revery_data_root, 'training_list.txt', FLAGS.revery_cams_dir, FLAGS.view_num)
+
+    # homography table of the shared revery cameras, built once
+    if FLAGS.homography_table is not None:
+        if not FLAGS.train_revery or FLAGS.tf_data:
+            raise Exception('--homography_table needs --train_revery and the python generator (no --tf_data).')
+        homography_table = HomographyTable(FLAGS.homography_table)
+        if len(homography_table) == 0:
+            homography_table.fill(FLAGS.revery_cams_dir, FLAGS.view_num, process_cams, sample_depth_values)
+            homography_table.save()
+            print(Notify.INFO, 'Homography table of %d entries saved to %s'
+                  % (len(homography_table), FLAGS.homography_table), Notify.ENDC)
         
-    # Shuffle
-    random.shuffle(sample_list)
-    # Training entrance.
+    # Training entrance, the samples are shuffled by the sampler of the generator.
     train(sample_list)
 
 
@@ -10,6 +10,7 @@ import os
 import time
 import sys
 import math
+import itertools
 import argparse
 import numpy as np
 
@@ -24,6 +25,13 @@ from model import *
 from loss import *
 
 import preprocess
+from pfm import load_pfm_mmap
+from data_cache import load_cam_cached, image_cache
+from sample_index import SampleIndex, gen_blendedmvs_index, gen_dtu_resized_index
+from shards import ShardSample, read_shard_sample, gen_shard_path
+from samplers import make_sampler
+from data_pipeline import *
+from homography_coefficients import linear_depth_values, inverse_depth_values, view_transform_coefficients
 
 # params for datasets
 tf.app.flags.DEFINE_string('blendedmvs_data_root', '/data/BlendedMVS/dataset_low_res', 
@@ -34,6 +42,18 @@ tf.app.flags.DEFINE_string('dtu_data_root', '/data/dtu',
                            """Path to dtu dataset.""")
 tf.app.flags.DEFINE_string('validate_set', 'dtu', 
                             """Dataset to validate.""")
+tf.app.flags.DEFINE_string('shard_folder', None, 
+                           """Path to packed shards of the validation set (see pack_shards.py).""")
+tf.app.flags.DEFINE_string('sample_index_folder', None, 
+                           """Path to a cleaned sample index of the validation set (see prescan.py).""")
+tf.app.flags.DEFINE_integer('image_cache_mb', 0,
+                            """Memory budget in MB of the decoded image cache (per process, 0 to disable).""")
+tf.app.flags.DEFINE_integer('image_cache_report', 1000,
+                            """Print the image cache stats every n image reads (0 to disable).""")
+tf.app.flags.DEFINE_integer('scene_window', 0,
+                            """Shuffle the samples of windows of n scenes together (0 to keep the list order).""")
+tf.app.flags.DEFINE_boolean('tf_data', False,
+                            """Read the samples with the native tf.data pipeline instead of the python generator.""")
 
 # params for config
 tf.app.flags.DEFINE_integer('view_num', 3, 
@@ -46,6 +66,26 @@ tf.app.flags.DEFINE_integer('max_h', 512,
                             """Maximum image height when training.""")
 tf.app.flags.DEFINE_float('sample_scale', 0.25, 
                             """Downsample scale for building cost volume.""")
+tf.app.flags.DEFINE_integer('depth_chunk', 0, 
+                            """Number of depth planes warped together when building the cost volume (0 for all).""")
+tf.app.flags.DEFINE_string('cost_metric', 'variance', 
+                            """Cost volume metric, 'variance' or 'correlation' (group-wise, fewer channels).""")
+tf.app.flags.DEFINE_integer('correlation_groups', 8, 
+                            """Number of feature channel groups of the correlation metric, a divisor of the feature channels.""")
+tf.app.flags.DEFINE_string('visibility', 'none', 
+                            """'warp' to warp the depth planes only inside their visible box, 'cost' to also average only the visible views.""")
+tf.app.flags.DEFINE_string('cost_dtype', 'float32', 
+                            """Data type of the 3DCNNs cost volume and regularization, 'float32', 'float16' or 'bfloat16'.""")
+tf.app.flags.DEFINE_boolean('host_homographies', False, 
+                            """Compute the homography transform coefficients in the data pipeline with NumPy instead of in the graph.""")
+tf.app.flags.DEFINE_boolean('cascade', False, 
+                            """Coarse-to-fine 3DCNNs inference: a coarse sweep at half the cost volume resolution, then per-pixel hypotheses around it.""")
+tf.app.flags.DEFINE_integer('cascade_coarse_d', 64, 
+                            """Number of depth planes of the coarse cascade sweep.""")
+tf.app.flags.DEFINE_integer('cascade_fine_d', 32, 
+                            """Number of per-pixel depth hypotheses of the fine cascade sweep.""")
+tf.app.flags.DEFINE_float('cascade_range_scale', 2.0, 
+                            """Half range of the fine cascade hypotheses, in standard deviations of the coarse depth.""")
 tf.app.flags.DEFINE_float('interval_scale', 1, 
                             """Downsample scale for building cost volume.""")
 tf.app.flags.DEFINE_integer('batch_size', 1, 
@@ -67,38 +107,94 @@ tf.app.flags.DEFINE_string('validation_result_path',
 
 FLAGS = tf.app.flags.FLAGS
 
+def sample_transform_coefficients(cams):
+    """ (V - 1, D, 8) homography transform coefficients of the sample cameras, for the depth planes
+        of the sweep of validate_mvsnet """
+    depth_start, depth_interval, _, depth_end = cams[0][1, 3]
+    if FLAGS.regularization == 'GRU' and FLAGS.inverse_depth:
+        depth_values = inverse_depth_values(depth_start, depth_end, FLAGS.max_d)
+    else:
+        depth_values = linear_depth_values(depth_start, depth_interval, FLAGS.max_d)
+    return view_transform_coefficients(cams, depth_values)
+
+def load_sample_tf(paths, position):
+    """ tf.data version of the MVSGenerator sample reading """
+    images = []
+    cams = []
+    for view in range(FLAGS.view_num):
+        images.append(tf_read_image(paths[2 * view]))
+        cams.append(tf_read_cam(paths[2 * view + 1], FLAGS.interval_scale, FLAGS.max_d))
+    images = tf.cast(tf.stack(images, axis=0), tf.float32)
+    cams = tf.stack(cams, axis=0)
+    depth_image = tf_read_depth(paths[2 * FLAGS.view_num])
+
+    cams = tf_set_cam_entry(cams, (1, 3, 1), (cams[:, 1, 3, 3] - cams[:, 1, 3, 0]) / FLAGS.max_d)
+    cams = tf_set_cam_entry(cams, (1, 3, 2), FLAGS.max_d)
+
+    if FLAGS.validate_set == 'eth3d':
+        # crop to fit the network
+        images, cams, depth_image = tf_crop_mvs_input(images, cams, FLAGS.max_h, FLAGS.max_w, depth_image)
+        # downsize by 4 to fit depth map output
+        cams = tf_scale_cams(cams, scale=FLAGS.sample_scale)
+        depth_image = tf_scale_image(depth_image, scale=FLAGS.sample_scale)
+
+    if FLAGS.validate_set == 'blendedmvs':
+        # downsize by 4 to fit depth map output
+        depth_image = tf_scale_image(depth_image, scale=FLAGS.sample_scale)
+        cams = tf_scale_cams(cams, scale=FLAGS.sample_scale)
+
+    depth_start = cams[0, 1, 3, 0] + cams[0, 1, 3, 1]
+    depth_end = cams[0, 1, 3, 0] + (FLAGS.max_d - 2) * cams[0, 1, 3, 1]
+    depth_image = tf_mask_depth_image(depth_image, depth_start, depth_end)
+    if FLAGS.host_homographies:
+        coefficients = tf.py_func(sample_transform_coefficients, [cams], tf.float32)
+        return images, tf.cast(cams, tf.float32), depth_image, coefficients
+    return images, tf.cast(cams, tf.float32), depth_image
+
 class MVSGenerator:
     """ data generator class, tf only accept generator without param """
-    def __init__(self, sample_list, view_num):
+    def __init__(self, sample_list, view_num, sampler=None):
         self.sample_list = sample_list
         self.view_num = view_num
         self.sample_num = len(sample_list)
         self.counter = 0
+        # samples are read in list order without sampler
+        self.sampler = sampler
+
+    def iter_data(self):
+        """ one pass over the samples """
+        if self.sampler is None:
+            return iter(self.sample_list)
+        return (self.sample_list[index] for index in itertools.islice(self.sampler, self.sample_num))
     
     def __iter__(self):
         while True:
-            for data in self.sample_list: 
+            for data in self.iter_data(): 
                 start_time = time.time()
                 
                 ###### read input data ######
-                images = []
-                cams = []
-                for view in range(self.view_num):
+                if isinstance(data, ShardSample):
+                    images, cams, depth_image = read_shard_sample(data)
+                else:
+                    images = []
+                    cams = []
+                    for view in range(self.view_num):
 
 
-                    print("\033[1;35m[DEBUG] Loading view image: '" + str(data[2 * view]) + "'...\033[0m")
+                        print("\033[1;35m[DEBUG] Loading view image: '" + str(data[2 * view]) + "'...\033[0m")
 
-                    image = cv2.imread(data[2 * view])
-                    cam = load_cam(open(data[2 * view + 1]), FLAGS.interval_scale)
+                        images.append(image_cache.load(data[2 * view], cv2.imread))
+                        cams.append(load_cam_cached(data[2 * view + 1], FLAGS.interval_scale))
+                
+                    if preprocess.revery_opts.read_png_depth:
+                        depth_image = load_depth_packed_png(data[2 * self.view_num])
+                    else:
+                        depth_image = load_pfm_mmap(data[2 * self.view_num])
+
+                cams = [writable_cam(cam) for cam in cams]
+                for cam in cams:
                     cam[1, 3, 1] = (cam[1, 3, 3] - cam[1, 3, 0]) / FLAGS.max_d
                     cam[1, 3, 2] = FLAGS.max_d
-                    images.append(image)
-                    cams.append(cam)
-                
-                if preprocess.revery_opts.read_png_depth:
-                    depth_image = load_depth_packed_png(data[2 * self.view_num])
-                else:
-                    depth_image = load_pfm(open(data[2 * self.view_num]))
                 
                 if FLAGS.validate_set == 'eth3d':
                     # crop to fit the network
@@ -122,23 +218,38 @@ class MVSGenerator:
                 duration = time.time() - start_time
                 images = np.stack(images, axis=0)
                 cams = np.stack(cams, axis=0)
-                yield (images, cams, depth_image) 
+                if FLAGS.host_homographies:
+                    yield (images, cams, depth_image, sample_transform_coefficients(cams))
+                else:
+                    yield (images, cams, depth_image) 
 
 def validate_mvsnet(mvs_list):
     """ validate mvsnet """
     print ('Validation sample number: ', len(mvs_list))
 
     # Training and validation generators
-    mvs_generator = iter(MVSGenerator(mvs_list, FLAGS.view_num))
-    generator_data_type = (tf.float32, tf.float32, tf.float32)
-    # Datasets from generators
-    mvs_set = tf.data.Dataset.from_generator(lambda: mvs_generator, generator_data_type)
-    mvs_set = mvs_set.batch(FLAGS.batch_size)
-    mvs_set = mvs_set.prefetch(buffer_size=1)
+    sampler = make_sampler(mvs_list, FLAGS.scene_window) if FLAGS.scene_window > 0 else None
+    if FLAGS.tf_data:
+        # samples decoded by a parallel map over the sample indices
+        mvs_set = mvs_dataset(mvs_list, load_sample_tf, sampler)
+        mvs_set = mvs_set.batch(FLAGS.batch_size)
+        mvs_set = mvs_set.prefetch(buffer_size=AUTOTUNE)
+    else:
+        mvs_generator = iter(MVSGenerator(mvs_list, FLAGS.view_num, sampler))
+        generator_data_type = (tf.float32,) * (4 if FLAGS.host_homographies else 3)
+        # Datasets from generators
+        mvs_set = tf.data.Dataset.from_generator(lambda: mvs_generator, generator_data_type)
+        mvs_set = mvs_set.batch(FLAGS.batch_size)
+        mvs_set = mvs_set.prefetch(buffer_size=1)
     # iterators
     mvs_iterator = mvs_set.make_initializable_iterator()
     # data
-    images, cams, depth_image = mvs_iterator.get_next()
+    view_coefficients = None
+    if FLAGS.host_homographies:
+        images, cams, depth_image, view_coefficients = mvs_iterator.get_next()
+        view_coefficients.set_shape(tf.TensorShape([None, FLAGS.view_num - 1, None, 8]))
+    else:
+        images, cams, depth_image = mvs_iterator.get_next()
 
     # consolidate inputs
     images.set_shape(tf.TensorShape([None, FLAGS.view_num, None, None, 3]))
@@ -165,12 +276,22 @@ def validate_mvsnet(mvs_list):
     images = tf.stack(normalized_images, axis=1)
 
     # depth map inference
-    if FLAGS.regularization == '3DCNNs':
+    if FLAGS.regularization == '3DCNNs' and FLAGS.cascade:
+        depth_map, prob_map = inference_cascade(
+            images, cams, FLAGS.max_d, depth_start, depth_interval,
+            FLAGS.cascade_coarse_d, FLAGS.cascade_fine_d, FLAGS.cascade_range_scale,
+            cost_metric=FLAGS.cost_metric, group_num=FLAGS.correlation_groups, cost_dtype=FLAGS.cost_dtype,
+            visibility=FLAGS.visibility)
+    elif FLAGS.regularization == '3DCNNs':
         depth_map, prob_map = inference(
-            images, cams, FLAGS.max_d, depth_start, depth_interval)
+            images, cams, FLAGS.max_d, depth_start, depth_interval, depth_chunk=FLAGS.depth_chunk,
+            cost_metric=FLAGS.cost_metric, group_num=FLAGS.correlation_groups, cost_dtype=FLAGS.cost_dtype,
+            view_coefficients=view_coefficients, visibility=FLAGS.visibility)
     elif FLAGS.regularization == 'GRU':
         depth_map, prob_map = inference_winner_take_all(images, cams, 
-            depth_num, depth_start, depth_end, reg_type='GRU', inverse_depth=FLAGS.inverse_depth)
+            depth_num, depth_start, depth_end, reg_type='GRU', inverse_depth=FLAGS.inverse_depth,
+            cost_metric=FLAGS.cost_metric, group_num=FLAGS.correlation_groups,
+            view_coefficients=view_coefficients, visibility=FLAGS.visibility)
 
     if FLAGS.inverse_depth:
         interval = tf.ones_like(depth_interval)
@@ -236,15 +357,29 @@ def validate_mvsnet(mvs_list):
             log_file.write('Model check point %d, L1 loss = %f, < 1 = %f, < 3 = %f \n' 
                            % (int(FLAGS.ckpt_step), float(ave_loss), float(ave_per1), float(ave_per3)))
 
-def main(argv=None):
-    """ program entrance """
-    # gen validation list
-    if FLAGS.validate_set == 'blendedmvs':
-        sample_list = gen_blendedmvs_path(FLAGS.blendedmvs_data_root, mode='validation')
+def gen_validation_list():
+    """ validation samples of FLAGS.validate_set """
+    if FLAGS.shard_folder is not None:
+        sample_list = gen_shard_path(FLAGS.shard_folder, view_num=FLAGS.view_num,
+                                     max_d=FLAGS.max_d, interval_scale=FLAGS.interval_scale)
+    elif FLAGS.sample_index_folder is not None:
+        sample_list = SampleIndex(FLAGS.sample_index_folder)
+    elif FLAGS.validate_set == 'blendedmvs':
+        sample_list = gen_blendedmvs_index(FLAGS.blendedmvs_data_root, FLAGS.view_num, mode='validation')
     elif FLAGS.validate_set == 'eth3d':
         sample_list = gen_eth3d_path(FLAGS.eth3d_data_root, mode='validation')
     elif FLAGS.validate_set == 'dtu':
-        sample_list = gen_dtu_resized_path(FLAGS.dtu_data_root, mode='validation')
+        sample_list = gen_dtu_resized_index(FLAGS.dtu_data_root, FLAGS.view_num, mode='validation')
+    return sample_list
+
+def main(argv=None):
+    """ program entrance """
+    image_cache.configure(FLAGS.image_cache_mb * 1024 * 1024, FLAGS.image_cache_report)
+    if FLAGS.host_homographies and FLAGS.cascade:
+        raise Exception('--host_homographies is for the single sweep, not --cascade.')
+
+    # gen validation list
+    sample_list = gen_validation_list()
 
     # inference
     validate_mvsnet(sample_list)
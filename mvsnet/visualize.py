@@ -8,7 +8,7 @@ import numpy as np
 import cv2
 import argparse
 import matplotlib.pyplot as plt
-from preprocess import load_pfm
+from pfm import load_pfm_mmap
 from depthfusion import read_gipuma_dmb
 
 if __name__ == '__main__':
@@ -23,7 +23,7 @@ if __name__ == '__main__':
         plt.imshow(depth_image, 'rainbow')
         plt.show()
     elif depth_path.endswith('pfm'):
-        depth_image = load_pfm(open(depth_path, 'rb'))
+        depth_image = load_pfm_mmap(depth_path)
         ma = np.ma.masked_equal(depth_image, 0.0, copy=False)
         print('value range: ', ma.min(), ma.max())
         plt.imshow(depth_image, 'rainbow')
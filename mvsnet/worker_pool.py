@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+Multi-process sample loading for the MVS data generators.
+"""
+
+from __future__ import print_function
+
+import collections
+import multiprocessing as mp
+import signal
+
+
+def _init_worker():
+    """ leave keyboard interrupts to the main process """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class OrderedWorkerPool:
+    """ load samples in worker processes, return them in submission order """
+    def __init__(self, load_fn, num_workers, queue_size):
+        # load_fn must be a module level function so that it can be sent to the workers
+        self.load_fn = load_fn
+        self.num_workers = num_workers
+        self.queue_size = max(queue_size, num_workers)
+        self.pool = mp.Pool(num_workers, initializer=_init_worker)
+
+    def imap(self, iterable):
+        """ same as Pool.imap, but at most queue_size samples are loaded ahead of the consumer """
+        pending = collections.deque()
+        try:
+            for item in iterable:
+                pending.append(self.pool.apply_async(self.load_fn, (item,)))
+                if len(pending) >= self.queue_size:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            # drop the samples loaded ahead if the consumer stops early
+            pending.clear()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()